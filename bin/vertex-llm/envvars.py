@@ -2,19 +2,141 @@ class EnvVars:
     test_type = "TEST_TYPE"
     http_port_qa = "HTTP_PORT_QA"
     http_port_material = "HTTP_PORT_MATERIAL"
+    http_port_chunking_jobs = "HTTP_PORT_CHUNKING_JOBS"
     vertex_ai_region = "VERTEX_AI_REGION"
     vertex_ai_project_id = "VERTEX_AI_PROJECT_ID"
     vertex_ai_model = "VERTEX_AI_MODEL"
     min_chunk_size = "MIN_CHUNK_SIZE"
+    prechunk_window_chars = "PRECHUNK_WINDOW_CHARS"
+    prechunk_parallelism = "PRECHUNK_PARALLELISM"
+    prechunk_pages_per_range = "PRECHUNK_PAGES_PER_RANGE"
+    whole_chunks = "WHOLE_CHUNKS"
     max_output_tokens = "MAX_OUTPUT_TOKENS"
     google_application_credentials = "GOOGLE_APPLICATION_CREDENTIALS"
+    vertex_client_pool_size = "VERTEX_CLIENT_POOL_SIZE"
+    vertex_keep_alive = "VERTEX_KEEP_ALIVE"
+    vertex_health_check_interval = "VERTEX_HEALTH_CHECK_INTERVAL"
+    max_streams = "MAX_STREAMS"
+    stream_idle_timeout = "STREAM_IDLE_TIMEOUT"
+    stream_heartbeat_interval = "STREAM_HEARTBEAT_INTERVAL"
+    stream_resume_window = "STREAM_RESUME_WINDOW"
+    stream_replay_max_bytes = "STREAM_REPLAY_MAX_BYTES"
+    stream_replay_max_stream_bytes = "STREAM_REPLAY_MAX_STREAM_BYTES"
+    stream_replay_redis_url = "STREAM_REPLAY_REDIS_URL"
+    batch_concurrency = "BATCH_CONCURRENCY"
+    max_batch_size = "MAX_BATCH_SIZE"
+    reply_cache_ttl = "REPLY_CACHE_TTL"
+    reply_cache_max_bytes = "REPLY_CACHE_MAX_BYTES"
+    reply_cache_redis_url = "REPLY_CACHE_REDIS_URL"
+    coalesce_queries = "COALESCE_QUERIES"
+    coalesce_streams = "COALESCE_STREAMS"
+    chunk_store_dir = "CHUNK_STORE_DIR"
+    chunk_store_max_bytes = "CHUNK_STORE_MAX_BYTES"
+    chunk_store_max_age = "CHUNK_STORE_MAX_AGE"
+    chunking_jobs_dir = "CHUNKING_JOBS_DIR"
+    chunking_jobs_concurrency = "CHUNKING_JOBS_CONCURRENCY"
+    chunking_jobs_max_documents = "CHUNKING_JOBS_MAX_DOCUMENTS"
+    chunking_jobs_max_age = "CHUNKING_JOBS_MAX_AGE"
+    chunking_batch_staging_uri = "CHUNKING_BATCH_STAGING_URI"
+    chunking_batch_poll_interval = "CHUNKING_BATCH_POLL_INTERVAL"
+    download_cache_dir = "DOWNLOAD_CACHE_DIR"
+    download_cache_max_bytes = "DOWNLOAD_CACHE_MAX_BYTES"
+    download_max_bytes = "DOWNLOAD_MAX_BYTES"
+    download_timeout = "DOWNLOAD_TIMEOUT"
+    gemini_executor_workers = "GEMINI_EXECUTOR_WORKERS"
+    gemini_executor_max_queue = "GEMINI_EXECUTOR_MAX_QUEUE"
+    gemini_executor_queue_timeout = "GEMINI_EXECUTOR_QUEUE_TIMEOUT"
+    admission_rate = "ADMISSION_RATE"
+    admission_burst = "ADMISSION_BURST"
+    admission_max_wait = "ADMISSION_MAX_WAIT"
+    admission_initial_concurrency = "ADMISSION_INITIAL_CONCURRENCY"
+    admission_min_concurrency = "ADMISSION_MIN_CONCURRENCY"
+    admission_max_concurrency = "ADMISSION_MAX_CONCURRENCY"
+    vertex_deadline = "VERTEX_DEADLINE"
+    vertex_max_attempts = "VERTEX_MAX_ATTEMPTS"
+    vertex_retry_base_delay = "VERTEX_RETRY_BASE_DELAY"
+    vertex_hedging = "VERTEX_HEDGING"
+    vertex_hedge_percentile = "VERTEX_HEDGE_PERCENTILE"
+    prompt_cache_ttl = "PROMPT_CACHE_TTL"
+    prompt_cache_min_chars = "PROMPT_CACHE_MIN_CHARS"
+    claude_context_window = "CLAUDE_CONTEXT_WINDOW"
+    gemini_context_window = "GEMINI_CONTEXT_WINDOW"
+    min_output_tokens = "MIN_OUTPUT_TOKENS"
+    token_overflow = "TOKEN_OVERFLOW"
+    exact_token_margin = "EXACT_TOKEN_MARGIN"
+    router_failure_threshold = "ROUTER_FAILURE_THRESHOLD"
+    router_open_for = "ROUTER_OPEN_FOR"
+    router_latency_outlier_factor = "ROUTER_LATENCY_OUTLIER_FACTOR"
+    workers = "WORKERS"
+    worker_shutdown_timeout = "WORKER_SHUTDOWN_TIMEOUT"
 
 
 class Defaults:
     test_type = "unit"  # or "integration"
     http_port_qa = "80"
     http_port_material = "81"
-    vertex_ai_region = "us-central1"
-    vertex_ai_model = "claude-sonnet-4"
+    http_port_chunking_jobs = "82"
+    vertex_ai_region = "us-central1"  # comma separated to route over several regions
+    vertex_ai_model = "claude-sonnet-4"  # comma separated to route over several models
     min_chunk_size = "4000"
+    prechunk_window_chars = "24000"  # 0 sends text materials to Claude whole
+    prechunk_parallelism = "4"
+    prechunk_pages_per_range = "20"  # 0 sends PDFs whole
+    whole_chunks = "false"  # true makes Claude's read_and_chunk yield whole chunks
     max_output_tokens = "8192"
+    vertex_client_pool_size = "4"
+    vertex_keep_alive = "300"
+    vertex_health_check_interval = "60"
+    max_streams = "512"
+    stream_idle_timeout = "300"
+    stream_heartbeat_interval = "15"  # for SSE and NDJSON streams, 0 sends none
+    stream_resume_window = "60"  # 0 closes a stream as soon as its client goes away
+    stream_replay_max_bytes = "67108864"
+    stream_replay_max_stream_bytes = "1048576"
+    batch_concurrency = "16"
+    max_batch_size = "1000"
+    reply_cache_ttl = "3600"  # 0 disables the cache
+    reply_cache_max_bytes = "67108864"
+    coalesce_queries = "true"
+    coalesce_streams = "false"
+    chunk_store_dir = ""  # empty disables the chunk store
+    chunk_store_max_bytes = "1073741824"
+    chunk_store_max_age = "2592000"
+    chunking_jobs_dir = "./.chunking-jobs"  # empty disables the chunking job API
+    chunking_jobs_concurrency = "4"
+    chunking_jobs_max_documents = "1000"
+    chunking_jobs_max_age = "604800"
+    chunking_batch_staging_uri = ""  # gs://bucket/prefix for Gemini batch prediction
+    chunking_batch_poll_interval = "30"
+    download_cache_dir = "./.download-cache"
+    download_cache_max_bytes = "1073741824"
+    download_max_bytes = "104857600"
+    download_timeout = "60"
+    gemini_executor_workers = "32"
+    gemini_executor_max_queue = "256"
+    gemini_executor_queue_timeout = "5"
+    # Rate and burst are for the whole service and split between its workers;
+    # the concurrency limits apply to each worker
+    admission_rate = "0"  # calls per second to each model, 0 does not limit the rate
+    admission_burst = "10"
+    admission_max_wait = "10"
+    admission_initial_concurrency = "16"
+    admission_min_concurrency = "1"
+    admission_max_concurrency = "256"  # 0 disables admission control
+    vertex_deadline = "120"  # 0 means no deadline
+    vertex_max_attempts = "3"
+    vertex_retry_base_delay = "0.5"
+    vertex_hedging = "false"
+    vertex_hedge_percentile = "0.95"
+    prompt_cache_ttl = "3600"  # of Gemini context caches, 0 sends prefixes inline
+    prompt_cache_min_chars = "4096"
+    claude_context_window = "200000"  # 0 disables token budgeting for Claude
+    gemini_context_window = "1048576"  # 0 disables token budgeting for Gemini
+    min_output_tokens = "1024"
+    token_overflow = "reject"  # or "truncate"
+    exact_token_margin = "0.1"  # 0 never calls count_tokens
+    router_failure_threshold = "5"
+    router_open_for = "30"
+    router_latency_outlier_factor = "3"
+    workers = "1"  # more than 1 runs a supervisor with that many worker processes
+    worker_shutdown_timeout = "30"
@@ -1,78 +1,599 @@
-from asyncio import run, sleep
+from __future__ import annotations
+
+from asyncio import Event, get_running_loop, run
 from os import getenv
-from typing import NoReturn
+from signal import SIGINT, SIGTERM
+from typing import Callable
 
 from dotenv import load_dotenv
+from sbilifeco.cp.llm.chunking_jobs_http_server import ChunkingJobsHttpServer
 from sbilifeco.cp.llm.http_server import LLMHttpServer
+from sbilifeco.cp.llm.replay import RedisReplayShare
 from sbilifeco.cp.material_reader.http_server import MaterialReaderHttpServer
 from sbilifeco.boundaries.llm import ILLM
+from sbilifeco.boundaries.llm_metrics import LLMMetrics
+from sbilifeco.boundaries.material_reader import BaseMaterialReader
 from sbilifeco.gateways.vertex import VertexAI
+from sbilifeco.gateways.vertex_admission import AdmissionControlledLLM
+from sbilifeco.gateways.vertex_batch_chunking import VertexBatchChunkingBackend
+from sbilifeco.gateways.vertex_chunk_store import ChunkStore
+from sbilifeco.gateways.vertex_chunking_jobs import (
+    ChunkingJobs,
+    IChunkingBackend,
+    StreamingChunkingBackend,
+)
+from sbilifeco.gateways.vertex_downloader import MaterialDownloader
 from sbilifeco.gateways.vertex_gemini import VertexGemini
+from sbilifeco.gateways.vertex_prechunker import PreChunker
+from sbilifeco.gateways.vertex_token_budget import TokenBudget
+from sbilifeco.gateways.vertex_reply_cache import (
+    CachedLLM,
+    InMemoryReplyCache,
+    IReplyCacheBackend,
+    RedisReplyCache,
+)
+from sbilifeco.gateways.vertex_retry import RetryPolicy
+from sbilifeco.gateways.vertex_router import VertexRouter
+from sbilifeco.gateways.vertex_worker_reader import WorkerMaterialReader
 
 from envvars import Defaults, EnvVars
+from supervisor import VertexLLMSupervisor
 
 
 class VertexLLMMicroservice:
+    def __init__(self) -> None:
+        self.vertex: (
+            VertexAI | VertexGemini | AdmissionControlledLLM | VertexRouter | None
+        ) = None
+        self.http_server_qa: LLMHttpServer | None = None
+        self.http_server_material: MaterialReaderHttpServer | None = None
+        self.worker_reader: WorkerMaterialReader | None = None
+        self.chunking_jobs: ChunkingJobs | None = None
+        self.batch_chunking: VertexBatchChunkingBackend | None = None
+        self.http_server_chunking_jobs: ChunkingJobsHttpServer | None = None
+        self.redis_cache: RedisReplyCache | None = None
+        self.replay_share: RedisReplayShare | None = None
+        self.serves_chunking_jobs = True
+        self.on_started: Callable[[], None] = lambda: None
+
+    def set_serves_chunking_jobs(
+        self, serves_chunking_jobs: bool
+    ) -> VertexLLMMicroservice:
+        """Whether to run the chunking jobs and their server, which only one process may do."""
+        self.serves_chunking_jobs = serves_chunking_jobs
+        return self
+
+    def set_on_started(self, on_started: Callable[[], None]) -> VertexLLMMicroservice:
+        self.on_started = on_started
+        return self
+
     async def start(self):
         # Settings from environment
-        region = getenv(EnvVars.vertex_ai_region, Defaults.vertex_ai_region)
+        regions = [
+            region.strip()
+            for region in getenv(
+                EnvVars.vertex_ai_region, Defaults.vertex_ai_region
+            ).split(",")
+            if region.strip()
+        ]
         project_id = getenv(EnvVars.vertex_ai_project_id, "")
-        model = getenv(EnvVars.vertex_ai_model, Defaults.vertex_ai_model)
+        models = [
+            model.strip()
+            for model in getenv(EnvVars.vertex_ai_model, Defaults.vertex_ai_model).split(
+                ","
+            )
+            if model.strip()
+        ]
         http_port_qa = int(getenv(EnvVars.http_port_qa, Defaults.http_port_qa))
         http_port_material = int(
             getenv(EnvVars.http_port_material, Defaults.http_port_material)
         )
+        http_port_chunking_jobs = int(
+            getenv(EnvVars.http_port_chunking_jobs, Defaults.http_port_chunking_jobs)
+        )
         max_output_tokens = int(
             getenv(EnvVars.max_output_tokens, Defaults.max_output_tokens)
         )
         min_chunk_size = int(getenv(EnvVars.min_chunk_size, Defaults.min_chunk_size))
+        prechunk_window_chars = int(
+            getenv(EnvVars.prechunk_window_chars, Defaults.prechunk_window_chars)
+        )
+        prechunk_parallelism = int(
+            getenv(EnvVars.prechunk_parallelism, Defaults.prechunk_parallelism)
+        )
+        prechunk_pages_per_range = int(
+            getenv(EnvVars.prechunk_pages_per_range, Defaults.prechunk_pages_per_range)
+        )
+        whole_chunks = (
+            getenv(EnvVars.whole_chunks, Defaults.whole_chunks).lower() == "true"
+        )
+        client_pool_size = int(
+            getenv(EnvVars.vertex_client_pool_size, Defaults.vertex_client_pool_size)
+        )
+        keep_alive = float(getenv(EnvVars.vertex_keep_alive, Defaults.vertex_keep_alive))
+        health_check_interval = float(
+            getenv(
+                EnvVars.vertex_health_check_interval,
+                Defaults.vertex_health_check_interval,
+            )
+        )
+        max_streams = int(getenv(EnvVars.max_streams, Defaults.max_streams))
+        stream_idle_timeout = float(
+            getenv(EnvVars.stream_idle_timeout, Defaults.stream_idle_timeout)
+        )
+        stream_heartbeat_interval = float(
+            getenv(
+                EnvVars.stream_heartbeat_interval, Defaults.stream_heartbeat_interval
+            )
+        )
+        stream_resume_window = float(
+            getenv(EnvVars.stream_resume_window, Defaults.stream_resume_window)
+        )
+        stream_replay_max_bytes = int(
+            getenv(EnvVars.stream_replay_max_bytes, Defaults.stream_replay_max_bytes)
+        )
+        stream_replay_max_stream_bytes = int(
+            getenv(
+                EnvVars.stream_replay_max_stream_bytes,
+                Defaults.stream_replay_max_stream_bytes,
+            )
+        )
+        batch_concurrency = int(
+            getenv(EnvVars.batch_concurrency, Defaults.batch_concurrency)
+        )
+        max_batch_size = int(getenv(EnvVars.max_batch_size, Defaults.max_batch_size))
+        reply_cache_ttl = float(
+            getenv(EnvVars.reply_cache_ttl, Defaults.reply_cache_ttl)
+        )
+        reply_cache_max_bytes = int(
+            getenv(EnvVars.reply_cache_max_bytes, Defaults.reply_cache_max_bytes)
+        )
+        reply_cache_redis_url = getenv(EnvVars.reply_cache_redis_url, "")
+        stream_replay_redis_url = getenv(EnvVars.stream_replay_redis_url, "")
+        coalesce_queries = (
+            getenv(EnvVars.coalesce_queries, Defaults.coalesce_queries).lower()
+            == "true"
+        )
+        coalesce_streams = (
+            getenv(EnvVars.coalesce_streams, Defaults.coalesce_streams).lower()
+            == "true"
+        )
+        chunk_store_dir = getenv(EnvVars.chunk_store_dir, Defaults.chunk_store_dir)
+        chunk_store_max_bytes = int(
+            getenv(EnvVars.chunk_store_max_bytes, Defaults.chunk_store_max_bytes)
+        )
+        chunk_store_max_age = float(
+            getenv(EnvVars.chunk_store_max_age, Defaults.chunk_store_max_age)
+        )
+        download_cache_dir = getenv(
+            EnvVars.download_cache_dir, Defaults.download_cache_dir
+        )
+        download_cache_max_bytes = int(
+            getenv(EnvVars.download_cache_max_bytes, Defaults.download_cache_max_bytes)
+        )
+        download_max_bytes = int(
+            getenv(EnvVars.download_max_bytes, Defaults.download_max_bytes)
+        )
+        download_timeout = float(
+            getenv(EnvVars.download_timeout, Defaults.download_timeout)
+        )
+        gemini_executor_workers = int(
+            getenv(EnvVars.gemini_executor_workers, Defaults.gemini_executor_workers)
+        )
+        gemini_executor_max_queue = int(
+            getenv(
+                EnvVars.gemini_executor_max_queue, Defaults.gemini_executor_max_queue
+            )
+        )
+        gemini_executor_queue_timeout = float(
+            getenv(
+                EnvVars.gemini_executor_queue_timeout,
+                Defaults.gemini_executor_queue_timeout,
+            )
+        )
+        admission_rate = float(getenv(EnvVars.admission_rate, Defaults.admission_rate))
+        admission_burst = int(
+            getenv(EnvVars.admission_burst, Defaults.admission_burst)
+        )
+        admission_max_wait = float(
+            getenv(EnvVars.admission_max_wait, Defaults.admission_max_wait)
+        )
+        admission_initial_concurrency = int(
+            getenv(
+                EnvVars.admission_initial_concurrency,
+                Defaults.admission_initial_concurrency,
+            )
+        )
+        admission_min_concurrency = int(
+            getenv(
+                EnvVars.admission_min_concurrency, Defaults.admission_min_concurrency
+            )
+        )
+        admission_max_concurrency = int(
+            getenv(
+                EnvVars.admission_max_concurrency, Defaults.admission_max_concurrency
+            )
+        )
+        vertex_deadline = float(getenv(EnvVars.vertex_deadline, Defaults.vertex_deadline))
+        vertex_max_attempts = int(
+            getenv(EnvVars.vertex_max_attempts, Defaults.vertex_max_attempts)
+        )
+        vertex_retry_base_delay = float(
+            getenv(EnvVars.vertex_retry_base_delay, Defaults.vertex_retry_base_delay)
+        )
+        vertex_hedging = (
+            getenv(EnvVars.vertex_hedging, Defaults.vertex_hedging).lower() == "true"
+        )
+        vertex_hedge_percentile = float(
+            getenv(EnvVars.vertex_hedge_percentile, Defaults.vertex_hedge_percentile)
+        )
+        prompt_cache_ttl = float(
+            getenv(EnvVars.prompt_cache_ttl, Defaults.prompt_cache_ttl)
+        )
+        prompt_cache_min_chars = int(
+            getenv(EnvVars.prompt_cache_min_chars, Defaults.prompt_cache_min_chars)
+        )
+        claude_context_window = int(
+            getenv(EnvVars.claude_context_window, Defaults.claude_context_window)
+        )
+        gemini_context_window = int(
+            getenv(EnvVars.gemini_context_window, Defaults.gemini_context_window)
+        )
+        min_output_tokens = int(
+            getenv(EnvVars.min_output_tokens, Defaults.min_output_tokens)
+        )
+        token_overflow = getenv(EnvVars.token_overflow, Defaults.token_overflow)
+        exact_token_margin = float(
+            getenv(EnvVars.exact_token_margin, Defaults.exact_token_margin)
+        )
+        router_failure_threshold = int(
+            getenv(EnvVars.router_failure_threshold, Defaults.router_failure_threshold)
+        )
+        router_open_for = float(
+            getenv(EnvVars.router_open_for, Defaults.router_open_for)
+        )
+        router_latency_outlier_factor = float(
+            getenv(
+                EnvVars.router_latency_outlier_factor,
+                Defaults.router_latency_outlier_factor,
+            )
+        )
+
+        chunking_jobs_dir = getenv(
+            EnvVars.chunking_jobs_dir, Defaults.chunking_jobs_dir
+        )
+        chunking_jobs_concurrency = int(
+            getenv(
+                EnvVars.chunking_jobs_concurrency, Defaults.chunking_jobs_concurrency
+            )
+        )
+        chunking_jobs_max_documents = int(
+            getenv(
+                EnvVars.chunking_jobs_max_documents,
+                Defaults.chunking_jobs_max_documents,
+            )
+        )
+        chunking_jobs_max_age = float(
+            getenv(EnvVars.chunking_jobs_max_age, Defaults.chunking_jobs_max_age)
+        )
+        chunking_batch_staging_uri = getenv(
+            EnvVars.chunking_batch_staging_uri, Defaults.chunking_batch_staging_uri
+        )
+        chunking_batch_poll_interval = float(
+            getenv(
+                EnvVars.chunking_batch_poll_interval,
+                Defaults.chunking_batch_poll_interval,
+            )
+        )
+
+        # Store of chunking results, so re-read materials are not sent to the model again
+        chunk_store: ChunkStore | None = None
+        if chunk_store_dir:
+            chunk_store = (
+                ChunkStore()
+                .set_directory(chunk_store_dir)
+                .set_max_bytes(chunk_store_max_bytes)
+                .set_max_age(chunk_store_max_age)
+            )
+            await chunk_store.async_init()
+
+        # Downloader of http(s) materials
+        downloader = (
+            MaterialDownloader()
+            .set_cache_directory(download_cache_dir)
+            .set_max_cache_bytes(download_cache_max_bytes)
+            .set_max_bytes(download_max_bytes)
+            .set_read_timeout(download_timeout)
+        )
+
+        # Latencies and occupancy, recorded by the gateways and the QA server alike
+        metrics = LLMMetrics()
 
-        self.vertex: ILLM | None = None
-
-        # Vertex gateway
-        if "gemini" in model.lower():
-            print("Using Gemini", flush=True)
-            self.vertex = (
-                VertexGemini()
-                .set_region(region)
-                .set_project_id(project_id)
-                .set_model(model)
-                .set_min_chunk_size(min_chunk_size)
-                .set_max_output_tokens(max_output_tokens)
-            )
-            await self.vertex.async_init()
-        elif "claude" in model.lower():
-            print("Using Claude", flush=True)
-            self.vertex = (
-                VertexAI()
-                .set_region(region)
-                .set_project_id(project_id)
-                .set_model(model)
-                .set_max_output_tokens(max_output_tokens)
-            )
-            await self.vertex.async_init()
-
-        if not self.vertex:
+        # Vertex gateways, one per region and model
+        gateways: list[VertexAI | VertexGemini] = []
+        for region in regions:
+            for model in models:
+                # Each gateway learns its own latencies for hedging
+                retries = (
+                    RetryPolicy()
+                    .set_deadline(vertex_deadline)
+                    .set_max_attempts(vertex_max_attempts)
+                    .set_base_delay(vertex_retry_base_delay)
+                    .set_hedging(vertex_hedging)
+                    .set_hedge_percentile(vertex_hedge_percentile)
+                )
+
+                gateway: VertexAI | VertexGemini
+                if "gemini" in model.lower():
+                    print(f"Using Gemini in {region}", flush=True)
+                    gateway = (
+                        VertexGemini()
+                        .set_region(region)
+                        .set_project_id(project_id)
+                        .set_model(model)
+                        .set_min_chunk_size(min_chunk_size)
+                        .set_max_output_tokens(max_output_tokens)
+                        .set_pool_size(client_pool_size)
+                        .set_keep_alive(keep_alive)
+                        .set_health_check_interval(health_check_interval)
+                        .set_max_streams(max_streams)
+                        .set_stream_idle_timeout(stream_idle_timeout)
+                        .set_downloader(downloader)
+                        .set_executor_workers(gemini_executor_workers)
+                        .set_executor_max_queue(gemini_executor_max_queue)
+                        .set_executor_queue_timeout(gemini_executor_queue_timeout)
+                        .set_retry_policy(retries)
+                        .set_prompt_cache_ttl(prompt_cache_ttl)
+                        .set_prompt_cache_min_chars(prompt_cache_min_chars)
+                        .set_range_parallelism(prechunk_parallelism)
+                    )
+                    if prechunk_pages_per_range:
+                        gateway.set_prechunker(
+                            PreChunker().set_pages_per_range(prechunk_pages_per_range)
+                        )
+                elif "claude" in model.lower():
+                    print(f"Using Claude in {region}", flush=True)
+                    gateway = (
+                        VertexAI()
+                        .set_region(region)
+                        .set_project_id(project_id)
+                        .set_model(model)
+                        .set_max_output_tokens(max_output_tokens)
+                        .set_pool_size(client_pool_size)
+                        .set_keep_alive(keep_alive)
+                        .set_health_check_interval(health_check_interval)
+                        .set_max_streams(max_streams)
+                        .set_stream_idle_timeout(stream_idle_timeout)
+                        .set_downloader(downloader)
+                        .set_retry_policy(retries)
+                        .set_prompt_cache_min_chars(prompt_cache_min_chars)
+                        .set_prechunk_parallelism(prechunk_parallelism)
+                        .set_whole_chunks(whole_chunks)
+                    )
+                    if prechunk_window_chars or prechunk_pages_per_range:
+                        gateway.set_prechunker(
+                            PreChunker()
+                            .set_window_chars(prechunk_window_chars)
+                            .set_pages_per_range(prechunk_pages_per_range)
+                        )
+                else:
+                    print(f"Skipping unknown Vertex model {model}", flush=True)
+                    continue
+
+                # Each gateway counts exact tokens with its own model
+                context_window = (
+                    gemini_context_window
+                    if isinstance(gateway, VertexGemini)
+                    else claude_context_window
+                )
+                if context_window:
+                    gateway.set_token_budget(
+                        TokenBudget()
+                        .set_context_window(context_window)
+                        .set_min_output_tokens(min_output_tokens)
+                        .set_overflow(token_overflow)
+                        .set_exact_margin(exact_token_margin)
+                    )
+
+                gateway.set_metrics(metrics)
+                if chunk_store:
+                    gateway.set_chunk_store(chunk_store)
+                gateways.append(gateway)
+
+        if not gateways:
             print("No valid Vertex LLM model configured.")
             return
 
+        # Admission control in front of each gateway, as quota is per region and
+        # model. Each worker process admits calls on its own, so the rate and
+        # burst, meant for the whole service, are split between the workers.
+        workers = max(1, int(getenv(EnvVars.workers, Defaults.workers)))
+        backends: list[VertexAI | VertexGemini | AdmissionControlledLLM] = [
+            *gateways
+        ]
+        if admission_max_concurrency > 0:
+            backends = [
+                AdmissionControlledLLM()
+                .set_llm(gateway)
+                .set_rate(admission_rate / workers)
+                .set_burst(max(1, admission_burst // workers))
+                .set_max_wait(admission_max_wait)
+                .set_initial_concurrency(admission_initial_concurrency)
+                .set_min_concurrency(admission_min_concurrency)
+                .set_max_concurrency(admission_max_concurrency)
+                .set_metrics(metrics)
+                for gateway in gateways
+            ]
+
+        # Router over the gateways when there is more than one
+        if len(backends) == 1:
+            self.vertex = backends[0]
+        else:
+            print(f"Routing over {len(backends)} Vertex backends", flush=True)
+            router = (
+                VertexRouter()
+                .set_failure_threshold(router_failure_threshold)
+                .set_open_for(router_open_for)
+                .set_latency_outlier_factor(router_latency_outlier_factor)
+                .set_metrics(metrics)
+            )
+            for backend in backends:
+                router.add_backend(backend)
+            self.vertex = router
+        await self.vertex.async_init()
+
+        qa_llm: ILLM = self.vertex
+
+        # Reply cache in front of admission control, so cache hits are never queued
+        if reply_cache_ttl > 0:
+            reply_cache_backend: IReplyCacheBackend
+            if reply_cache_redis_url:
+                print("Caching replies in Redis", flush=True)
+                self.redis_cache = RedisReplyCache().set_url(reply_cache_redis_url)
+                await self.redis_cache.async_init()
+                reply_cache_backend = self.redis_cache
+            else:
+                reply_cache_backend = InMemoryReplyCache().set_max_bytes(
+                    reply_cache_max_bytes
+                )
+            cached_llm = (
+                CachedLLM()
+                .set_llm(qa_llm)
+                .set_backend(reply_cache_backend)
+                .set_ttl(reply_cache_ttl)
+            )
+            cached_llm.add_metrics(metrics)
+            qa_llm = cached_llm
+
         # HTTP server
         self.http_server_qa = LLMHttpServer()
-        self.http_server_qa.set_llm(self.vertex).set_http_port(http_port_qa)
+        self.http_server_qa.set_llm(qa_llm).set_http_port(http_port_qa)
+        self.http_server_qa.set_metrics(metrics)
+        self.http_server_qa.set_max_streams(max_streams).set_stream_idle_timeout(
+            stream_idle_timeout
+        )
+        self.http_server_qa.set_coalesce_queries(coalesce_queries).set_coalesce_streams(
+            coalesce_streams
+        )
+        self.http_server_qa.set_heartbeat_interval(stream_heartbeat_interval)
+        self.http_server_qa.set_resume_window(stream_resume_window).set_replay_max_bytes(
+            stream_replay_max_bytes
+        ).set_replay_max_stream_bytes(stream_replay_max_stream_bytes)
+        if stream_replay_redis_url:
+            print("Sharing stream replays between workers in Redis", flush=True)
+            self.replay_share = RedisReplayShare().set_url(stream_replay_redis_url)
+            await self.replay_share.async_init()
+            self.http_server_qa.set_replay_share(self.replay_share)
+        elif workers > 1 and stream_resume_window > 0:
+            print(
+                "Streams resume only on the worker that generated them, set STREAM_REPLAY_REDIS_URL to resume on any",
+                flush=True,
+            )
+        self.http_server_qa.set_batch_concurrency(batch_concurrency).set_max_batch_size(
+            max_batch_size
+        )
         await self.http_server_qa.listen()
 
+        # Every worker serves materials, relaying chunk reads to the worker
+        # holding the material's stream
+        material_reader: BaseMaterialReader = self.vertex
+        if workers > 1:
+            self.worker_reader = WorkerMaterialReader().set_reader(self.vertex)
+            await self.worker_reader.async_init()
+            material_reader = self.worker_reader
         self.http_server_material = MaterialReaderHttpServer()
-        self.http_server_material.set_material_reader(self.vertex).set_http_port(
+        self.http_server_material.set_material_reader(material_reader).set_http_port(
             http_port_material
         )
         await self.http_server_material.listen()
 
-    async def run_forever(self) -> NoReturn:
+        if self.serves_chunking_jobs and chunking_jobs_dir:
+            # Batch prediction needs a Gemini model; otherwise each document is
+            # streamed through admission control. Batch jobs do not count
+            # against the online quota, so they use the gateway directly.
+            chunking_backend: IChunkingBackend = (
+                StreamingChunkingBackend()
+                .set_reader(self.vertex)
+                .set_concurrency(chunking_jobs_concurrency)
+                # Claude streams raw text with delimiters unless asked for whole chunks
+                .set_delimiter("" if whole_chunks else VertexAI.CHUNK_DELIMITER)
+            )
+            gemini = next(
+                (gateway for gateway in gateways if isinstance(gateway, VertexGemini)),
+                None,
+            )
+            if chunking_batch_staging_uri and gemini:
+                print(f"Chunking jobs with batch prediction on {gemini.model}", flush=True)
+                self.batch_chunking = (
+                    VertexBatchChunkingBackend()
+                    .set_gateway(gemini)
+                    .set_staging_uri(chunking_batch_staging_uri)
+                    .set_poll_interval(chunking_batch_poll_interval)
+                )
+                chunking_backend = self.batch_chunking
+            elif chunking_batch_staging_uri:
+                print(
+                    "Batch prediction needs a Gemini model, chunking jobs by streaming instead",
+                    flush=True,
+                )
+
+            self.chunking_jobs = (
+                ChunkingJobs()
+                .set_directory(chunking_jobs_dir)
+                .set_backend(chunking_backend)
+                .set_max_documents(chunking_jobs_max_documents)
+                .set_max_age(chunking_jobs_max_age)
+            )
+            await self.chunking_jobs.async_init()
+
+            self.http_server_chunking_jobs = ChunkingJobsHttpServer()
+            self.http_server_chunking_jobs.set_jobs(self.chunking_jobs).set_http_port(
+                http_port_chunking_jobs
+            )
+            await self.http_server_chunking_jobs.listen()
+
+    async def async_shutdown(self) -> None:
+        print("Shutting down the Vertex LLM microservice", flush=True)
+        if self.http_server_qa:
+            await self.http_server_qa.stop()
+        if self.http_server_material:
+            await self.http_server_material.stop()
+        if self.worker_reader:
+            await self.worker_reader.async_shutdown()
+        if self.http_server_chunking_jobs:
+            await self.http_server_chunking_jobs.stop()
+        if self.chunking_jobs:
+            await self.chunking_jobs.async_shutdown()
+        if self.batch_chunking:
+            await self.batch_chunking.async_shutdown()
+        if self.vertex:
+            await self.vertex.async_shutdown()
+        if self.redis_cache:
+            await self.redis_cache.async_shutdown()
+        if self.replay_share:
+            await self.replay_share.async_shutdown()
+
+    async def run_until_stopped(self) -> None:
+        """Serve until SIGTERM or SIGINT, then shut down gracefully."""
+        stopped = Event()
+        loop = get_running_loop()
+        for stop_signal in (SIGTERM, SIGINT):
+            loop.add_signal_handler(stop_signal, stopped.set)
+
         await self.start()
-        while True:
-            await sleep(3600)
+        self.on_started()
+        await stopped.wait()
+        await self.async_shutdown()
 
 
 if __name__ == "__main__":
     load_dotenv()
-    run(VertexLLMMicroservice().run_forever())
+    workers = int(getenv(EnvVars.workers, Defaults.workers))
+    if workers > 1:
+        VertexLLMSupervisor().set_workers(workers).set_shutdown_timeout(
+            float(
+                getenv(EnvVars.worker_shutdown_timeout, Defaults.worker_shutdown_timeout)
+            )
+        ).run()
+    else:
+        run(VertexLLMMicroservice().run_until_stopped())
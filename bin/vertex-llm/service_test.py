@@ -49,8 +49,8 @@ class Test(IsolatedAsyncioTestCase):
 
     async def asyncTearDown(self) -> None:
         # Shutdown the service(s) here
-        # await self.service.async_shutdown()
-        ...
+        if self.test_type == "unit":
+            await self.service.async_shutdown()
 
     async def test(self) -> None:
         # Arrange
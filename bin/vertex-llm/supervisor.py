@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+from asyncio import SelectorEventLoop
+from multiprocessing import get_context
+from multiprocessing.process import BaseProcess
+from multiprocessing.synchronize import Event as ProcessEvent
+from signal import SIGHUP, SIGINT, SIGTERM, signal
+from time import monotonic, sleep
+from typing import Any
+
+from dotenv import load_dotenv
+
+
+class ReusePortEventLoop(SelectorEventLoop):
+    """Opens every listening socket with SO_REUSEPORT.
+
+    Worker processes running on this loop can all listen on the same ports,
+    and the kernel spreads incoming connections across them.
+    """
+
+    async def create_server(self, *args: Any, **kwargs: Any):  # type: ignore[override]
+        if kwargs.get("sock") is None:
+            kwargs["reuse_port"] = True
+        return await super().create_server(*args, **kwargs)
+
+
+def run_worker(index: int, ready: ProcessEvent) -> None:
+    # Imported here, as the service module imports this one
+    from service import VertexLLMMicroservice
+
+    load_dotenv()
+    print(f"Worker {index} starting", flush=True)
+
+    # Chunking jobs are resumed from their directory, so only the first worker runs them
+    service = (
+        VertexLLMMicroservice()
+        .set_serves_chunking_jobs(index == 0)
+        .set_on_started(ready.set)
+    )
+
+    loop = ReusePortEventLoop()
+    try:
+        loop.run_until_complete(service.run_until_stopped())
+    finally:
+        loop.close()
+    print(f"Worker {index} stopped", flush=True)
+
+
+class _Worker:
+    def __init__(
+        self,
+        index: int,
+        process: BaseProcess,
+        ready: ProcessEvent,
+        crashes: int = 0,
+    ) -> None:
+        self.index = index
+        self.process = process
+        self.ready = ready
+        self.started_at = monotonic()
+        self.crashes = crashes
+        """Exits in a row of this worker and those it replaced, each soon after starting."""
+
+        self.restart_at: float | None = None
+
+
+class VertexLLMSupervisor:
+    """Runs the microservice in several worker processes sharing its ports.
+
+    Workers that die are restarted, after a delay that doubles with each
+    exit in a row that came soon after starting, so a worker that cannot
+    start does not spin. SIGTERM or SIGINT stops every worker gracefully,
+    letting each shut its servers and gateways down, and kills those still
+    running after the shutdown timeout. SIGHUP replaces the workers one at a
+    time, each only after its replacement is serving, so a reload drops no
+    LLM requests. Every worker serves materials, but the materials a worker
+    was reading are gone once it is replaced. The first worker alone runs
+    the chunking jobs, so it is stopped before its replacement starts rather
+    than sharing the chunking jobs port with it; the jobs resume from their
+    directory, and that port is down until the replacement serves.
+    """
+
+    def __init__(self) -> None:
+        self.workers = 2
+        self.shutdown_timeout = 30.0
+        self.startup_timeout = 120.0
+        self.restart_delay = 1.0
+        self.max_restart_delay = 60.0
+        self.stable_after = 60.0
+        self.context = get_context("spawn")
+        self.running: list[_Worker] = []
+        self.is_stopping = False
+        self.is_reload_requested = False
+
+    def set_workers(self, workers: int) -> VertexLLMSupervisor:
+        self.workers = max(1, workers)
+        return self
+
+    def set_shutdown_timeout(self, shutdown_timeout: float) -> VertexLLMSupervisor:
+        self.shutdown_timeout = shutdown_timeout
+        return self
+
+    def set_startup_timeout(self, startup_timeout: float) -> VertexLLMSupervisor:
+        self.startup_timeout = startup_timeout
+        return self
+
+    def set_restart_delay(self, restart_delay: float) -> VertexLLMSupervisor:
+        """Seconds before a worker that exited is restarted, doubled for each exit in a row."""
+        self.restart_delay = restart_delay
+        return self
+
+    def set_max_restart_delay(self, max_restart_delay: float) -> VertexLLMSupervisor:
+        self.max_restart_delay = max_restart_delay
+        return self
+
+    def set_stable_after(self, stable_after: float) -> VertexLLMSupervisor:
+        """Seconds a worker must run before its exit no longer counts as one in a row."""
+        self.stable_after = stable_after
+        return self
+
+    def run(self) -> None:
+        signal(SIGTERM, self._on_stop)
+        signal(SIGINT, self._on_stop)
+        signal(SIGHUP, self._on_reload)
+
+        print(f"Starting {self.workers} workers", flush=True)
+        self.running = [self._spawn(index) for index in range(self.workers)]
+
+        while not self.is_stopping:
+            if self.is_reload_requested:
+                self.is_reload_requested = False
+                self._reload()
+
+            for position, worker in enumerate(self.running):
+                if worker.process.is_alive() or self.is_stopping:
+                    continue
+
+                if worker.restart_at is None:
+                    is_crash_loop = monotonic() - worker.started_at < self.stable_after
+                    worker.crashes = worker.crashes + 1 if is_crash_loop else 1
+                    delay = min(
+                        self.max_restart_delay,
+                        self.restart_delay * 2 ** (worker.crashes - 1),
+                    )
+                    worker.restart_at = monotonic() + delay
+                    print(
+                        f"Worker {worker.index} exited with {worker.process.exitcode}, restarting it in {delay:.0f}s",
+                        flush=True,
+                    )
+                elif monotonic() >= worker.restart_at:
+                    self.running[position] = self._spawn(worker.index, worker.crashes)
+            sleep(1)
+
+        self._stop_all(self.running)
+
+    def _on_stop(self, *_: Any) -> None:
+        self.is_stopping = True
+
+    def _on_reload(self, *_: Any) -> None:
+        self.is_reload_requested = True
+
+    def _spawn(self, index: int, crashes: int = 0) -> _Worker:
+        ready = self.context.Event()
+        process = self.context.Process(
+            target=run_worker, args=(index, ready), name=f"vertex-llm-{index}"
+        )
+        process.start()
+        return _Worker(index, process, ready, crashes)
+
+    def _reload(self) -> None:
+        print("Reloading workers one at a time", flush=True)
+        for position, worker in enumerate(list(self.running)):
+            if self.is_stopping:
+                return
+
+            # Two processes running chunking jobs would both resume the same
+            # jobs, and each get half the calls about them
+            serves_chunking_jobs = worker.index == 0
+            if serves_chunking_jobs:
+                self._stop_all([worker])
+
+            replacement = self._spawn(worker.index)
+            deadline = monotonic() + self.startup_timeout
+            while not replacement.ready.wait(1):
+                if not replacement.process.is_alive() or monotonic() > deadline:
+                    outcome = (
+                        "restarting it"
+                        if serves_chunking_jobs
+                        else "keeping the old one"
+                    )
+                    print(
+                        f"Replacement for worker {worker.index} did not start, {outcome}",
+                        flush=True,
+                    )
+                    self._stop_all([replacement])
+                    return
+
+            self.running[position] = replacement
+            if not serves_chunking_jobs:
+                self._stop_all([worker])
+
+    def _stop_all(self, workers: list[_Worker]) -> None:
+        for worker in workers:
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+        deadline = monotonic() + self.shutdown_timeout
+        for worker in workers:
+            worker.process.join(max(0.0, deadline - monotonic()))
+            if worker.process.is_alive():
+                print(
+                    f"Worker {worker.index} did not stop in {self.shutdown_timeout}s, killing it",
+                    flush=True,
+                )
+                worker.process.kill()
+                worker.process.join()
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+from traceback import format_exc
+from typing import AsyncGenerator
+
+from httpx import AsyncClient, Timeout
+from sbilifeco.boundaries.chunking_jobs import ChunkingJob, IChunkingJobs
+from sbilifeco.cp.common.http.client import HttpClient
+from sbilifeco.cp.llm.paths import ChunkingJobPaths, ChunkingJobRequest, StreamFormats
+from sbilifeco.models.base import Response
+
+
+class ChunkingJobsHttpClient(HttpClient, IChunkingJobs):
+    def __init__(self) -> None:
+        HttpClient.__init__(self)
+        self.connect_timeout = 10.0
+        self.read_timeout = 60.0
+        self.transport: AsyncClient | None = None
+
+    def set_connect_timeout(self, connect_timeout: float) -> ChunkingJobsHttpClient:
+        self.connect_timeout = connect_timeout
+        return self
+
+    def set_read_timeout(self, read_timeout: float) -> ChunkingJobsHttpClient:
+        """Also the longest a watched job may go without progress."""
+        self.read_timeout = read_timeout
+        return self
+
+    async def async_shutdown(self) -> None:
+        if self.transport:
+            await self.transport.aclose()
+            self.transport = None
+
+    def _get_transport(self) -> AsyncClient:
+        if self.transport is None:
+            self.transport = AsyncClient(
+                timeout=Timeout(self.read_timeout, connect=self.connect_timeout)
+            )
+        return self.transport
+
+    async def submit_job(self, sources: list[str]) -> Response[ChunkingJob]:
+        try:
+            http_response = await self._get_transport().post(
+                f"{self.url_base}{ChunkingJobPaths.BASE}",
+                json=ChunkingJobRequest(sources=sources).model_dump(),
+            )
+            return Response[ChunkingJob].model_validate(http_response.json())
+        except Exception as e:
+            return Response.error(e)
+
+    async def get_job(self, job_id: str) -> Response[ChunkingJob]:
+        try:
+            http_response = await self._get_transport().get(
+                f"{self.url_base}{ChunkingJobPaths.JOB.format(job_id=job_id)}"
+            )
+            return Response[ChunkingJob].model_validate(http_response.json())
+        except Exception as e:
+            return Response.error(e)
+
+    async def watch_job(
+        self, job_id: str
+    ) -> Response[AsyncGenerator[ChunkingJob, None]]:
+        try:
+            transport = self._get_transport()
+            http_request = transport.build_request(
+                "GET",
+                f"{self.url_base}{ChunkingJobPaths.JOB_EVENTS.format(job_id=job_id)}",
+                headers={"Accept": StreamFormats.NDJSON},
+            )
+            http_response = await transport.send(http_request, stream=True)
+
+            if http_response.is_error:
+                await http_response.aread()
+                await http_response.aclose()
+                return Response.fail(http_response.text, http_response.status_code)
+
+            async def updates():
+                try:
+                    async for line in http_response.aiter_lines():
+                        if line.strip():
+                            yield ChunkingJob.model_validate_json(line)
+                finally:
+                    await http_response.aclose()
+
+            return Response.ok(updates())
+        except Exception as e:
+            print(f"Error in watch_job: {e}")
+            print(format_exc())
+            return Response.error(e)
+
+    async def read_job_chunks(self, job_id: str, index: int) -> Response[list[str]]:
+        try:
+            http_response = await self._get_transport().get(
+                f"{self.url_base}{ChunkingJobPaths.JOB_CHUNKS.format(job_id=job_id, index=index)}"
+            )
+            return Response[list[str]].model_validate(http_response.json())
+        except Exception as e:
+            return Response.error(e)
+
+    async def cancel_job(self, job_id: str) -> Response[ChunkingJob]:
+        try:
+            http_response = await self._get_transport().post(
+                f"{self.url_base}{ChunkingJobPaths.JOB_CANCELLATION.format(job_id=job_id)}"
+            )
+            return Response[ChunkingJob].model_validate(http_response.json())
+        except Exception as e:
+            return Response.error(e)
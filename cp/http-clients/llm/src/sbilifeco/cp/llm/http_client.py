@@ -1,53 +1,348 @@
+from __future__ import annotations
 from typing import AsyncGenerator
 from traceback import format_exc
 
-from asyncio import get_running_loop
-from functools import partial
+from httpx import AsyncClient, Limits, Response as HttpResponse, Timeout, TransportError
 from sbilifeco.cp.common.http.client import HttpClient
 from sbilifeco.boundaries.llm import ILLM, ChatMessage, LLMRequest
 from sbilifeco.models.base import Response
-from sbilifeco.cp.llm.paths import Paths, LLMQuery
-from requests import Request, Session
+from sbilifeco.cp.llm.paths import (
+    LLMBatchQuery,
+    LLMBatchResult,
+    LLMQuery,
+    LLMStreamEvent,
+    Paths,
+    StreamFormats,
+)
 
 
 class LLMHttpClient(HttpClient, ILLM):
+    def __init__(self) -> None:
+        HttpClient.__init__(self)
+        self.connect_timeout = 10.0
+        self.read_timeout = 300.0
+        self.max_connections = 512
+        self.max_keepalive_connections = 64
+        self.keep_alive = 60.0
+        self.chunk_size = 4096
+        self.stream_format = StreamFormats.RAW
+        self.max_resumes = 3
+        self.batch_size = 1000
+        self.transport: AsyncClient | None = None
+
+    def set_connect_timeout(self, connect_timeout: float) -> LLMHttpClient:
+        self.connect_timeout = connect_timeout
+        return self
+
+    def set_read_timeout(self, read_timeout: float) -> LLMHttpClient:
+        self.read_timeout = read_timeout
+        return self
+
+    def set_max_connections(self, max_connections: int) -> LLMHttpClient:
+        self.max_connections = max_connections
+        return self
+
+    def set_max_keepalive_connections(
+        self, max_keepalive_connections: int
+    ) -> LLMHttpClient:
+        self.max_keepalive_connections = max_keepalive_connections
+        return self
+
+    def set_keep_alive(self, keep_alive: float) -> LLMHttpClient:
+        self.keep_alive = keep_alive
+        return self
+
+    def set_chunk_size(self, chunk_size: int) -> LLMHttpClient:
+        self.chunk_size = chunk_size
+        return self
+
+    def set_stream_format(self, stream_format: str) -> LLMHttpClient:
+        """One of `StreamFormats`. SSE and NDJSON carry usage, finish and timing events besides the text."""
+        self.stream_format = stream_format
+        return self
+
+    def set_max_resumes(self, max_resumes: int) -> LLMHttpClient:
+        """Times a framed stream reconnects after its connection drops. Needs a server with a resume window."""
+        self.max_resumes = max_resumes
+        return self
+
+    def set_batch_size(self, batch_size: int) -> LLMHttpClient:
+        """Most contexts sent in one batch call; longer lists are sent in several."""
+        self.batch_size = max(1, batch_size)
+        return self
+
+    async def async_shutdown(self) -> None:
+        if self.transport:
+            await self.transport.aclose()
+            self.transport = None
+
+    def _get_transport(self) -> AsyncClient:
+        # One pooled transport per client, so every call reuses kept-alive connections
+        if self.transport is None:
+            self.transport = AsyncClient(
+                timeout=Timeout(
+                    self.read_timeout,
+                    connect=self.connect_timeout,
+                    pool=self.connect_timeout,
+                ),
+                limits=Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                    keepalive_expiry=self.keep_alive,
+                ),
+            )
+        return self.transport
+
     async def generate_reply(self, context: str) -> Response[str]:
         try:
-            return await self.request_as_model(
-                Request(
-                    method="POST",
-                    url=f"{self.url_base}{Paths.QUERIES}",
-                    json=LLMQuery(context=context).model_dump(),
+            http_response = await self._get_transport().post(
+                f"{self.url_base}{Paths.QUERIES}",
+                json=LLMQuery(context=context).model_dump(),
+            )
+            return Response[str].model_validate(http_response.json())
+        except Exception as e:
+            return Response.error(e)
+
+    async def generate_replies_as_completed(
+        self, contexts: list[str]
+    ) -> Response[AsyncGenerator[LLMBatchResult, None]]:
+        """Replies to many contexts, each as soon as it is ready.
+
+        Every result carries the index of its context and its own success or
+        error, so one failed context does not fail the others.
+        """
+        try:
+
+            async def result_generator():
+                transport = self._get_transport()
+                for start in range(0, len(contexts), self.batch_size):
+                    batch = LLMBatchQuery(
+                        queries=[
+                            LLMQuery(context=context)
+                            for context in contexts[start : start + self.batch_size]
+                        ]
+                    )
+                    async with transport.stream(
+                        "POST",
+                        f"{self.url_base}{Paths.BATCHES}",
+                        json=batch.model_dump(),
+                        headers={"Accept": StreamFormats.NDJSON},
+                    ) as http_response:
+                        if http_response.is_error:
+                            await http_response.aread()
+                            raise RuntimeError(
+                                f"Batch call failed with {http_response.status_code}: {http_response.text}"
+                            )
+
+                        async for line in http_response.aiter_lines():
+                            if not line.strip():
+                                continue
+                            result = LLMBatchResult.model_validate_json(line)
+                            result.index += start
+                            yield result
+
+            return Response.ok(result_generator())
+        except Exception as e:
+            return Response.error(e)
+
+    async def generate_replies(
+        self, contexts: list[str]
+    ) -> Response[list[Response[str]]]:
+        """Replies to many contexts, in the order of the contexts."""
+        try:
+            response_with_results = await self.generate_replies_as_completed(contexts)
+            if (
+                not response_with_results.is_success
+                or not response_with_results.payload
+            ):
+                return Response.fail(
+                    response_with_results.message, response_with_results.code
                 )
+
+            replies: list[Response[str]] = [
+                Response.fail("No reply was received", 500) for _ in contexts
+            ]
+            async for result in response_with_results.payload:
+                replies[result.index] = Response[str].model_validate(
+                    result.model_dump(exclude={"index"})
+                )
+            return Response.ok(replies)
+        except Exception as e:
+            return Response.error(e)
+
+    async def _open_stream(
+        self, request: LLMRequest, stream_format: str
+    ) -> HttpResponse:
+        transport = self._get_transport()
+        http_request = transport.build_request(
+            "POST",
+            f"{self.url_base}{Paths.STREAMS}",
+            json=request.model_dump(),
+            headers={"Accept": stream_format} if stream_format else None,
+        )
+        return await transport.send(http_request, stream=True)
+
+    async def _parse_events(
+        self, http_response: HttpResponse
+    ) -> AsyncGenerator[LLMStreamEvent, None]:
+        # SSE frames end with a blank line and may span several data lines;
+        # NDJSON has one event per line. Comments and heartbeats are skipped.
+        is_sse = StreamFormats.SSE in http_response.headers.get("content-type", "")
+        data: list[str] = []
+        async for line in http_response.aiter_lines():
+            if not is_sse:
+                if line.strip():
+                    event = LLMStreamEvent.model_validate_json(line)
+                    if event.type != "heartbeat":
+                        yield event
+                continue
+
+            if line.startswith("data:"):
+                data.append(line[5:].removeprefix(" "))
+            elif not line and data:
+                yield LLMStreamEvent.model_validate_json("\n".join(data))
+                data = []
+
+    async def _reopen_stream(
+        self, request_id: str, offset: int, stream_format: str
+    ) -> HttpResponse:
+        transport = self._get_transport()
+        http_request = transport.build_request(
+            "GET",
+            f"{self.url_base}{Paths.STREAM.format(request_id=request_id)}",
+            params={"offset": offset},
+            headers={"Accept": stream_format},
+        )
+        return await transport.send(http_request, stream=True)
+
+    async def _events_from(
+        self,
+        request_id: str,
+        http_response: HttpResponse,
+        stream_format: str,
+        offset: int = 0,
+    ) -> AsyncGenerator[LLMStreamEvent, None]:
+        # A dropped connection is resumed from the last character received,
+        # so the consumer sees one uninterrupted reply
+        resumes = 0
+        try:
+            while True:
+                try:
+                    async for event in self._parse_events(http_response):
+                        if event.type == "delta" and event.offset is not None:
+                            offset = event.offset + len(event.text or "")
+                        yield event
+                    return
+                except TransportError as e:
+                    if resumes >= self.max_resumes:
+                        raise
+                    resumes += 1
+                    print(
+                        f"Stream {request_id} dropped at {offset}: {e!r}, resuming",
+                        flush=True,
+                    )
+
+                await http_response.aclose()
+                http_response = await self._reopen_stream(
+                    request_id, offset, stream_format
+                )
+                if http_response.is_error:
+                    await http_response.aread()
+                    raise RuntimeError(
+                        f"Unable to resume stream {request_id}: {http_response.text}"
+                    )
+        finally:
+            await http_response.aclose()
+
+    async def generate_stream_events(
+        self, request: LLMRequest
+    ) -> Response[AsyncGenerator[LLMStreamEvent, None]]:
+        """The reply as framed events: deltas, then usage, finish and timing."""
+        try:
+            stream_format = self.stream_format or StreamFormats.SSE
+            http_response = await self._open_stream(request, stream_format)
+
+            if http_response.is_error:
+                await http_response.aread()
+                await http_response.aclose()
+                return Response.fail(http_response.text, http_response.status_code)
+
+            return Response.ok(
+                self._events_from(request.request_id, http_response, stream_format)
             )
         except Exception as e:
+            print(f"Error in generate_stream_events: {e}")
+            print(format_exc())
+            return Response.error(e)
+
+    async def resume_stream_events(
+        self, request_id: str, offset: int = 0
+    ) -> Response[AsyncGenerator[LLMStreamEvent, None]]:
+        """The rest of a reply the server still buffers, from the character at `offset` on."""
+        try:
+            stream_format = self.stream_format or StreamFormats.SSE
+            http_response = await self._reopen_stream(request_id, offset, stream_format)
+
+            if http_response.is_error:
+                await http_response.aread()
+                await http_response.aclose()
+                return Response.fail(http_response.text, http_response.status_code)
+
+            return Response.ok(
+                self._events_from(request_id, http_response, stream_format, offset)
+            )
+        except Exception as e:
+            print(f"Error in resume_stream_events: {e}")
+            print(format_exc())
             return Response.error(e)
 
     async def generate_streamed_reply(
         self, request: LLMRequest
     ) -> Response[AsyncGenerator[str, None]]:
-        try:
-            req = Request(
-                method="POST",
-                url=f"{self.url_base}{Paths.STREAMS}",
-                json=request.model_dump(),
-            )
-            with Session() as session:
-                prepped = session.prepare_request(req)
-                http_response = await get_running_loop().run_in_executor(
-                    None, partial(session.send, prepped, stream=True)
+        if self.stream_format:
+            response_with_events = await self.generate_stream_events(request)
+            if not response_with_events.is_success or not response_with_events.payload:
+                return Response.fail(
+                    response_with_events.message, response_with_events.code
                 )
+            events = response_with_events.payload
+
+            async def text_generator():
+                # An error event means the reply broke off, which the consumer must not mistake for its end
+                try:
+                    async for event in events:
+                        if event.type == "delta" and event.text:
+                            yield event.text
+                        elif event.type == "error":
+                            raise RuntimeError(
+                                f"LLM stream failed midway: {event.message}"
+                            )
+                finally:
+                    await events.aclose()
+
+            return Response.ok(text_generator())
+
+        try:
+            http_response = await self._open_stream(request, self.stream_format)
+
+            if http_response.is_error:
+                await http_response.aread()
+                await http_response.aclose()
+                return Response.fail(http_response.text, http_response.status_code)
 
-                async def stream_generator():
-                    try:
-                        for content in http_response.iter_content(
-                            4096, decode_unicode=True
-                        ):
-                            yield content
-                    except Exception as e:
-                        print(f"Error in stream_generator: {e}")
-                        print(format_exc())
-                        return
+            async def stream_generator():
+                # Chunks are only read off the socket when the consumer asks for
+                # the next one, so a slow consumer slows the server down instead
+                # of buffering the whole reply here.
+                try:
+                    async for content in http_response.aiter_text(self.chunk_size):
+                        yield content
+                except Exception as e:
+                    print(f"Error in stream_generator: {e}")
+                    print(format_exc())
+                    return
+                finally:
+                    await http_response.aclose()
 
             return Response.ok(stream_generator())
         except Exception as e:
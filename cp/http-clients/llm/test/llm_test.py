@@ -8,10 +8,18 @@ from unittest import IsolatedAsyncioTestCase
 from unittest.mock import AsyncMock, patch
 from faker import Faker
 from sbilifeco.models.base import Response
-from sbilifeco.boundaries.llm import ILLM, LLMRequest
+from sbilifeco.boundaries.chunking_jobs import ChunkingJob, IChunkingJobs
+from sbilifeco.boundaries.llm import ILLM, LLMRequest, ReplyStats, ReplyStream
 from sbilifeco.cp.llm.http_server import LLMHttpServer
 from sbilifeco.cp.llm.http_client import LLMHttpClient
+from sbilifeco.cp.llm.chunking_jobs_http_server import ChunkingJobsHttpServer
+from sbilifeco.cp.llm.chunking_jobs_http_client import ChunkingJobsHttpClient
+from sbilifeco.cp.llm.paths import Paths, StreamFormats
+from sbilifeco.cp.llm.replay import RedisReplayShare
+from sbilifeco.cp.llm.single_flight import StreamBroadcast
 from random import randint
+from asyncio import gather, sleep
+from httpx import AsyncClient
 
 
 class LLMTest(IsolatedAsyncioTestCase):
@@ -30,6 +38,7 @@ class LLMTest(IsolatedAsyncioTestCase):
         self.faker = Faker()
 
     async def asyncTearDown(self) -> None:
+        await self.client.async_shutdown()
         await self.http_server.stop()
         patch.stopall()
         return await super().asyncTearDown()
@@ -83,3 +92,422 @@ class LLMTest(IsolatedAsyncioTestCase):
     async def __generate_stream(self) -> AsyncGenerator[str, None]:
         for _ in range(randint(1, 5)):
             yield self.faker.paragraph()
+
+    async def test_concurrent_series(self) -> None:
+        # Arrange
+        concurrent_streams = 100
+        patch.object(
+            self.llm,
+            "generate_streamed_reply",
+            side_effect=lambda _: Response.ok(self.__generate_stream()),
+        ).start()
+
+        async def consume() -> int:
+            response = await self.client.generate_streamed_reply(
+                LLMRequest(request_id=uuid4().hex, context=self.faker.sentence())
+            )
+            self.assertTrue(response.is_success, response.message)
+            assert response.payload is not None
+
+            return len([chunk async for chunk in response.payload])
+
+        # Act
+        chunk_counts = await gather(*[consume() for _ in range(concurrent_streams)])
+
+        # Assert
+        self.assertEqual(len(chunk_counts), concurrent_streams)
+        for chunk_count in chunk_counts:
+            self.assertGreater(chunk_count, 0)
+
+    async def test_series_leaves_no_stream_behind(self) -> None:
+        # Arrange
+        requests = [LLMRequest(context=self.faker.sentence()) for _ in range(3)]
+        patch.object(
+            self.llm,
+            "generate_streamed_reply",
+            side_effect=lambda _: Response.ok(self.__generate_stream()),
+        ).start()
+
+        # Act
+        for request in requests:
+            response = await self.client.generate_streamed_reply(request)
+            assert response.payload is not None
+            async for _ in response.payload:
+                ...
+
+        # Assert
+        self.assertEqual(len({request.request_id for request in requests}), 3)
+
+        metrics = self.http_server.streams.metrics()
+        self.assertEqual(metrics.live, 0)
+        self.assertEqual(metrics.completed, 3)
+
+    async def test_coalesced_sequence(self) -> None:
+        # Arrange
+        self.http_server.set_coalesce_queries(True)
+        question = self.faker.sentence()
+        reply = self.faker.paragraph()
+
+        async def slow_reply(_: str) -> Response[str]:
+            await sleep(0.5)
+            return Response.ok(reply)
+
+        patched_generate_reply = patch.object(
+            self.llm, "generate_reply", side_effect=slow_reply
+        ).start()
+
+        # Act
+        responses = await gather(
+            *[self.client.generate_reply(question) for _ in range(10)]
+        )
+
+        # Assert
+        for response in responses:
+            self.assertTrue(response.is_success, response.message)
+            self.assertEqual(response.payload, reply)
+        patched_generate_reply.assert_called_once_with(question)
+        self.assertEqual(self.http_server.coalescing_metrics().queries_coalesced, 9)
+
+    async def test_stream_broadcast_subscribers(self) -> None:
+        # Arrange
+        chunks = [self.faker.paragraph() for _ in range(3)]
+
+        async def slow_stream() -> AsyncGenerator[str, None]:
+            for chunk in chunks:
+                await sleep(0.1)
+                yield chunk
+
+        broadcast = StreamBroadcast(slow_stream()).start()
+        first = broadcast.subscribe()
+        second = broadcast.subscribe()
+
+        # Act
+        await anext(first)
+        await first.aclose()
+        received = [chunk async for chunk in second]
+
+        lone_broadcast = StreamBroadcast(slow_stream()).start()
+        leaving = lone_broadcast.subscribe()
+        await anext(leaving)
+        await leaving.aclose()
+        late = lone_broadcast.subscribe()
+
+        # Assert
+        self.assertEqual(received, chunks)
+        with self.assertRaises(RuntimeError):
+            [chunk async for chunk in late]
+
+    async def test_framed_series(self) -> None:
+        # Arrange
+        self.http_server.set_heartbeat_interval(0.1)
+        # Streams go through a broadcast, which is to pass their stats on
+        self.http_server.set_coalesce_streams(True)
+        chunks = [self.faker.paragraph() for _ in range(3)]
+
+        async def slow_stream() -> AsyncGenerator[str, None]:
+            for chunk in chunks:
+                await sleep(0.25)
+                yield chunk
+
+        patch.object(
+            self.llm,
+            "generate_streamed_reply",
+            side_effect=lambda _: Response.ok(
+                ReplyStream(
+                    slow_stream(),
+                    ReplyStats(
+                        input_tokens=12, output_tokens=34, finish_reason="end_turn"
+                    ),
+                )
+            ),
+        ).start()
+
+        for stream_format in [StreamFormats.SSE, StreamFormats.NDJSON]:
+            self.client.set_stream_format(stream_format)
+
+            # Act
+            response = await self.client.generate_stream_events(
+                LLMRequest(context=self.faker.sentence())
+            )
+
+            # Assert
+            self.assertTrue(response.is_success, response.message)
+            assert response.payload is not None
+            events = [event async for event in response.payload]
+
+            deltas = [event for event in events if event.type == "delta"]
+            self.assertEqual([event.text for event in deltas], chunks)
+            self.assertEqual(deltas[-1].offset, len(chunks[0]) + len(chunks[1]))
+            self.assertEqual(
+                [event.type for event in events[3:]], ["usage", "finish", "timing"]
+            )
+            self.assertEqual(events[3].output_tokens, 34)
+            self.assertEqual(events[4].finish_reason, "end_turn")
+
+            response_with_text = await self.client.generate_streamed_reply(
+                LLMRequest(context=self.faker.sentence())
+            )
+            assert response_with_text.payload is not None
+            self.assertEqual(
+                [text async for text in response_with_text.payload], chunks
+            )
+
+    async def test_resumed_series(self) -> None:
+        # Arrange
+        self.http_server.set_resume_window(5)
+        self.client.set_stream_format(StreamFormats.SSE)
+        chunks = [self.faker.paragraph() for _ in range(4)]
+
+        async def slow_stream() -> AsyncGenerator[str, None]:
+            for chunk in chunks:
+                await sleep(0.1)
+                yield chunk
+
+        fn_stream = patch.object(
+            self.llm,
+            "generate_streamed_reply",
+            side_effect=lambda _: Response.ok(slow_stream()),
+        ).start()
+        request = LLMRequest(context=self.faker.sentence())
+
+        # Act
+        response = await self.client.generate_stream_events(request)
+        assert response.payload is not None
+        first = await anext(response.payload)
+        await response.payload.aclose()
+
+        await sleep(0.6)
+        resumed = await self.client.resume_stream_events(
+            request.request_id, len(chunks[0])
+        )
+
+        # Assert
+        fn_stream.assert_called_once()
+        self.assertEqual(first.text, chunks[0])
+        self.assertTrue(resumed.is_success, resumed.message)
+        assert resumed.payload is not None
+        events = [event async for event in resumed.payload]
+        self.assertEqual(
+            "".join(event.text or "" for event in events if event.type == "delta"),
+            "".join(chunks[1:]),
+        )
+        self.assertEqual(self.http_server.replays.metrics().resumed, 1)
+        self.assertEqual(self.http_server.streams.metrics().completed, 1)
+
+    async def test_resumed_series_on_another_worker(self) -> None:
+        # Arrange
+        class Redis:
+            """The Redis stream commands the replay share uses, in memory."""
+
+            def __init__(self) -> None:
+                self.streams: dict[str, list[tuple[str, dict]]] = {}
+                self.next_id = 0
+
+            async def xadd(self, name: str, fields: dict) -> str:
+                self.next_id += 1
+                entry_id = f"{self.next_id}-0"
+                fields = {field: str(value) for field, value in fields.items()}
+                self.streams.setdefault(name, []).append((entry_id, fields))
+                return entry_id
+
+            async def pexpire(self, name: str, ttl: int) -> None: ...
+
+            async def xtrim(self, name: str, minid: str) -> None:
+                self.streams[name] = [
+                    entry for entry in self.streams[name] if entry[0] >= minid
+                ]
+
+            async def xrange(self, name: str, count: int) -> list:
+                return self.streams.get(name, [])[:count]
+
+            async def xread(self, streams: dict[str, str], block: int) -> list:
+                [(name, last_id)] = streams.items()
+                entries = [
+                    entry
+                    for entry in self.streams.get(name, [])
+                    if int(entry[0].split("-")[0]) > int(last_id.split("-")[0])
+                ]
+                if not entries:
+                    await sleep(block / 1000)
+                    return []
+                return [[name, entries]]
+
+            async def exists(self, name: str) -> bool:
+                return name in self.streams
+
+        share = RedisReplayShare().set_poll_interval(0.05)
+        share.redis = Redis()
+        self.http_server.set_resume_window(5).set_replay_share(share)
+        other_worker = LLMHttpServer()
+        other_worker.set_llm(self.llm).set_http_port(self.HTTP_PORT + 1)
+        other_worker.set_resume_window(5).set_replay_share(share)
+        await other_worker.listen()
+        other_client = LLMHttpClient()
+        other_client.set_proto("http").set_host("localhost").set_port(
+            self.HTTP_PORT + 1
+        )
+        self.client.set_stream_format(StreamFormats.SSE)
+        other_client.set_stream_format(StreamFormats.SSE)
+        chunks = [self.faker.paragraph() for _ in range(4)]
+
+        async def slow_stream() -> AsyncGenerator[str, None]:
+            for chunk in chunks:
+                await sleep(0.1)
+                yield chunk
+
+        patch.object(
+            self.llm,
+            "generate_streamed_reply",
+            side_effect=lambda _: Response.ok(
+                ReplyStream(slow_stream(), ReplyStats(finish_reason="end_turn"))
+            ),
+        ).start()
+        request = LLMRequest(context=self.faker.sentence())
+
+        try:
+            # Act
+            response = await self.client.generate_stream_events(request)
+            assert response.payload is not None
+            first = await anext(response.payload)
+            await response.payload.aclose()
+
+            resumed = await other_client.resume_stream_events(
+                request.request_id, len(first.text or "")
+            )
+            assert resumed.payload is not None
+            events = [event async for event in resumed.payload]
+
+            # Assert
+            self.assertEqual(
+                "".join(event.text or "" for event in events if event.type == "delta"),
+                "".join(chunks[1:]),
+            )
+            self.assertIn(
+                "end_turn",
+                [event.finish_reason for event in events if event.type == "finish"],
+            )
+            self.assertEqual(other_worker.replays.metrics().shared_resumed, 1)
+        finally:
+            await other_client.async_shutdown()
+            await other_worker.stop()
+
+    async def test_batch(self) -> None:
+        # Arrange
+        self.http_server.set_batch_concurrency(4)
+        self.client.set_batch_size(7)
+        contexts = [self.faker.sentence() for _ in range(20)]
+        failing_context = contexts[5]
+
+        async def reply(context: str) -> Response[str]:
+            await sleep(randint(0, 10) / 100)
+            if context == failing_context:
+                return Response.fail("Unable to reply", 429)
+            return Response.ok(context.upper())
+
+        patched_generate_reply = patch.object(
+            self.llm, "generate_reply", side_effect=reply
+        ).start()
+
+        # Act
+        response = await self.client.generate_replies(contexts)
+
+        # Assert
+        self.assertTrue(response.is_success, response.message)
+        assert response.payload is not None
+        self.assertEqual(patched_generate_reply.call_count, len(contexts))
+        for context, reply_response in zip(contexts, response.payload):
+            if context == failing_context:
+                self.assertFalse(reply_response.is_success)
+                self.assertEqual(reply_response.code, 429)
+            else:
+                self.assertEqual(reply_response.payload, context.upper())
+
+    async def test_chunking_jobs(self) -> None:
+        # Arrange
+        jobs: IChunkingJobs = AsyncMock(spec=IChunkingJobs)
+        jobs_server = ChunkingJobsHttpServer()
+        jobs_server.set_jobs(jobs).set_http_port(self.HTTP_PORT + 1)
+        await jobs_server.listen()
+
+        jobs_client = ChunkingJobsHttpClient()
+        jobs_client.set_proto("http").set_host("localhost").set_port(self.HTTP_PORT + 1)
+
+        job = ChunkingJob(job_id=uuid4().hex, created_at=0, updated_at=0, documents=[])
+
+        async def updates():
+            for status in ["running", "succeeded"]:
+                yield job.model_copy(update={"status": status})
+
+        patch.object(jobs, "submit_job", return_value=Response.ok(job)).start()
+        patch.object(jobs, "watch_job", return_value=Response.ok(updates())).start()
+        patched_read_job_chunks = patch.object(
+            jobs, "read_job_chunks", return_value=Response.ok(["a", "b"])
+        ).start()
+
+        try:
+            # Act
+            submitted = await jobs_client.submit_job(["https://example.com/a.pdf"])
+            watched = await jobs_client.watch_job(job.job_id)
+            assert watched.payload is not None
+            statuses = [update.status async for update in watched.payload]
+            chunks = await jobs_client.read_job_chunks(job.job_id, 0)
+
+            # Assert
+            self.assertTrue(submitted.is_success, submitted.message)
+            self.assertEqual(statuses, ["running", "succeeded"])
+            self.assertEqual(chunks.payload, ["a", "b"])
+            patched_read_job_chunks.assert_called_once_with(job.job_id, 0)
+        finally:
+            await jobs_client.async_shutdown()
+            await jobs_server.stop()
+
+    async def test_metrics(self) -> None:
+        # Arrange
+        chunks = [self.faker.paragraph() for _ in range(3)]
+
+        async def slow_stream() -> AsyncGenerator[str, None]:
+            for chunk in chunks:
+                await sleep(0.1)
+                yield chunk
+
+        patch.object(
+            self.llm, "generate_reply", return_value=Response.ok(self.faker.sentence())
+        ).start()
+        patch.object(
+            self.llm,
+            "generate_streamed_reply",
+            side_effect=lambda _: Response.ok(
+                ReplyStream(
+                    slow_stream(),
+                    ReplyStats(model="claude-sonnet-4", output_tokens=30),
+                )
+            ),
+        ).start()
+
+        # Act
+        await self.client.generate_reply(self.faker.sentence())
+        response = await self.client.generate_streamed_reply(
+            LLMRequest(context=self.faker.sentence())
+        )
+        assert response.payload is not None
+        [text async for text in response.payload]
+        async with AsyncClient() as http:
+            scraped = await http.get(
+                f"http://localhost:{self.HTTP_PORT}{Paths.METRICS}"
+            )
+
+        # Assert
+        metrics = self.http_server.metrics
+        self.assertEqual(metrics.latency.count(Paths.QUERIES, ""), 1)
+        self.assertEqual(
+            metrics.time_to_first_token.count(Paths.STREAMS, "claude-sonnet-4"), 1
+        )
+        self.assertEqual(
+            metrics.tokens_per_second.count(Paths.STREAMS, "claude-sonnet-4"), 1
+        )
+        self.assertEqual(scraped.status_code, 200)
+        self.assertIn(
+            f'llm_latency_seconds_count{{route="{Paths.STREAMS}",model="claude-sonnet-4"}} 1',
+            scraped.text,
+        )
+        self.assertIn("llm_live_streams 0.0", scraped.text)
@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+from traceback import format_exc
+from typing import Annotated, AsyncGenerator
+
+from fastapi import Header, Path
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sbilifeco.boundaries.chunking_jobs import ChunkingJob, IChunkingJobs
+from sbilifeco.cp.common.http.server import HttpServer
+from sbilifeco.cp.llm.paths import ChunkingJobPaths, ChunkingJobRequest, StreamFormats
+from sbilifeco.models.base import Response
+
+
+class ChunkingJobsHttpServer(HttpServer):
+    def __init__(self):
+        HttpServer.__init__(self)
+        self.jobs: IChunkingJobs
+
+    def set_jobs(self, jobs: IChunkingJobs) -> ChunkingJobsHttpServer:
+        self.jobs = jobs
+        return self
+
+    def build_routes(self) -> None:
+        @self.post(ChunkingJobPaths.BASE)
+        async def submit_job(request: ChunkingJobRequest) -> Response[ChunkingJob]:
+            try:
+                return await self.jobs.submit_job(request.sources)
+            except Exception as e:
+                return Response.error(e)
+
+        @self.get(ChunkingJobPaths.JOB)
+        async def get_job(job_id: Annotated[str, Path()]) -> Response[ChunkingJob]:
+            try:
+                return await self.jobs.get_job(job_id)
+            except Exception as e:
+                return Response.error(e)
+
+        @self.get(ChunkingJobPaths.JOB_EVENTS)
+        async def watch_job(
+            job_id: Annotated[str, Path()],
+            accept: Annotated[str | None, Header()] = None,
+        ):
+            try:
+                response_with_updates = await self.jobs.watch_job(job_id)
+                if not response_with_updates.is_success:
+                    return PlainTextResponse(
+                        response_with_updates.message,
+                        status_code=response_with_updates.code,
+                    )
+                elif response_with_updates.payload is None:
+                    return PlainTextResponse(
+                        "Job updates are inexplicably empty", status_code=500
+                    )
+
+                is_sse = bool(accept and StreamFormats.SSE in accept)
+                updates = response_with_updates.payload
+
+                async def stream_updates() -> AsyncGenerator[str, None]:
+                    try:
+                        async for job in updates:
+                            data = job.model_dump_json()
+                            yield (
+                                f"event: job\ndata: {data}\n\n"
+                                if is_sse
+                                else data + "\n"
+                            )
+                    finally:
+                        await updates.aclose()
+
+                return StreamingResponse(
+                    stream_updates(),
+                    media_type=StreamFormats.SSE if is_sse else StreamFormats.NDJSON,
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                )
+            except Exception as e:
+                message = f"Error while watching chunking job {job_id}: {e}"
+                print(message)
+                print(format_exc())
+                return PlainTextResponse(message, status_code=500)
+
+        @self.post(ChunkingJobPaths.JOB_CANCELLATION)
+        async def cancel_job(job_id: Annotated[str, Path()]) -> Response[ChunkingJob]:
+            try:
+                return await self.jobs.cancel_job(job_id)
+            except Exception as e:
+                return Response.error(e)
+
+        @self.get(ChunkingJobPaths.JOB_CHUNKS)
+        async def read_job_chunks(
+            job_id: Annotated[str, Path()], index: Annotated[int, Path()]
+        ) -> Response[list[str]]:
+            try:
+                return await self.jobs.read_job_chunks(job_id, index)
+            except Exception as e:
+                return Response.error(e)
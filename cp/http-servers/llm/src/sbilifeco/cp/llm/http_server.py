@@ -1,12 +1,40 @@
 from __future__ import annotations
+from asyncio import Semaphore, Task, as_completed, create_task, wait
+from hashlib import sha256
+from time import monotonic
 from typing import Annotated, AsyncGenerator
 from traceback import format_exc
-from sbilifeco.boundaries.llm import ILLM, ChatMessage
+from sbilifeco.boundaries.llm import ILLM, ChatMessage, ReplyStats, ReplyStream
+from sbilifeco.boundaries.llm_streams import (
+    StreamAlreadyExists,
+    StreamLimitExceeded,
+    StreamMetrics,
+    StreamRegistry,
+)
+from sbilifeco.boundaries.llm_metrics import LLMMetrics
 from sbilifeco.models.base import Response
 from sbilifeco.cp.common.http.server import HttpServer
-from sbilifeco.cp.llm.paths import Paths, LLMQuery
+from sbilifeco.cp.llm.paths import (
+    LLMBatchQuery,
+    LLMBatchResult,
+    LLMQuery,
+    LLMStreamEvent,
+    Paths,
+    StreamFormats,
+)
+from sbilifeco.cp.llm.single_flight import (
+    CoalescingMetrics,
+    SingleFlight,
+    StreamBroadcast,
+)
 from sbilifeco.boundaries.llm import ChatMessage, LLMRequest
-from fastapi import Path, Body
+from sbilifeco.cp.llm.replay import (
+    OffsetUnavailable,
+    RedisReplayShare,
+    ReplayMetrics,
+    ReplayStore,
+)
+from fastapi import Path, Body, Header, Query
 from fastapi.responses import StreamingResponse, PlainTextResponse
 
 
@@ -14,30 +42,449 @@ class LLMHttpServer(HttpServer):
     def __init__(self):
         HttpServer.__init__(self)
         self.llm: ILLM
-        self.streams: dict[str, AsyncGenerator[str, None]] = {}
+        self.streams: StreamRegistry[AsyncGenerator[str, None]] = StreamRegistry(
+            closer=lambda stream: stream.aclose()
+        )
+        self.coalesce_queries = False
+        self.coalesce_streams = False
+        self.query_flights: SingleFlight[Response[str]] = SingleFlight()
+        self.broadcasts: dict[str, StreamBroadcast] = {}
+        self.streams_coalesced = 0
+        self.heartbeat_interval = 15.0
+        self.replays = ReplayStore()
+        self.batch_concurrency = 16
+        self.max_batch_size = 1000
+        self.metrics = LLMMetrics()
 
     def set_llm(self, llm: ILLM) -> LLMHttpServer:
         self.llm = llm
         return self
 
+    def set_max_streams(self, max_streams: int) -> LLMHttpServer:
+        self.streams.set_max_streams(max_streams)
+        return self
+
+    def set_stream_idle_timeout(self, idle_timeout: float) -> LLMHttpServer:
+        self.streams.set_idle_timeout(idle_timeout)
+        return self
+
+    def set_coalesce_queries(self, coalesce_queries: bool) -> LLMHttpServer:
+        """Let concurrent identical queries share one upstream call."""
+        self.coalesce_queries = coalesce_queries
+        return self
+
+    def set_coalesce_streams(self, coalesce_streams: bool) -> LLMHttpServer:
+        """Let concurrent identical streams with randomness 0 share one upstream stream."""
+        self.coalesce_streams = coalesce_streams
+        return self
+
+    def set_heartbeat_interval(self, heartbeat_interval: float) -> LLMHttpServer:
+        """Seconds of silence after which a framed stream sends a heartbeat. 0 sends none."""
+        self.heartbeat_interval = heartbeat_interval
+        return self
+
+    def set_batch_concurrency(self, batch_concurrency: int) -> LLMHttpServer:
+        """Queries of one batch run at the same time."""
+        self.batch_concurrency = max(1, batch_concurrency)
+        return self
+
+    def set_max_batch_size(self, max_batch_size: int) -> LLMHttpServer:
+        self.max_batch_size = max_batch_size
+        return self
+
+    def set_resume_window(self, resume_window: float) -> LLMHttpServer:
+        """Seconds a dropped stream stays resumable. 0 closes streams as soon as their client goes away.
+
+        A stream resumes only on the worker process that generated it, unless
+        a replay share is set.
+        """
+        self.replays.set_resume_window(resume_window)
+        return self
+
+    def set_replay_share(self, share: RedisReplayShare) -> LLMHttpServer:
+        """Lets a stream resume on any worker process, not only the one that generated it."""
+        self.replays.set_share(share)
+        return self
+
+    def set_replay_max_bytes(self, max_bytes: int) -> LLMHttpServer:
+        self.replays.set_max_bytes(max_bytes)
+        return self
+
+    def set_replay_max_stream_bytes(self, max_stream_bytes: int) -> LLMHttpServer:
+        self.replays.set_max_stream_bytes(max_stream_bytes)
+        return self
+
+    def set_metrics(self, metrics: LLMMetrics) -> LLMHttpServer:
+        """Where latencies and sizes are recorded, shared with the gateways behind the server."""
+        self.metrics = metrics
+        return self
+
+    def coalescing_metrics(self) -> CoalescingMetrics:
+        return CoalescingMetrics(
+            queries_coalesced=self.query_flights.coalesced,
+            streams_coalesced=self.streams_coalesced,
+            queries_in_flight=len(self.query_flights.in_flight),
+            streams_in_flight=len(self.broadcasts),
+        )
+
+    async def _generate_reply(self, context: str) -> Response[str]:
+        if self.coalesce_queries:
+            return await self.query_flights.do(
+                sha256(context.encode("utf-8")).hexdigest(),
+                lambda: self.llm.generate_reply(context),
+            )
+        return await self.llm.generate_reply(context)
+
+    async def _timed_reply(self, route: str, context: str) -> Response[str]:
+        model = getattr(self.llm, "model", "")
+        started_at = monotonic()
+        response = await self._generate_reply(context)
+
+        self.metrics.request_size.observe(route, model, len(context.encode("utf-8")))
+        if response.is_success:
+            self.metrics.latency.observe(route, model, monotonic() - started_at)
+            if response.payload is not None:
+                self.metrics.response_size.observe(
+                    route, model, len(response.payload.encode("utf-8"))
+                )
+        return response
+
+    async def _timed_stream(
+        self,
+        route: str,
+        chunks: AsyncGenerator[str, None],
+        stats: ReplyStats | None,
+        started_at: float,
+    ) -> AsyncGenerator[str, None]:
+        """Passes a reply through, recording its time to first token, and more once it has ended."""
+        model = (stats.model if stats else None) or getattr(self.llm, "model", "")
+        first_token_at: float | None = None
+        size = 0
+
+        try:
+            async for chunk in chunks:
+                if first_token_at is None:
+                    first_token_at = monotonic()
+                    self.metrics.time_to_first_token.observe(
+                        route, model, first_token_at - started_at
+                    )
+                size += len(chunk.encode("utf-8"))
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+        ended_at = monotonic()
+        self.metrics.latency.observe(route, model, ended_at - started_at)
+        self.metrics.response_size.observe(route, model, size)
+        if (
+            stats is not None
+            and stats.output_tokens
+            and first_token_at is not None
+            and ended_at > first_token_at
+        ):
+            self.metrics.tokens_per_second.observe(
+                route, model, stats.output_tokens / (ended_at - first_token_at)
+            )
+
+    async def _run_batch(
+        self, queries: list[LLMQuery]
+    ) -> AsyncGenerator[LLMBatchResult, None]:
+        """Results of a batch in the order they complete."""
+        slots = Semaphore(self.batch_concurrency)
+
+        async def run(index: int, query: LLMQuery) -> LLMBatchResult:
+            async with slots:
+                try:
+                    response = await self._timed_reply(Paths.BATCHES, query.context)
+                except Exception as e:
+                    response = Response.error(e)
+            return LLMBatchResult(
+                index=index,
+                is_success=response.is_success,
+                code=response.code,
+                message=response.message,
+                payload=response.payload,
+            )
+
+        tasks = [create_task(run(index, query)) for index, query in enumerate(queries)]
+        try:
+            for next_result in as_completed(tasks):
+                yield await next_result
+        finally:
+            # The client went away, so the rest of the batch is not wanted
+            for task in tasks:
+                task.cancel()
+
+    async def _generate_streamed_reply(
+        self, request: LLMRequest
+    ) -> Response[AsyncGenerator[str, None]]:
+        if not self.coalesce_streams or request.randomness != 0:
+            return await self.llm.generate_streamed_reply(request)
+
+        key = sha256(
+            f"{request.cacheable_prefix}\0{request.context}".encode("utf-8")
+        ).hexdigest()
+        broadcast = self.broadcasts.get(key)
+        if broadcast is not None:
+            self.streams_coalesced += 1
+            return Response.ok(self._subscribe(broadcast))
+
+        response_with_stream = await self.llm.generate_streamed_reply(request)
+        if not response_with_stream.is_success or response_with_stream.payload is None:
+            return response_with_stream
+
+        # Another identical request may have started a broadcast while we waited
+        broadcast = self.broadcasts.get(key)
+        if broadcast is not None:
+            await response_with_stream.payload.aclose()
+            self.streams_coalesced += 1
+            return Response.ok(self._subscribe(broadcast))
+
+        broadcast = StreamBroadcast(
+            response_with_stream.payload,
+            getattr(response_with_stream.payload, "stats", None),
+        )
+        self.broadcasts[key] = broadcast
+        broadcast.start(on_done=lambda: self.broadcasts.pop(key, None))
+        return Response.ok(self._subscribe(broadcast))
+
+    def _subscribe(self, broadcast: StreamBroadcast) -> AsyncGenerator[str, None]:
+        if broadcast.stats is None:
+            return broadcast.subscribe()
+        return ReplyStream(broadcast.subscribe(), broadcast.stats)
+
+    def _stream_format(self, accept: str | None) -> str:
+        if accept and StreamFormats.SSE in accept:
+            return StreamFormats.SSE
+        if accept and StreamFormats.NDJSON in accept:
+            return StreamFormats.NDJSON
+        return StreamFormats.RAW
+
+    def _frame(self, event: LLMStreamEvent, stream_format: str) -> str:
+        data = event.model_dump_json(exclude_none=True)
+        if stream_format == StreamFormats.NDJSON:
+            return data + "\n"
+
+        if event.type == "heartbeat":
+            return ": heartbeat\n\n"
+        frame = f"event: {event.type}\n"
+        if event.offset is not None and event.text is not None:
+            # The characters received so far, which is where a reconnecting
+            # client sending this back as Last-Event-ID resumes from
+            frame += f"id: {event.offset + len(event.text)}\n"
+        return frame + f"data: {data}\n\n"
+
+    def _stream_response(
+        self,
+        chunks: AsyncGenerator[str, None],
+        stats: ReplyStats | None,
+        stream_format: str,
+        offset: int = 0,
+    ) -> StreamingResponse:
+        if stream_format == StreamFormats.RAW:
+            return StreamingResponse(chunks, media_type="text/markdown")
+
+        return StreamingResponse(
+            self._framed(chunks, stats, stream_format, offset),
+            media_type=stream_format,
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    async def _resume(
+        self,
+        request_id: str,
+        offset: str | int | None,
+        stream_format: str,
+    ) -> StreamingResponse | PlainTextResponse | None:
+        """The rest of a buffered reply, or None if `request_id` has no buffer.
+
+        Without a replay share, only the worker process that generated the
+        reply has its buffer, and the others return None.
+        """
+        if self.replays.get(request_id) is None and not self.replays.is_shared:
+            return None
+
+        try:
+            start = int(offset or 0)
+        except ValueError:
+            return PlainTextResponse(
+                f"Offset {offset} is not a number", status_code=400
+            )
+
+        try:
+            chunks = await self.replays.resume(request_id, start)
+        except OffsetUnavailable as e:
+            return PlainTextResponse(str(e), status_code=416)
+        if chunks is None:
+            return None
+
+        print(f"Resuming stream {request_id} from {start}", flush=True)
+        return self._stream_response(
+            chunks, getattr(chunks, "stats", None), stream_format, start
+        )
+
+    async def _framed(
+        self,
+        chunks: AsyncGenerator[str, None],
+        stats: ReplyStats | None,
+        stream_format: str,
+        offset: int = 0,
+    ) -> AsyncGenerator[str, None]:
+        """Frames a reply as delta events, followed by usage, finish and timing events.
+
+        A heartbeat is sent whenever the LLM stays silent for the heartbeat
+        interval, so proxies do not time a long generation out. An error in
+        the middle of the reply becomes an error event. Offsets count from
+        `offset`, where a resumed reply starts.
+        """
+        started_at = monotonic()
+        time_to_first_token: float | None = None
+        next_chunk: Task[str] | None = None
+
+        try:
+            while True:
+                next_chunk = create_task(anext(chunks))  # type: ignore[arg-type]
+                while not next_chunk.done():
+                    await wait(
+                        {next_chunk},
+                        timeout=(
+                            self.heartbeat_interval
+                            if self.heartbeat_interval > 0
+                            else None
+                        ),
+                    )
+                    if not next_chunk.done():
+                        yield self._frame(
+                            LLMStreamEvent(type="heartbeat"), stream_format
+                        )
+
+                try:
+                    text = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    next_chunk = None
+
+                if time_to_first_token is None:
+                    time_to_first_token = monotonic() - started_at
+                yield self._frame(
+                    LLMStreamEvent(type="delta", text=text, offset=offset),
+                    stream_format,
+                )
+                offset += len(text)
+        except Exception as e:
+            print(f"Error in the middle of a stream: {e}", flush=True)
+            print(format_exc(), flush=True)
+            yield self._frame(
+                LLMStreamEvent(type="error", message=str(e)), stream_format
+            )
+            return
+        finally:
+            if next_chunk is not None:
+                next_chunk.cancel()
+                await wait({next_chunk})
+            await chunks.aclose()
+
+        if stats is not None:
+            yield self._frame(
+                LLMStreamEvent(
+                    type="usage",
+                    input_tokens=stats.input_tokens,
+                    output_tokens=stats.output_tokens,
+                    cached_input_tokens=stats.cached_input_tokens,
+                ),
+                stream_format,
+            )
+        yield self._frame(
+            LLMStreamEvent(
+                type="finish", finish_reason=stats.finish_reason if stats else None
+            ),
+            stream_format,
+        )
+        yield self._frame(
+            LLMStreamEvent(
+                type="timing",
+                time_to_first_token=time_to_first_token,
+                elapsed=monotonic() - started_at,
+            ),
+            stream_format,
+        )
+
     async def listen(self) -> None:
+        self.metrics.add_gauge(
+            "llm_live_streams",
+            "Streams open through the server.",
+            lambda: len(self.streams),
+        )
+        await self.streams.start()
+        await self.replays.start()
         await HttpServer.listen(self)
 
     async def stop(self) -> None:
         await HttpServer.stop(self)
+        await self.replays.stop()
+        await self.streams.stop()
 
     def build_routes(self) -> None:
         @self.post(Paths.QUERIES)
         async def generate_query(query: LLMQuery) -> Response[str]:
             try:
-                return await self.llm.generate_reply(query.context)
+                return await self._timed_reply(Paths.QUERIES, query.context)
+            except Exception as e:
+                return Response.error(e)
+
+        @self.post(Paths.BATCHES)
+        async def generate_batch(
+            batch: LLMBatchQuery,
+            accept: Annotated[str | None, Header()] = None,
+        ):
+            try:
+                if self.max_batch_size and len(batch.queries) > self.max_batch_size:
+                    return Response.fail(
+                        f"Batch of {len(batch.queries)} queries is over the limit of {self.max_batch_size}",
+                        413,
+                    )
+
+                if self._stream_format(accept) == StreamFormats.NDJSON:
+
+                    async def stream_results() -> AsyncGenerator[str, None]:
+                        async for result in self._run_batch(batch.queries):
+                            yield result.model_dump_json() + "\n"
+
+                    return StreamingResponse(
+                        stream_results(), media_type=StreamFormats.NDJSON
+                    )
+
+                results = [result async for result in self._run_batch(batch.queries)]
+                return Response.ok(sorted(results, key=lambda result: result.index))
             except Exception as e:
                 return Response.error(e)
 
         @self.post(Paths.STREAMS)
-        async def generate_stream(request: Annotated[LLMRequest, Body()]):
+        async def generate_stream(
+            request: Annotated[LLMRequest, Body()],
+            accept: Annotated[str | None, Header()] = None,
+            last_event_id: Annotated[str | None, Header()] = None,
+        ):
             try:
-                response_with_stream = await self.llm.generate_streamed_reply(request)
+                started_at = monotonic()
+                stream_format = self._stream_format(accept)
+
+                # A client reconnecting with the same request ID picks up where it dropped
+                resumed = await self._resume(
+                    request.request_id, last_event_id, stream_format
+                )
+                if resumed is not None:
+                    return resumed
+
+                try:
+                    self.streams.ensure_capacity(request.request_id)
+                except StreamLimitExceeded as e:
+                    return PlainTextResponse(str(e), status_code=429)
+                except StreamAlreadyExists as e:
+                    return PlainTextResponse(str(e), status_code=409)
+
+                response_with_stream = await self._generate_streamed_reply(request)
                 if not response_with_stream.is_success:
                     return PlainTextResponse(
                         response_with_stream.message,
@@ -48,23 +495,139 @@ class LLMHttpServer(HttpServer):
                         "LLM response is inexplicably empty",
                         status_code=500,
                     )
-                self.streams[request.request_id] = response_with_stream.payload
+
+                buffer = (
+                    self.replays.create(response_with_stream.payload)
+                    if self.replays.is_enabled
+                    else None
+                )
+
+                try:
+                    self.streams.register(
+                        request.request_id,
+                        response_with_stream.payload,
+                        on_close=buffer.close if buffer else None,
+                    )
+                except (StreamLimitExceeded, StreamAlreadyExists) as e:
+                    await response_with_stream.payload.aclose()
+                    return PlainTextResponse(
+                        str(e),
+                        status_code=429 if isinstance(e, StreamLimitExceeded) else 409,
+                    )
 
                 async def stream_llm_reply(
                     request_id: str,
                 ) -> AsyncGenerator[str, None]:
-                    async for chunk in self.streams[request_id]:
-                        yield chunk
+                    # Runs to the finally block also when the client disconnects,
+                    # so the upstream stream is closed either way
+                    is_complete = False
+                    try:
+                        stream = self.streams.get(request_id)
+                        if stream is None:
+                            return
 
-                    await self.streams[request_id].aclose()
-                    del self.streams[request_id]
+                        async for chunk in stream:
+                            self.streams.touch(request_id)
+                            yield chunk
+                        is_complete = True
+                    finally:
+                        await self.streams.unregister(request_id, completed=is_complete)
 
-                return StreamingResponse(
-                    stream_llm_reply(request.request_id),
-                    media_type="text/markdown",
+                stats = getattr(response_with_stream.payload, "stats", None)
+                self.metrics.request_size.observe(
+                    Paths.STREAMS,
+                    (stats.model if stats else None) or getattr(self.llm, "model", ""),
+                    len(f"{request.cacheable_prefix}{request.context}".encode("utf-8")),
+                )
+                if buffer is None:
+                    return self._stream_response(
+                        self._timed_stream(
+                            Paths.STREAMS,
+                            stream_llm_reply(request.request_id),
+                            stats,
+                            started_at,
+                        ),
+                        stats,
+                        stream_format,
+                    )
+
+                # The buffer reads the upstream stream to its end even if this
+                # client goes away, so it can resume instead of starting over
+                request_id = request.request_id
+                self.replays.add(
+                    request_id,
+                    buffer,
+                    on_chunk=lambda: self.streams.touch(request_id),
+                    on_done=lambda is_complete: self.streams.unregister(
+                        request_id, completed=is_complete
+                    ),
+                )
+                return self._stream_response(
+                    self._timed_stream(
+                        Paths.STREAMS, buffer.subscribe(), stats, started_at
+                    ),
+                    stats,
+                    stream_format,
                 )
             except Exception as e:
                 message = f"Error while generating stream out of LLM response: {e}"
                 print(message)
                 print(format_exc())
                 return PlainTextResponse(message, status_code=500)
+
+        @self.get(Paths.STREAM)
+        async def resume_stream(
+            request_id: Annotated[str, Path()],
+            offset: Annotated[int | None, Query()] = None,
+            accept: Annotated[str | None, Header()] = None,
+            last_event_id: Annotated[str | None, Header()] = None,
+        ):
+            try:
+                resumed = await self._resume(
+                    request_id,
+                    offset if offset is not None else last_event_id,
+                    self._stream_format(accept),
+                )
+                if resumed is None:
+                    return PlainTextResponse(
+                        f"No resumable stream for {request_id}", status_code=404
+                    )
+                return resumed
+            except Exception as e:
+                message = f"Error while resuming stream {request_id}: {e}"
+                print(message)
+                print(format_exc())
+                return PlainTextResponse(message, status_code=500)
+
+        @self.get(Paths.REPLAY_METRICS)
+        async def get_replay_metrics() -> Response[ReplayMetrics]:
+            try:
+                return Response.ok(self.replays.metrics())
+            except Exception as e:
+                return Response.error(e)
+
+        @self.get(Paths.STREAM_METRICS)
+        async def get_stream_metrics() -> Response[StreamMetrics]:
+            try:
+                return Response.ok(self.streams.metrics())
+            except Exception as e:
+                return Response.error(e)
+
+        @self.get(Paths.METRICS)
+        async def get_metrics():
+            try:
+                return PlainTextResponse(
+                    self.metrics.render(), media_type=LLMMetrics.CONTENT_TYPE
+                )
+            except Exception as e:
+                message = f"Error while rendering metrics: {e}"
+                print(message)
+                print(format_exc())
+                return PlainTextResponse(message, status_code=500)
+
+        @self.get(Paths.COALESCING_METRICS)
+        async def get_coalescing_metrics() -> Response[CoalescingMetrics]:
+            try:
+                return Response.ok(self.coalescing_metrics())
+            except Exception as e:
+                return Response.error(e)
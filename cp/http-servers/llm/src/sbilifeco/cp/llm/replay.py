@@ -0,0 +1,517 @@
+from __future__ import annotations
+
+from asyncio import (
+    CancelledError,
+    Condition,
+    Queue,
+    Task,
+    create_task,
+    current_task,
+    sleep,
+    wait,
+)
+from collections import deque
+from time import monotonic
+from typing import AsyncGenerator, Awaitable, Callable
+
+from pydantic import BaseModel
+from sbilifeco.boundaries.llm import ReplyStats, ReplyStream
+
+
+class ReplayMetrics(BaseModel):
+    buffers: int = 0
+    """Replay buffers held, for streams still generating or recently finished."""
+
+    bytes: int = 0
+    resumed: int = 0
+    """Reconnections served from a replay buffer."""
+
+    shared_resumed: int = 0
+    """Part of `resumed` served through Redis from a buffer another worker holds."""
+
+    expired: int = 0
+    """Buffers dropped after nobody resumed them within the resume window."""
+
+    evicted: int = 0
+    """Buffers dropped to stay under the memory cap."""
+
+
+class OffsetUnavailable(Exception):
+    """Raised when a resume offset is past the reply or no longer buffered."""
+
+
+class ReplayBuffer:
+    """The text of one upstream stream, kept for clients that reconnect.
+
+    A pump reads the upstream stream to its end whether or not a client is
+    listening, so a client that drops can resume from any character offset
+    still buffered instead of having the reply generated again. Past
+    `max_bytes`, the oldest text is dropped.
+    """
+
+    def __init__(self, source: AsyncGenerator[str, None], max_bytes: int) -> None:
+        self.source = source
+        self.stats: ReplyStats | None = getattr(source, "stats", None)
+        self.max_bytes = max_bytes
+        self.chunks: list[tuple[int, str, int]] = []
+        """Offset, text and size in bytes of every chunk still buffered."""
+
+        self.bytes = 0
+        self.end_offset = 0
+        self.is_done = False
+        self.error: Exception | None = None
+        self.subscribers = 0
+        self.detached_at: float | None = monotonic()
+        self.changed = Condition()
+        self.pump: Task | None = None
+        self.mirror: Queue[str | None] | None = None
+
+    @property
+    def start_offset(self) -> int:
+        return self.chunks[0][0] if self.chunks else self.end_offset
+
+    def start(
+        self,
+        on_chunk: Callable[[], None],
+        on_done: Callable[[bool], Awaitable[None]],
+    ) -> ReplayBuffer:
+        self.pump = create_task(self._pump(on_chunk, on_done))
+        return self
+
+    def start_mirror(self) -> Queue[str | None]:
+        """A queue receiving the text as it is buffered, then None once the stream is done."""
+        self.mirror = Queue()
+        return self.mirror
+
+    def ensure_offset(self, offset: int) -> None:
+        if offset > self.end_offset:
+            raise OffsetUnavailable(
+                f"Offset {offset} is past the {self.end_offset} characters produced so far"
+            )
+        if offset < self.start_offset:
+            raise OffsetUnavailable(
+                f"Offset {offset} is no longer buffered, the buffer starts at {self.start_offset}"
+            )
+
+    async def subscribe(self, offset: int = 0) -> AsyncGenerator[str, None]:
+        self.subscribers += 1
+        self.detached_at = None
+        position = offset
+
+        try:
+            while True:
+                async with self.changed:
+                    await self.changed.wait_for(
+                        lambda: position < self.end_offset or self.is_done
+                    )
+
+                if position < self.end_offset:
+                    text = self._text_from(position)
+                    position += len(text)
+                    yield text
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0:
+                self.detached_at = monotonic()
+
+    def cancel(self) -> None:
+        if self.pump and not self.pump.done() and self.pump is not current_task():
+            self.pump.cancel()
+
+    async def close(self) -> None:
+        self.cancel()
+        if self.pump and self.pump is not current_task():
+            await wait({self.pump})
+
+    def _text_from(self, position: int) -> str:
+        self.ensure_offset(position)
+        return "".join(
+            text[max(0, position - offset) :]
+            for offset, text, _ in self.chunks
+            if offset + len(text) > position
+        )
+
+    def _append(self, text: str) -> None:
+        size = len(text.encode("utf-8"))
+        self.chunks.append((self.end_offset, text, size))
+        self.end_offset += len(text)
+        self.bytes += size
+        if self.mirror is not None:
+            self.mirror.put_nowait(text)
+
+        while self.bytes > self.max_bytes and len(self.chunks) > 1:
+            self.bytes -= self.chunks.pop(0)[2]
+
+    async def _pump(
+        self,
+        on_chunk: Callable[[], None],
+        on_done: Callable[[bool], Awaitable[None]],
+    ) -> None:
+        is_complete = False
+        try:
+            async for text in self.source:
+                self._append(text)
+                on_chunk()
+                async with self.changed:
+                    self.changed.notify_all()
+            is_complete = True
+        except CancelledError:
+            self.error = RuntimeError("The stream was stopped before it ended")
+        except Exception as e:
+            self.error = e
+        finally:
+            self.is_done = True
+            if self.mirror is not None:
+                self.mirror.put_nowait(None)
+            try:
+                await self.source.aclose()
+                await on_done(is_complete)
+            finally:
+                async with self.changed:
+                    self.changed.notify_all()
+
+
+class RedisReplayShare:
+    """Replay buffers shared through Redis, so a client can resume on any worker.
+
+    The worker generating a reply appends its text to a Redis stream named
+    after the request ID, then an end entry carrying the reply's stats or
+    error. Another worker resumes a reply from there, following the Redis
+    stream until its end entry. Each Redis stream expires the resume window
+    after its last entry, and past the per-stream cap its oldest text is
+    trimmed, as in the worker's own buffer.
+
+    Needs the optional `redis` dependency (`sbilifeco-http-server-llm[redis]`).
+    """
+
+    def __init__(self) -> None:
+        self.url = "redis://localhost:6379/0"
+        self.key_prefix = "llm-replay:"
+        self.poll_interval = 1.0
+        self.redis = None
+
+    def set_url(self, url: str) -> RedisReplayShare:
+        self.url = url
+        return self
+
+    def set_key_prefix(self, key_prefix: str) -> RedisReplayShare:
+        self.key_prefix = key_prefix
+        return self
+
+    def set_poll_interval(self, poll_interval: float) -> RedisReplayShare:
+        """Seconds a resumed reply waits for new text before checking that its Redis stream still exists."""
+        self.poll_interval = poll_interval
+        return self
+
+    async def async_init(self) -> None:
+        from redis.asyncio import Redis
+
+        self.redis = Redis.from_url(self.url, decode_responses=True)
+
+    async def async_shutdown(self) -> None:
+        if self.redis is not None:
+            await self.redis.aclose()
+            self.redis = None
+
+    async def publish(
+        self,
+        key: str,
+        buffer: ReplayBuffer,
+        texts: Queue[str | None],
+        ttl: float,
+        max_bytes: int,
+    ) -> None:
+        """Appends the text of `buffer`, as `texts` receives it, to the Redis stream of `key`."""
+        if self.redis is None:
+            return
+
+        name = self.key_prefix + key
+        ttl_ms = max(1, int(ttl * 1000))
+        offset = 0
+        sizes: deque[tuple[str, int]] = deque()
+        """ID and size in bytes of every entry still in the Redis stream."""
+
+        total = 0
+        try:
+            while (text := await texts.get()) is not None:
+                entry_id = await self.redis.xadd(name, {"offset": offset, "text": text})
+                await self.redis.pexpire(name, ttl_ms)
+                offset += len(text)
+                sizes.append((entry_id, len(text.encode("utf-8"))))
+                total += sizes[-1][1]
+
+                if total > max_bytes and len(sizes) > 1:
+                    while total > max_bytes and len(sizes) > 1:
+                        total -= sizes.popleft()[1]
+                    await self.redis.xtrim(name, minid=sizes[0][0])
+
+            end: dict[str, str | int] = {"end": offset}
+            if buffer.error is not None:
+                end["error"] = str(buffer.error)
+            if buffer.stats is not None:
+                end["stats"] = buffer.stats.model_dump_json()
+            await self.redis.xadd(name, end)
+            await self.redis.pexpire(name, ttl_ms)
+        except Exception as e:
+            print(f"Unable to share the replay of stream {key}: {e}", flush=True)
+
+    async def resume(self, key: str, offset: int) -> ReplyStream | None:
+        """The reply from `offset` on, or None if Redis has no stream for `key`.
+
+        Raises `OffsetUnavailable` if the offset was trimmed. An offset past
+        the text shared so far is waited for, as the worker generating the
+        reply may not have shared all it sent yet.
+        """
+        if self.redis is None:
+            return None
+
+        name = self.key_prefix + key
+        entries = await self.redis.xrange(name, count=1)
+        if not entries:
+            return None
+
+        _, first = entries[0]
+        start_offset = int(first.get("offset", first.get("end", 0)))
+        if offset < start_offset:
+            raise OffsetUnavailable(
+                f"Offset {offset} is no longer buffered, the buffer starts at {start_offset}"
+            )
+
+        stats = ReplyStats()
+        return ReplyStream(self._follow(name, offset, stats), stats)
+
+    async def _follow(
+        self, name: str, offset: int, stats: ReplyStats
+    ) -> AsyncGenerator[str, None]:
+        if self.redis is None:
+            return
+
+        position = offset
+        last_id = "0-0"
+        while True:
+            response = await self.redis.xread(
+                {name: last_id}, block=max(1, int(self.poll_interval * 1000))
+            )
+            if not response:
+                if not await self.redis.exists(name):
+                    raise RuntimeError("The stream expired before it ended")
+                continue
+
+            for entry_id, fields in response[0][1]:
+                last_id = entry_id
+                if "end" in fields:
+                    if "stats" in fields:
+                        for field, value in ReplyStats.model_validate_json(
+                            fields["stats"]
+                        ):
+                            setattr(stats, field, value)
+                    if position > int(fields["end"]):
+                        raise OffsetUnavailable(
+                            f"Offset {position} is past the {fields['end']} characters of the reply"
+                        )
+                    if "error" in fields:
+                        raise RuntimeError(fields["error"])
+                    return
+
+                start, text = int(fields["offset"]), fields["text"]
+                if start > position:
+                    raise OffsetUnavailable(
+                        f"Offset {position} is no longer buffered, the buffer starts at {start}"
+                    )
+                if start + len(text) > position:
+                    yield text[position - start :]
+                    position = start + len(text)
+
+
+class ReplayStore:
+    """Replay buffers by request ID, bounded in time and memory.
+
+    A buffer is kept while a client is reading it, and for the resume window
+    after the last client went away. When the buffers together outgrow
+    `max_bytes`, finished ones are dropped first, oldest first, then ones
+    nobody is reading. Buffers being read are never dropped; the per-stream
+    cap bounds them.
+
+    Buffers live in the memory of the process that generated the reply, so
+    with several worker processes a client can only resume on the worker it
+    was streaming from, and another worker answers as if there were no
+    buffer. With a `RedisReplayShare`, buffers are shared and a client can
+    resume on any worker.
+    """
+
+    PUBLISH_TIMEOUT = 5.0
+
+    def __init__(self) -> None:
+        self.resume_window = 0.0
+        self.max_bytes = 64 * 1024 * 1024
+        self.max_stream_bytes = 1024 * 1024
+        self.sweep_interval = 10.0
+        self.buffers: dict[str, ReplayBuffer] = {}
+        self.counters = ReplayMetrics()
+        self.sweeper: Task | None = None
+        self.share: RedisReplayShare | None = None
+        self.publishers: set[Task] = set()
+
+    def set_resume_window(self, resume_window: float) -> ReplayStore:
+        """Seconds a buffer is kept after its last client went away. 0 disables replay."""
+        self.resume_window = resume_window
+        return self
+
+    def set_max_bytes(self, max_bytes: int) -> ReplayStore:
+        self.max_bytes = max_bytes
+        return self
+
+    def set_max_stream_bytes(self, max_stream_bytes: int) -> ReplayStore:
+        self.max_stream_bytes = max_stream_bytes
+        return self
+
+    def set_share(self, share: RedisReplayShare) -> ReplayStore:
+        """Shares buffers with other workers. The share is started and stopped by its owner."""
+        self.share = share
+        return self
+
+    @property
+    def is_enabled(self) -> bool:
+        return self.resume_window > 0
+
+    @property
+    def is_shared(self) -> bool:
+        return self.share is not None
+
+    async def start(self) -> None:
+        if self.is_enabled and self.sweeper is None:
+            self.sweeper = create_task(self._sweep_forever())
+
+    async def stop(self) -> None:
+        if self.sweeper:
+            self.sweeper.cancel()
+            try:
+                await self.sweeper
+            except CancelledError:
+                ...
+            self.sweeper = None
+
+        for buffer in list(self.buffers.values()):
+            await buffer.close()
+        self.buffers.clear()
+
+        # Closed buffers have queued their end, so the publishers finish on their own
+        if self.publishers:
+            _, pending = await wait(self.publishers, timeout=self.PUBLISH_TIMEOUT)
+            for publisher in pending:
+                publisher.cancel()
+
+    def create(self, source: AsyncGenerator[str, None]) -> ReplayBuffer:
+        return ReplayBuffer(source, self.max_stream_bytes)
+
+    def add(
+        self,
+        key: str,
+        buffer: ReplayBuffer,
+        on_chunk: Callable[[], None],
+        on_done: Callable[[bool], Awaitable[None]],
+    ) -> None:
+        def on_buffer_chunk() -> None:
+            on_chunk()
+            self._enforce_max_bytes()
+
+        self.buffers[key] = buffer
+        if self.share is not None:
+            publisher = create_task(
+                self.share.publish(
+                    key,
+                    buffer,
+                    buffer.start_mirror(),
+                    self.resume_window,
+                    self.max_stream_bytes,
+                )
+            )
+            self.publishers.add(publisher)
+            publisher.add_done_callback(self.publishers.discard)
+        buffer.start(on_buffer_chunk, on_done)
+
+    async def resume(self, key: str, offset: int) -> AsyncGenerator[str, None] | None:
+        """The buffered reply from `offset` on, or None if there is no buffer for `key`.
+
+        The buffer is looked for in this process, then in the share if there
+        is one. The reply is a `ReplyStream` when its stats are known, which
+        for a shared buffer they are once the reply has ended. Raises
+        `OffsetUnavailable` if the buffer does not hold `offset`.
+        """
+        buffer = self.buffers.get(key)
+        if buffer is not None:
+            buffer.ensure_offset(offset)
+            self.counters.resumed += 1
+            if buffer.stats is None:
+                return buffer.subscribe(offset)
+            return ReplyStream(buffer.subscribe(offset), buffer.stats)
+
+        if self.share is None:
+            return None
+
+        try:
+            shared = await self.share.resume(key, offset)
+        except OffsetUnavailable:
+            raise
+        except Exception as e:
+            print(
+                f"Unable to look for a shared replay of stream {key}: {e}", flush=True
+            )
+            return None
+        if shared is not None:
+            self.counters.resumed += 1
+            self.counters.shared_resumed += 1
+        return shared
+
+    def get(self, key: str) -> ReplayBuffer | None:
+        return self.buffers.get(key)
+
+    def expire(self) -> None:
+        now = monotonic()
+        for key, buffer in list(self.buffers.items()):
+            if (
+                buffer.detached_at is not None
+                and now - buffer.detached_at >= self.resume_window
+            ):
+                self._drop(key)
+                self.counters.expired += 1
+
+    def metrics(self) -> ReplayMetrics:
+        return self.counters.model_copy(
+            update={
+                "buffers": len(self.buffers),
+                "bytes": sum(buffer.bytes for buffer in self.buffers.values()),
+            }
+        )
+
+    def _enforce_max_bytes(self) -> None:
+        total = sum(buffer.bytes for buffer in self.buffers.values())
+        if total <= self.max_bytes:
+            return
+
+        finished = [key for key, buffer in self.buffers.items() if buffer.is_done]
+        unread = [
+            key
+            for key, buffer in self.buffers.items()
+            if not buffer.is_done and buffer.subscribers == 0
+        ]
+        for key in finished + unread:
+            if total <= self.max_bytes:
+                return
+            total -= self.buffers[key].bytes
+            self._drop(key)
+            self.counters.evicted += 1
+
+    def _drop(self, key: str) -> None:
+        buffer = self.buffers.pop(key, None)
+        if buffer is not None:
+            buffer.cancel()
+
+    async def _sweep_forever(self) -> None:
+        while True:
+            await sleep(min(self.sweep_interval, self.resume_window))
+            self.expire()
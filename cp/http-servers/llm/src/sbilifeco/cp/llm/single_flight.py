@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+from asyncio import CancelledError, Condition, Task, create_task, shield
+from typing import AsyncGenerator, Awaitable, Callable, Generic, TypeVar
+
+from pydantic import BaseModel
+from sbilifeco.boundaries.llm import ReplyStats
+
+ResultT = TypeVar("ResultT")
+
+
+class CoalescingMetrics(BaseModel):
+    queries_coalesced: int = 0
+    """Queries answered by another identical query's upstream call."""
+
+    streams_coalesced: int = 0
+    """Streams fed from another identical stream's upstream stream."""
+
+    queries_in_flight: int = 0
+    streams_in_flight: int = 0
+
+
+class SingleFlight(Generic[ResultT]):
+    """Runs at most one call per key at a time; concurrent callers share its result."""
+
+    def __init__(self) -> None:
+        self.in_flight: dict[str, Task[ResultT]] = {}
+        self.coalesced = 0
+
+    async def do(self, key: str, call: Callable[[], Awaitable[ResultT]]) -> ResultT:
+        task = self.in_flight.get(key)
+        if task is None:
+            task = create_task(self._run(call))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+
+        # Shielded, so one caller going away does not cancel the call for the others
+        return await shield(task)
+
+    async def _run(self, call: Callable[[], Awaitable[ResultT]]) -> ResultT:
+        return await call()
+
+
+class StreamBroadcast:
+    """Fans one upstream stream out to any number of subscribers.
+
+    Chunks are kept for the lifetime of the upstream stream, so a subscriber
+    that joins late first replays what it missed and then follows live. The
+    upstream stream is closed once it ends or its last subscriber leaves.
+    Subscribers share the upstream stream's `stats`, if it has any.
+
+    A subscriber counts from when `subscribe` hands its stream out, so one
+    leaving does not close the upstream stream under another that has not
+    started reading yet; a stream handed out but never read keeps the
+    upstream stream going to its end. Should the upstream stream be closed
+    early all the same, subscribers get an error rather than a reply that
+    looks complete.
+    """
+
+    def __init__(
+        self, source: AsyncGenerator[str, None], stats: ReplyStats | None = None
+    ) -> None:
+        self.source = source
+        self.stats = stats
+        self.chunks: list[str] = []
+        self.is_done = False
+        self.error: Exception | None = None
+        self.subscribers = 0
+        self.changed = Condition()
+        self.pump: Task | None = None
+        self.on_done: Callable[[], None] | None = None
+
+    def start(self, on_done: Callable[[], None] | None = None) -> StreamBroadcast:
+        self.on_done = on_done
+        self.pump = create_task(self._pump())
+        return self
+
+    def subscribe(self) -> AsyncGenerator[str, None]:
+        self.subscribers += 1
+        return self._follow()
+
+    async def _follow(self) -> AsyncGenerator[str, None]:
+        position = 0
+
+        try:
+            while True:
+                async with self.changed:
+                    await self.changed.wait_for(
+                        lambda: position < len(self.chunks) or self.is_done
+                    )
+
+                if position < len(self.chunks):
+                    chunk = self.chunks[position]
+                    position += 1
+                    yield chunk
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.is_done and self.pump:
+                self.pump.cancel()
+
+    async def _pump(self) -> None:
+        try:
+            async for chunk in self.source:
+                self.chunks.append(chunk)
+                async with self.changed:
+                    self.changed.notify_all()
+        except CancelledError:
+            self.error = RuntimeError("The upstream stream was cancelled")
+        except Exception as e:
+            self.error = e
+        finally:
+            self.is_done = True
+            if self.on_done:
+                self.on_done()
+            try:
+                await self.source.aclose()
+            finally:
+                async with self.changed:
+                    self.changed.notify_all()
@@ -5,7 +5,69 @@ class LLMQuery(BaseModel):
     context: str
 
 
+class LLMBatchQuery(BaseModel):
+    queries: list[LLMQuery]
+
+
+class LLMBatchResult(BaseModel):
+    """The outcome of one query of a batch, shaped like a `Response`."""
+
+    index: int
+    """Position of the query in the batch."""
+
+    is_success: bool
+    code: int
+    message: str = ""
+    payload: str | None = None
+
+
+class LLMStreamEvent(BaseModel):
+    """One frame of a framed (SSE or NDJSON) stream."""
+
+    type: str
+    """delta, usage, finish, timing, error or heartbeat."""
+
+    text: str | None = None
+    offset: int | None = None
+    """Characters of the reply sent before this delta."""
+
+    input_tokens: int | None = None
+    output_tokens: int | None = None
+    cached_input_tokens: int | None = None
+    finish_reason: str | None = None
+    time_to_first_token: float | None = None
+    elapsed: float | None = None
+    message: str | None = None
+
+
+class StreamFormats:
+    """Media types a client can ask for in the Accept header of a stream request."""
+
+    RAW = ""
+    SSE = "text/event-stream"
+    NDJSON = "application/x-ndjson"
+
+
 class Paths:
     BASE = "/api/v1/llm"
     QUERIES = BASE + "/queries"
+    BATCHES = BASE + "/batches"
     STREAMS = BASE + "/streams"
+    STREAM = STREAMS + "/{request_id}"
+    STREAM_METRICS = BASE + "/stream-metrics"
+    COALESCING_METRICS = BASE + "/coalescing-metrics"
+    REPLAY_METRICS = BASE + "/replay-metrics"
+    METRICS = BASE + "/metrics"
+
+
+class ChunkingJobRequest(BaseModel):
+    sources: list[str]
+    """URLs, file paths or texts of the documents to chunk."""
+
+
+class ChunkingJobPaths:
+    BASE = "/api/v1/chunking-jobs"
+    JOB = BASE + "/{job_id}"
+    JOB_EVENTS = JOB + "/events"
+    JOB_CANCELLATION = JOB + "/cancellation"
+    JOB_CHUNKS = JOB + "/documents/{index}/chunks"
@@ -0,0 +1,64 @@
+from typing import AsyncGenerator, Protocol
+
+from pydantic import BaseModel
+from sbilifeco.models.base import Response
+
+
+class ChunkingJobStatus:
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class ChunkingDocument(BaseModel):
+    index: int
+    """Position of the document in the job."""
+
+    source: str
+    """URL, file path or text of the document, as `read_and_chunk` takes it."""
+
+    status: str = ChunkingJobStatus.QUEUED
+    chunks: int = 0
+    """Number of chunks, once the document has been chunked."""
+
+    error: str | None = None
+
+
+class ChunkingJob(BaseModel):
+    """Chunking of many documents, run in the background."""
+
+    job_id: str
+    status: str = ChunkingJobStatus.QUEUED
+    """queued, running, succeeded, failed or cancelled. A job with any failed document fails."""
+
+    created_at: float
+    updated_at: float
+    documents: list[ChunkingDocument]
+
+    backend_state: dict[str, str] = {}
+    """What the chunking backend needs to pick the job up after a restart, such as the batch job it started."""
+
+
+class IChunkingJobs(Protocol):
+    async def submit_job(self, sources: list[str]) -> Response[ChunkingJob]:
+        raise NotImplementedError()
+
+    async def get_job(self, job_id: str) -> Response[ChunkingJob]:
+        raise NotImplementedError()
+
+    async def watch_job(
+        self, job_id: str
+    ) -> Response[AsyncGenerator[ChunkingJob, None]]:
+        """The job's state now and after every change, until it has finished."""
+        raise NotImplementedError()
+
+    async def read_job_chunks(self, job_id: str, index: int) -> Response[list[str]]:
+        """Chunks of the job's document at `index`, once it has been chunked."""
+        raise NotImplementedError()
+
+    async def cancel_job(self, job_id: str) -> Response[ChunkingJob]:
+        raise NotImplementedError()
@@ -1,5 +1,5 @@
 from typing import Protocol, AsyncGenerator
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from sbilifeco.models.base import Response
 from uuid import uuid4
 
@@ -12,16 +12,53 @@ class ChatMessage(BaseModel):
 class LLMRequest(BaseModel):
     """Represents a request to the LLM service."""
 
-    request_id: str = str(uuid4())
+    request_id: str = Field(default_factory=lambda: str(uuid4()))
     """Unique identifier for the request."""
 
     context: str = ""
     """Context for the LLM request."""
 
+    cacheable_prefix: str = ""
+    """Leading part of the prompt shared by many requests, such as a document or instructions. Sent before `context` and cached by the model where it can, so repeats skip reprocessing it."""
+
     randomness: float = 0.0
     """Randomness factor for the LLM response. Is a value between 0 and 1, where higher values result in more random responses."""
 
 
+class ReplyStats(BaseModel):
+    """Token usage and outcome of a streamed reply, filled in once the reply has ended."""
+
+    model: str | None = None
+    """Model writing the reply, known from the start."""
+
+    input_tokens: int | None = None
+    output_tokens: int | None = None
+    cached_input_tokens: int | None = None
+    """Part of `input_tokens` read from a prompt cache rather than processed afresh."""
+
+    finish_reason: str | None = None
+    """Why the model stopped, as reported by the model, e.g. end_turn, max_tokens or STOP."""
+
+
+class ReplyStream(AsyncGenerator[str, None]):
+    """A streamed reply whose `stats` are filled in by the time it has ended."""
+
+    def __init__(
+        self, chunks: AsyncGenerator[str, None], stats: ReplyStats | None = None
+    ) -> None:
+        self.chunks = chunks
+        self.stats = stats or ReplyStats()
+
+    async def asend(self, value: None) -> str:
+        return await self.chunks.asend(value)
+
+    async def athrow(self, typ, val=None, tb=None) -> str:  # type: ignore[override]
+        return await self.chunks.athrow(typ, val, tb)
+
+    async def aclose(self) -> None:
+        await self.chunks.aclose()
+
+
 class ILLM(Protocol):
     async def generate_reply(self, context: str) -> Response[str]:
         raise NotImplementedError()
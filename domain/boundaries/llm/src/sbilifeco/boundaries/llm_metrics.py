@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    pairs = []
+    for name, value in labels.items():
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Series:
+    def __init__(self, buckets: int) -> None:
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    """Observations of one quantity by route and model, bucketed the Prometheus way.
+
+    Observations may come from worker threads as well as the event loop.
+    """
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...]) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series: dict[tuple[str, str], _Series] = {}
+        self.lock = Lock()
+
+    def observe(self, route: str, model: str, value: float) -> None:
+        with self.lock:
+            series = self.series.get((route, model))
+            if series is None:
+                series = self.series[(route, model)] = _Series(len(self.buckets))
+            series.counts[bisect_left(self.buckets, value)] += 1
+            series.sum += value
+            series.count += 1
+
+    def count(self, route: str, model: str) -> int:
+        with self.lock:
+            series = self.series.get((route, model))
+            return series.count if series else 0
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for (route, model), series in sorted(self.series.items()):
+                labels = {"route": route, "model": model}
+                cumulative = 0
+                for bound, count in zip((*self.buckets, float("inf")), series.counts):
+                    cumulative += count
+                    bucket_labels = _format_labels(
+                        {**labels, "le": _format_value(bound)}
+                    )
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(
+                    f"{self.name}_sum{_format_labels(labels)} {_format_value(series.sum)}"
+                )
+                lines.append(
+                    f"{self.name}_count{_format_labels(labels)} {series.count}"
+                )
+        return lines
+
+
+class LLMMetrics:
+    """Latency histograms, occupancy gauges and counters of an LLM service, for Prometheus to scrape.
+
+    Histograms are labelled by route and model. The server observes its HTTP
+    routes, and the gateways observe queue waits and connect time by the
+    call that waited, such as generate_streamed_reply. Gauges and counters are
+    read from the objects they describe when the metrics are rendered. A service shares one
+    instance between its server and gateways; each worker process has its own.
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    SECONDS = (
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        30,
+        60,
+        120,
+        300,
+    )
+    TOKENS_PER_SECOND = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+    BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+    def __init__(self) -> None:
+        self.admission_wait = Histogram(
+            "llm_admission_wait_seconds",
+            "Time calls waited for admission control to let them through.",
+            self.SECONDS,
+        )
+        self.executor_wait = Histogram(
+            "llm_executor_wait_seconds",
+            "Time blocking calls waited for a worker thread.",
+            self.SECONDS,
+        )
+        self.connect_time = Histogram(
+            "llm_vertex_connect_seconds",
+            "Time to open a stream from Vertex AI, up to its response headers.",
+            self.SECONDS,
+        )
+        self.time_to_first_token = Histogram(
+            "llm_time_to_first_token_seconds",
+            "Time from a stream request to the first text of its reply.",
+            self.SECONDS,
+        )
+        self.tokens_per_second = Histogram(
+            "llm_output_tokens_per_second",
+            "Output tokens of a streamed reply over the time after its first text.",
+            self.TOKENS_PER_SECOND,
+        )
+        self.latency = Histogram(
+            "llm_latency_seconds",
+            "Time from a request to the end of its reply.",
+            self.SECONDS,
+        )
+        self.request_size = Histogram(
+            "llm_request_bytes", "Size of the prompts received.", self.BYTES
+        )
+        self.response_size = Histogram(
+            "llm_response_bytes", "Size of the replies sent.", self.BYTES
+        )
+        self.gauges: dict[
+            str, tuple[str, dict[tuple[tuple[str, str], ...], Callable[[], float]]]
+        ] = {}
+        self.counters: dict[
+            str, tuple[str, dict[tuple[tuple[str, str], ...], Callable[[], float]]]
+        ] = {}
+
+    def histograms(self) -> list[Histogram]:
+        return [
+            self.admission_wait,
+            self.executor_wait,
+            self.connect_time,
+            self.time_to_first_token,
+            self.tokens_per_second,
+            self.latency,
+            self.request_size,
+            self.response_size,
+        ]
+
+    def add_gauge(
+        self, name: str, help: str, read: Callable[[], float], **labels: str
+    ) -> LLMMetrics:
+        """Report `read()` as `name` with `labels`, replacing any gauge with the same name and labels."""
+        _, reads = self.gauges.setdefault(name, (help, {}))
+        reads[tuple(sorted(labels.items()))] = read
+        return self
+
+    def add_counter(
+        self, name: str, help: str, read: Callable[[], float], **labels: str
+    ) -> LLMMetrics:
+        """Report `read()`, a count that only goes up, as `name` with `labels`."""
+        _, reads = self.counters.setdefault(name, (help, {}))
+        reads[tuple(sorted(labels.items()))] = read
+        return self
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for histogram in self.histograms():
+            lines.extend(histogram.render())
+
+        for kind, series in [("gauge", self.gauges), ("counter", self.counters)]:
+            for name, (help, reads) in series.items():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, read in reads.items():
+                    try:
+                        value = read()
+                    except Exception as e:
+                        print(f"Unable to read {kind} {name}: {e}", flush=True)
+                        continue
+                    lines.append(
+                        f"{name}{_format_labels(dict(labels))} {_format_value(value)}"
+                    )
+
+        return "\n".join(lines) + "\n"
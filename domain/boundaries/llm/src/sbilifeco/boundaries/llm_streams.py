@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+from asyncio import CancelledError, Task, create_task, sleep
+from time import monotonic
+from traceback import format_exc
+from typing import Awaitable, Callable, Generic, TypeVar
+
+from pydantic import BaseModel
+
+StreamT = TypeVar("StreamT")
+
+
+class StreamMetrics(BaseModel):
+    """Counters describing the streams held by a `StreamRegistry`."""
+
+    live: int = 0
+    """Number of streams currently registered."""
+
+    registered: int = 0
+    """Number of streams registered since start."""
+
+    completed: int = 0
+    """Number of streams that were read to the end."""
+
+    disconnected: int = 0
+    """Number of streams abandoned by their reader before the end."""
+
+    evicted_idle: int = 0
+    """Number of streams evicted after producing nothing for the idle timeout."""
+
+    rejected: int = 0
+    """Number of streams refused because the registry was full."""
+
+
+class StreamLimitExceeded(Exception):
+    """Raised when registering a stream would exceed the maximum number of live streams."""
+
+
+class StreamAlreadyExists(Exception):
+    """Raised when a stream is already registered under the same key."""
+
+
+class _StreamEntry(Generic[StreamT]):
+    def __init__(
+        self, stream: StreamT, on_close: Callable[[], Awaitable[None]] | None
+    ) -> None:
+        self.stream = stream
+        self.on_close = on_close
+        self.last_active = monotonic()
+
+
+class StreamRegistry(Generic[StreamT]):
+    """Live streams keyed by request ID.
+
+    Every stream is closed exactly once, whichever of these comes first: the
+    reader finishes it, the reader goes away, or it stays idle for longer than
+    the idle timeout. The number of live streams can be capped.
+    """
+
+    def __init__(self, closer: Callable[[StreamT], Awaitable[None]] | None = None):
+        self.closer = closer
+        self.max_streams = 0
+        self.idle_timeout = 300.0
+        self.sweep_interval = 10.0
+        self.entries: dict[str, _StreamEntry[StreamT]] = {}
+        self.reserved: set[str] = set()
+        self.counters = StreamMetrics()
+        self.sweeper: Task | None = None
+
+    def set_max_streams(self, max_streams: int) -> StreamRegistry[StreamT]:
+        """Cap on live streams. 0 means no cap."""
+        self.max_streams = max_streams
+        return self
+
+    def set_idle_timeout(self, idle_timeout: float) -> StreamRegistry[StreamT]:
+        """Seconds a stream may go without activity before it is evicted. 0 disables eviction."""
+        self.idle_timeout = idle_timeout
+        return self
+
+    def set_sweep_interval(self, sweep_interval: float) -> StreamRegistry[StreamT]:
+        self.sweep_interval = sweep_interval
+        return self
+
+    async def start(self) -> None:
+        if self.idle_timeout > 0 and self.sweeper is None:
+            self.sweeper = create_task(self._sweep_forever())
+
+    async def stop(self) -> None:
+        if self.sweeper:
+            self.sweeper.cancel()
+            try:
+                await self.sweeper
+            except CancelledError:
+                ...
+            self.sweeper = None
+
+        for key in list(self.entries):
+            await self.unregister(key, completed=False)
+
+    def ensure_capacity(self, key: str) -> None:
+        """Raise if a stream could not be registered under `key` right now.
+
+        Lets callers refuse a request before opening an expensive upstream stream.
+        """
+        if key in self.entries or key in self.reserved:
+            raise StreamAlreadyExists(f"A stream is already registered for {key}")
+
+        if (
+            self.max_streams
+            and len(self.entries) + len(self.reserved) >= self.max_streams
+        ):
+            self.counters.rejected += 1
+            raise StreamLimitExceeded(
+                f"Too many concurrent streams, limit is {self.max_streams}"
+            )
+
+    def reserve(self, key: str) -> None:
+        """Hold a place for a stream under `key` while it is being opened.
+
+        Raises like `ensure_capacity`. The place counts against the cap until
+        `register` fills it or `unreserve` gives it up, so concurrent callers
+        cannot both pass the check and then overrun the cap.
+        """
+        self.ensure_capacity(key)
+        self.reserved.add(key)
+
+    def unreserve(self, key: str) -> None:
+        """Give up a place held by `reserve`. Does nothing once a stream is registered in it."""
+        self.reserved.discard(key)
+
+    def register(
+        self,
+        key: str,
+        stream: StreamT,
+        on_close: Callable[[], Awaitable[None]] | None = None,
+    ) -> None:
+        if key in self.reserved:
+            self.reserved.discard(key)
+        else:
+            self.ensure_capacity(key)
+        self.entries[key] = _StreamEntry(stream, on_close)
+        self.counters.registered += 1
+
+    def get(self, key: str) -> StreamT | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        entry.last_active = monotonic()
+        return entry.stream
+
+    def touch(self, key: str) -> None:
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.last_active = monotonic()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    async def unregister(self, key: str, completed: bool = True) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+
+        if completed:
+            self.counters.completed += 1
+        else:
+            self.counters.disconnected += 1
+
+        await self._close(key, entry)
+
+    async def evict_idle(self) -> None:
+        if self.idle_timeout <= 0:
+            return
+
+        now = monotonic()
+        for key, entry in list(self.entries.items()):
+            if now - entry.last_active < self.idle_timeout:
+                continue
+            if self.entries.pop(key, None) is None:
+                continue
+
+            print(f"Evicting stream {key} after being idle", flush=True)
+            self.counters.evicted_idle += 1
+            await self._close(key, entry)
+
+    def metrics(self) -> StreamMetrics:
+        return self.counters.model_copy(update={"live": len(self.entries)})
+
+    async def _close(self, key: str, entry: _StreamEntry[StreamT]) -> None:
+        try:
+            if entry.on_close:
+                await entry.on_close()
+            elif self.closer:
+                await self.closer(entry.stream)
+        except Exception as e:
+            print(f"Error closing stream {key}: {e}", flush=True)
+            print(format_exc(), flush=True)
+
+    async def _sweep_forever(self) -> None:
+        while True:
+            await sleep(self.sweep_interval)
+            await self.evict_idle()
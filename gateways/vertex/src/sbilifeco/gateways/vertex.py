@@ -2,27 +2,82 @@ from __future__ import annotations
 from io import BufferedIOBase, RawIOBase, TextIOBase
 from typing import AsyncGenerator, AsyncIterator
 from traceback import format_exc
-from anthropic.types import DocumentBlockParam
-from sbilifeco.boundaries.llm import ILLM, LLMRequest
+from anthropic import (
+    DEFAULT_CONNECTION_LIMITS,
+    APIConnectionError,
+    APIStatusError,
+    DefaultAsyncHttpxClient,
+    RateLimitError,
+)
+from anthropic.types import DocumentBlockParam, TextBlockParam
+from sbilifeco.boundaries.llm import ILLM, LLMRequest, ReplyStats, ReplyStream
+from sbilifeco.boundaries.llm_metrics import LLMMetrics
+from sbilifeco.boundaries.llm_streams import (
+    StreamAlreadyExists,
+    StreamLimitExceeded,
+    StreamRegistry,
+)
 from sbilifeco.models.base import Response
 from anthropic.lib.vertex import AsyncAnthropicVertex
 from anthropic.lib.streaming import AsyncMessageStream
 from anthropic.types.plain_text_source_param import PlainTextSourceParam
 from anthropic.types.base64_pdf_source_param import Base64PDFSourceParam
 from sbilifeco.boundaries.material_reader import BaseMaterialReader
-from requests import Request, Session
-from asyncio import get_running_loop
-from functools import partial
+from asyncio import TimeoutError, get_running_loop
 from base64 import b64encode
+from functools import partial
+from time import monotonic
+from httpx import Limits
+from sbilifeco.gateways.vertex_chunk_parser import DelimitedChunkParser
+from sbilifeco.gateways.vertex_chunk_store import ChunkStore
+from sbilifeco.gateways.vertex_client_pool import VertexClientPool
+from sbilifeco.gateways.vertex_downloader import MaterialDownloader, MaterialTooLarge
+from sbilifeco.gateways.vertex_material_source import MaterialSource
+from sbilifeco.gateways.vertex_prechunker import PreChunker, merge_in_order
+from sbilifeco.gateways.vertex_retry import RetryMetrics, RetryPolicy
+from sbilifeco.gateways.vertex_token_budget import (
+    TokenBudget,
+    TokenBudgetExceeded,
+    TokenBudgetMetrics,
+)
 
 
 class VertexAI(ILLM, BaseMaterialReader):
+    CHUNKING_PROMPT = (
+        ""
+        "You are a document parser. "
+        "Please parse the following document and extract it."
+        "If the content is base64 encoded, please decode it. Otherwise use it as it is."
+        "Split the document into logical chunks such as related paragraphs, bullet or numbered points, tables and figures."
+        'Flatten all tables as "Row header, Column header: Value".'
+        "Terms and conditions should appear in the same chunk as the original content on which they apply."
+        "Use the delimiter #=====# as the seperator between chunks."
+        "Return each logical chunk seperately"
+    )
+    CHUNK_DELIMITER = "#=====#"
+    CHUNKING_PROMPT_VERSION = "2"
+    """Bump whenever CHUNKING_PROMPT changes, so stored chunks from the old prompt are not reused."""
+
     def __init__(self) -> None:
         self.region: str = ""
         self.project_id: str = ""
         self.model: str = ""
         self.max_output_tokens = 8192
-        self.streams: dict[str, AsyncMessageStream] = {}
+        self.streams: StreamRegistry[AsyncMessageStream] = StreamRegistry()
+        self.pool_size = 4
+        self.keep_alive = 300.0
+        self.health_check_interval = 60.0
+        self.http2 = True
+        self.clients: VertexClientPool[AsyncAnthropicVertex]
+        self.chunk_store: ChunkStore | None = None
+        self.downloader = MaterialDownloader()
+        self.retries: RetryPolicy[str] = RetryPolicy()
+        self.prompt_cache_min_chars = 4096
+        self.prechunker: PreChunker | None = None
+        self.prechunk_parallelism = 4
+        self.whole_chunks = False
+        self.token_budget: TokenBudget | None = None
+        self.metrics = LLMMetrics()
 
     def set_region(self, region: str) -> VertexAI:
         self.region = region
@@ -40,24 +95,154 @@ class VertexAI(ILLM, BaseMaterialReader):
         self.max_output_tokens = max_output_tokens
         return self
 
-    async def async_init(self) -> None: ...
+    def set_pool_size(self, pool_size: int) -> VertexAI:
+        self.pool_size = pool_size
+        return self
 
-    async def async_shutdown(self) -> None: ...
+    def set_keep_alive(self, keep_alive: float) -> VertexAI:
+        self.keep_alive = keep_alive
+        return self
 
-    async def generate_reply(self, context: str) -> Response[str]:
-        vertex_client: AsyncAnthropicVertex | None = None
+    def set_health_check_interval(self, health_check_interval: float) -> VertexAI:
+        self.health_check_interval = health_check_interval
+        return self
+
+    def set_http2(self, http2: bool) -> VertexAI:
+        self.http2 = http2
+        return self
+
+    def set_chunk_store(self, chunk_store: ChunkStore) -> VertexAI:
+        self.chunk_store = chunk_store
+        return self
+
+    def set_downloader(self, downloader: MaterialDownloader) -> VertexAI:
+        self.downloader = downloader
+        return self
+
+    def set_prechunker(self, prechunker: PreChunker) -> VertexAI:
+        """Splits text materials into windows, and PDFs into page ranges, that `read_and_chunk` chunks in parallel."""
+        self.prechunker = prechunker
+        return self
+
+    def set_prechunk_parallelism(self, parallelism: int) -> VertexAI:
+        """Most windows or page ranges of one material chunked at a time."""
+        self.prechunk_parallelism = max(1, parallelism)
+        return self
+
+    def set_whole_chunks(self, whole_chunks: bool) -> VertexAI:
+        """Whether `read_and_chunk` yields whole chunks as each delimiter streams, rather than raw model text."""
+        self.whole_chunks = whole_chunks
+        return self
+
+    def set_retry_policy(self, retries: RetryPolicy[str]) -> VertexAI:
+        """Deadline, retries and hedging for `generate_reply`."""
+        self.retries = retries
+        return self
+
+    def set_prompt_cache_min_chars(self, min_chars: int) -> VertexAI:
+        """Shorter cacheable prefixes are not marked for caching, as Claude only caches 1024 tokens or more."""
+        self.prompt_cache_min_chars = min_chars
+        return self
+
+    def set_token_budget(self, token_budget: TokenBudget) -> VertexAI:
+        """Sizes prompts against the context window and the reply's max_tokens to what is left of it."""
+        self.token_budget = token_budget.set_count_tokens(self._count_tokens)
+        return self
+
+    def token_budget_metrics(self) -> TokenBudgetMetrics:
+        if self.token_budget is None:
+            return TokenBudgetMetrics()
+        return self.token_budget.metrics()
+
+    def set_metrics(self, metrics: LLMMetrics) -> VertexAI:
+        """Where the time to open streams is recorded."""
+        self.metrics = metrics
+        return self
+
+    def retry_metrics(self) -> RetryMetrics:
+        return self.retries.metrics()
+
+    def set_max_streams(self, max_streams: int) -> VertexAI:
+        self.streams.set_max_streams(max_streams)
+        return self
+
+    def set_stream_idle_timeout(self, idle_timeout: float) -> VertexAI:
+        self.streams.set_idle_timeout(idle_timeout)
+        return self
 
+    async def async_init(self) -> None:
+        print(
+            f"Initializing Vertex AI clients with region: {self.region}, project_id: {self.project_id}, model: {self.model}",
+            flush=True,
+        )
+        self.retries.add_metrics(self.metrics, model=self.model, region=self.region)
+        if self.token_budget is not None:
+            self.token_budget.add_metrics(
+                self.metrics, model=self.model, region=self.region
+            )
+
+        self.clients = (
+            VertexClientPool(self._create_client, self._close_client)
+            .set_size(self.pool_size)
+            .set_health_check(self._is_client_healthy)
+            .set_health_check_interval(self.health_check_interval)
+        )
+        await self.clients.start()
+        await self.streams.start()
+        await self.downloader.async_init()
+
+    async def async_shutdown(self) -> None:
+        await self.streams.stop()
+        await self.clients.stop()
+        await self.downloader.async_shutdown()
+
+    def _create_client(self) -> AsyncAnthropicVertex:
+        return AsyncAnthropicVertex(
+            region=self.region,
+            project_id=self.project_id,
+            http_client=DefaultAsyncHttpxClient(
+                http2=self.http2,
+                limits=Limits(
+                    max_connections=DEFAULT_CONNECTION_LIMITS.max_connections,
+                    max_keepalive_connections=DEFAULT_CONNECTION_LIMITS.max_keepalive_connections,
+                    keepalive_expiry=self.keep_alive,
+                ),
+            ),
+        )
+
+    async def _close_client(self, vertex_client: AsyncAnthropicVertex) -> None:
+        await vertex_client.close()
+
+    async def _is_client_healthy(self, vertex_client: AsyncAnthropicVertex) -> bool:
+        return not vertex_client.is_closed()
+
+    async def generate_reply(self, context: str) -> Response[str]:
         try:
-            print(
-                f"Initializing Vertex AI client with region: {self.region}, project_id: {self.project_id}, model: {self.model}",
-                flush=True,
+            context, max_tokens = await self._fit(context)
+            return Response.ok(
+                await self.retries.call(
+                    lambda: self._generate_reply_once(context, max_tokens),
+                    self._is_retryable,
+                )
             )
-            vertex_client = AsyncAnthropicVertex(
-                region=self.region, project_id=self.project_id
+        except TokenBudgetExceeded as e:
+            return Response.fail(str(e), 413)
+        except TimeoutError:
+            return Response.fail(
+                f"Vertex AI did not reply within {self.retries.deadline} seconds", 504
             )
+        except Exception as e:
+            print(f"Error generating reply with Vertex AI: {e}", flush=True)
+            if isinstance(e, RateLimitError):
+                return Response.fail(str(e), 429)
+            return Response.error(e)
 
+    async def _generate_reply_once(self, context: str, max_tokens: int) -> str:
+        vertex_client = self.clients.acquire()
+
+        try:
             message = await vertex_client.messages.create(
-                max_tokens=self.max_output_tokens,
+                max_tokens=max_tokens,
                 messages=[
                     {
                         "role": "user",
@@ -68,61 +253,135 @@ class VertexAI(ILLM, BaseMaterialReader):
                 temperature=0,
             )
 
-            return Response.ok(
-                "\n".join(
-                    [block.text for block in message.content if block.type == "text"]
-                )
+            return "\n".join(
+                [block.text for block in message.content if block.type == "text"]
             )
-        except Exception as e:
-            print(f"Error generating reply with Vertex AI: {e}", flush=True)
-            return Response.error(e)
+        except APIConnectionError:
+            self.clients.discard(vertex_client)
+            raise
         finally:
-            print("Closing Vertex AI client", flush=True)
-            if vertex_client:
-                await vertex_client.close()
+            await self.clients.release(vertex_client)
+
+    async def _fit(self, context: str, prefix: str = "") -> tuple[str, int]:
+        """The context, cut to the token budget if there is one, and max_tokens for the reply."""
+        if self.token_budget is None:
+            return context, self.max_output_tokens
+        return await self.token_budget.fit(context, self.max_output_tokens, prefix)
+
+    async def _chunking_reply_tokens(self, text: str) -> int:
+        """max_tokens for chunking `text`, which is never cut to fit the budget."""
+        if self.token_budget is None:
+            return self.max_output_tokens
+        return await self.token_budget.reply_tokens(
+            text, self.max_output_tokens, self.CHUNKING_PROMPT
+        )
+
+    async def _count_tokens(self, text: str) -> int:
+        vertex_client = self.clients.acquire()
+        try:
+            count = await vertex_client.messages.count_tokens(
+                messages=[{"role": "user", "content": text}], model=self.model
+            )
+            return count.input_tokens
+        finally:
+            await self.clients.release(vertex_client)
+
+    def _is_retryable(self, e: Exception) -> bool:
+        """Connection errors, timeouts, 429s, 5xx and 529 (overloaded) are worth another try."""
+        return isinstance(e, (APIConnectionError, RateLimitError)) or (
+            isinstance(e, APIStatusError) and e.status_code >= 500
+        )
 
     async def generate_streamed_reply(
         self, request: LLMRequest
     ) -> Response[AsyncGenerator[str, None]]:
         vertex_client: AsyncAnthropicVertex | None = None
+        is_reserved = False
 
         try:
-            print(
-                f"Initializing Vertex AI client with region: {self.region}, project_id: {self.project_id}, model: {self.model} for request_id: {request.request_id}",
-                flush=True,
-            )
-            vertex_client = AsyncAnthropicVertex(
-                region=self.region, project_id=self.project_id
-            )
+            try:
+                self.streams.reserve(request.request_id)
+                is_reserved = True
+            except StreamLimitExceeded as e:
+                return Response.fail(str(e), 429)
+            except StreamAlreadyExists as e:
+                return Response.fail(str(e), 409)
+
+            try:
+                context, max_tokens = await self._fit(
+                    request.context, request.cacheable_prefix
+                )
+            except TokenBudgetExceeded as e:
+                return Response.fail(str(e), 413)
+            request = request.model_copy(update={"context": context})
+
+            vertex_client = self.clients.acquire()
 
             print(
                 f"Sending prompt and obtaining streamed response from Vertex AI for request_id: {request.request_id}",
                 flush=True,
             )
             reply = vertex_client.messages.stream(
-                max_tokens=self.max_output_tokens,
+                max_tokens=max_tokens,
                 messages=[
                     {
                         "role": "user",
-                        "content": request.context,
+                        "content": self._prompt(request),
                     }
                 ],
                 model=self.model,
                 temperature=request.randomness,
             )
 
+            connecting_at = monotonic()
             stream = await reply.__aenter__()
+            self.metrics.connect_time.observe(
+                "generate_streamed_reply", self.model, monotonic() - connecting_at
+            )
             print(
                 f"Stream obtained, processing streamed response for request_id: {request.request_id}",
                 flush=True,
             )
 
-            async def process_stream(request_id: str) -> AsyncGenerator[str, None]:
-                stream = self.streams[request_id]
+            async def close_stream(
+                stream: AsyncMessageStream = stream,
+                vertex_client: AsyncAnthropicVertex = vertex_client,
+            ) -> None:
+                print(
+                    f"Vertex Gateway: Closing the open stream for request_id: {request.request_id}",
+                    flush=True,
+                )
+                try:
+                    await stream.__aexit__(None, None, None)
+                finally:
+                    await self.clients.release(vertex_client)
+
+            async def process_stream(
+                request_id: str, stats: ReplyStats
+            ) -> AsyncGenerator[str, None]:
+                is_complete = False
 
                 try:
+                    stream = self.streams.get(request_id)
+                    if stream is None:
+                        return
+
                     async for text in stream.text_stream:
+                        self.streams.touch(request_id)
                         yield text
+                    is_complete = True
+
+                    final_message = await stream.get_final_message()
+                    usage = final_message.usage
+                    # Claude counts cached and newly cached input apart from the rest
+                    stats.cached_input_tokens = usage.cache_read_input_tokens or 0
+                    stats.input_tokens = (
+                        usage.input_tokens
+                        + stats.cached_input_tokens
+                        + (usage.cache_creation_input_tokens or 0)
+                    )
+                    stats.output_tokens = usage.output_tokens
+                    stats.finish_reason = final_message.stop_reason
                 except Exception as e:
                     print(
                         f"Vertex Gateway: Error processing Vertex AI stream for request_id: {request_id}: {e}",
@@ -131,29 +390,43 @@ class VertexAI(ILLM, BaseMaterialReader):
                     print(format_exc(), flush=True)
                     raise e
                 finally:
-                    print(
-                        f"Vertex Gateway: Stream is exhausted, closing the open stream for request_id: {request_id}",
-                        flush=True,
-                    )
-                    await stream.__aexit__(None, None, None)
-                    print(
-                        f"Vertex Gateway: Closing Vertex AI client for request_id: {request_id}",
-                        flush=True,
-                    )
-                    await vertex_client.close()
-                    del self.streams[request.request_id]
+                    await self.streams.unregister(request_id, completed=is_complete)
+
+            self.streams.register(request.request_id, stream, on_close=close_stream)
+            vertex_client = None
 
-            self.streams[request.request_id] = stream
-            return Response.ok(process_stream(request.request_id))
+            stats = ReplyStats(model=self.model)
+            return Response.ok(
+                ReplyStream(process_stream(request.request_id, stats), stats)
+            )
         except Exception as e:
             print(
                 f"Vertex Gateway: Error generating streamed reply with Vertex AI for request_id: {request.request_id}: {e}",
                 flush=True,
             )
             print(format_exc(), flush=True)
+            if vertex_client:
+                await self.clients.release(vertex_client)
+            if isinstance(e, RateLimitError):
+                return Response.fail(str(e), 429)
             return Response.error(e)
         finally:
-            ...
+            if is_reserved:
+                # Frees the place unless the stream was registered in it
+                self.streams.unreserve(request.request_id)
+
+    def _prompt(self, request: LLMRequest) -> str | list[TextBlockParam]:
+        if not request.cacheable_prefix:
+            return request.context
+
+        # Claude caches the prompt up to the marked block, for five minutes past its last use
+        prefix: TextBlockParam = {"type": "text", "text": request.cacheable_prefix}
+        if len(request.cacheable_prefix) >= self.prompt_cache_min_chars:
+            prefix["cache_control"] = {"type": "ephemeral"}
+
+        if not request.context:
+            return [prefix]
+        return [prefix, {"type": "text", "text": request.context}]
 
     async def read_material(
         self,
@@ -170,67 +443,118 @@ class VertexAI(ILLM, BaseMaterialReader):
         self,
         material: str | bytes | bytearray | RawIOBase | BufferedIOBase | TextIOBase,
     ) -> Response[AsyncIterator[str | bytes]]:
+        response = await self._read_and_chunk(material)
+        if not self.whole_chunks or not response.is_success or response.payload is None:
+            return response
+
+        # The chunk store keeps the model's text as it came, so both modes share it
+        parser = DelimitedChunkParser(self.CHUNK_DELIMITER)
+        return Response.ok(parser.parse(response.payload))
+
+    async def _read_and_chunk(
+        self,
+        material: str | bytes | bytearray | RawIOBase | BufferedIOBase | TextIOBase,
+    ) -> Response[AsyncIterator[str | bytes]]:
+        source: MaterialSource | None = None
+
         try:
-            source: bytes | str | None = None
-            session: Session | None = None
-
-            if isinstance(material, (bytes, bytearray)):
-                source = bytes(material)
-            elif isinstance(material, str):
-                if material.startswith("file://"):
-                    file_path = material[len("file://") :]
-                    with open(file_path, "rb") as f:
-                        source = f.read()
-                elif material.startswith("http://") or material.startswith("https://"):
-                    req = Request("GET", material).prepare()
-                    session = Session()
-                    http_response = await get_running_loop().run_in_executor(
-                        None, partial(session.send, req)
-                    )
-                    source = http_response.content
-                else:
-                    source = material
-            elif isinstance(material, (RawIOBase, BufferedIOBase)):
-                source = material.read()
-            elif isinstance(material, TextIOBase):
-                source = material.read()
+            loop = get_running_loop()
+            material = await self.downloader.resolve(material)
+            source = await loop.run_in_executor(
+                None, partial(MaterialSource.open, material)
+            )
 
             if source is None:
                 return Response.fail("Material is not in a supported source structure")
 
+            chunk_store_key: str | None = None
+            if self.chunk_store:
+                material_digest = await loop.run_in_executor(None, source.digest)
+                chunk_store_key = self.chunk_store.key(
+                    material_digest,
+                    self.model,
+                    self._chunking_version(source.is_text),
+                    self.prechunker.window_chars if self.prechunker else 0,
+                )
+
+                if self.chunk_store.has(chunk_store_key):
+                    print(
+                        f"Serving chunks of material {material_digest} from the chunk store",
+                        flush=True,
+                    )
+                    return Response.ok(self.chunk_store.read(chunk_store_key))
+
+            # PDFs are only split by page range, as extracted text would lose their table layout
+            windows: list[str] | list[bytes] = []
+            if self.prechunker and source.text is not None:
+                if self.prechunker.window_chars:
+                    windows = await loop.run_in_executor(
+                        None, self.prechunker.windows, source.text
+                    )
+            elif self.prechunker and self.prechunker.pages_per_range:
+                pdf = await loop.run_in_executor(None, source.as_bytes)
+                windows = await loop.run_in_executor(
+                    None, self.prechunker.page_ranges, pdf
+                )
+
+            if len(windows) > 1:
+                parts = "windows" if source.is_text else "page ranges"
+                source.close()
+                source = None
+                print(
+                    f"Chunking material in {len(windows)} {parts} in parallel",
+                    flush=True,
+                )
+
+                async def __windowed_stream() -> AsyncGenerator[str | bytes, None]:
+                    finish_reasons: list[str | None] = []
+                    chunks = self._chunk_windows(windows, finish_reasons)
+                    if self.chunk_store and chunk_store_key:
+                        chunks = self.chunk_store.tee(
+                            chunk_store_key, chunks, finish_reasons
+                        )
+                    try:
+                        async for chunk in chunks:
+                            yield chunk
+                    except Exception as e:
+                        # Raised on, so the material is not taken for chunked in full
+                        print(f"Error using Vertex AI client for chunking: {e}")
+                        print(format_exc())
+                        raise
+                    finally:
+                        await chunks.aclose()
+
+                return Response.ok(__windowed_stream())
+
             source_as_block: PlainTextSourceParam | Base64PDFSourceParam
-            if isinstance(source, str):
+            if source.text is not None:
+                max_tokens = await self._chunking_reply_tokens(source.text)
                 source_as_block = {
                     "type": "text",
                     "media_type": "text/plain",
-                    "data": source,
+                    "data": source.text,
                 }
             else:
-                base64_as_bytes = b64encode(source)
+                # A PDF's tokens cannot be told from its size, so it gets the whole output limit
+                max_tokens = self.max_output_tokens
                 source_as_block = {
                     "type": "base64",
                     "media_type": "application/pdf",
-                    "data": base64_as_bytes.decode("utf-8"),
+                    "data": await loop.run_in_executor(None, source.base64),
                 }
 
-            vertex_client = AsyncAnthropicVertex(
-                region=self.region, project_id=self.project_id
-            )
+            # The request now holds its own copy, release the mapping or download
+            source.close()
+            source = None
+
+            vertex_client = self.clients.acquire()
 
             reply = vertex_client.messages.stream(
-                max_tokens=self.max_output_tokens,
+                max_tokens=max_tokens,
                 messages=[
                     {
                         "role": "user",
-                        "content": ""
-                        "You are a document parser. "
-                        "Please parse the following document and extract it."
-                        "If the content is base64 encoded, please decode it. Otherwise use it as it is."
-                        "Split the document into logical chunks such as related paragraphs, bullet or numbered points, tables and figures."
-                        'Flatten all tables as "Row header, Column header: Value".'
-                        "Terms and conditions should appear in the same chunk as the original content on which they apply."
-                        "Use the delimiter #=====# as the seperator between chunks."
-                        "Return each logical chunk seperately",
+                        "content": self.CHUNKING_PROMPT,
                     },
                     {
                         "role": "user",
@@ -244,23 +568,105 @@ class VertexAI(ILLM, BaseMaterialReader):
             async def __stream() -> AsyncGenerator[str | bytes, None]:
                 try:
                     async with reply as stream:
-                        async for chunk in stream.text_stream:
-                            yield chunk
+                        if not (self.chunk_store and chunk_store_key):
+                            async for chunk in stream.text_stream:
+                                yield chunk
+                            return
+
+                        finish_reasons: list[str | None] = []
+                        stored_chunks = self.chunk_store.tee(
+                            chunk_store_key,
+                            self._text_until_end(stream, finish_reasons),
+                            finish_reasons,
+                        )
+                        try:
+                            async for chunk in stored_chunks:
+                                yield chunk
+                        finally:
+                            await stored_chunks.aclose()
                 except Exception as e:
                     print(f"Error using Vertex AI client for chunking: {e}")
                     print(format_exc())
+                    raise
                 finally:
-                    print("Closing Vertex AI client in read_and_chunk", flush=True)
-                    if vertex_client:
-                        await vertex_client.close()
-                    if session:
-                        session.close()
+                    await self.clients.release(vertex_client)
 
             return Response.ok(__stream())
 
+        except (MaterialTooLarge, TokenBudgetExceeded) as e:
+            return Response.fail(str(e), 413)
         except Exception as e:
             print(f"Error: {e}")
             print(format_exc())
             return Response.error(e)
         finally:
-            ...
+            if source:
+                source.close()
+
+    def _chunking_version(self, is_text: bool) -> str:
+        # Chunks of page ranges differ from those of whole PDFs, so store them apart
+        if not is_text and self.prechunker and self.prechunker.pages_per_range:
+            return f"{self.CHUNKING_PROMPT_VERSION}-{self.prechunker.pages_per_range}p"
+        return self.CHUNKING_PROMPT_VERSION
+
+    async def _chunk_windows(
+        self, windows: list[str] | list[bytes], finish_reasons: list[str | None]
+    ) -> AsyncGenerator[str, None]:
+        """Chunks text windows or PDF page ranges concurrently, yielding their chunks in order.
+
+        A delimiter goes between windows, as each window ends on a chunk boundary.
+        """
+        producers = [
+            partial(self._chunk_window, window, finish_reasons) for window in windows
+        ]
+        current, tail = 0, ""
+        async for index, text in merge_in_order(producers, self.prechunk_parallelism):
+            if index != current:
+                if tail and not tail.rstrip().endswith(self.CHUNK_DELIMITER):
+                    yield f"\n{self.CHUNK_DELIMITER}\n"
+                current, tail = index, ""
+
+            tail = (tail + text)[-2 * len(self.CHUNK_DELIMITER) :]
+            yield text
+
+    async def _chunk_window(
+        self, window: str | bytes, finish_reasons: list[str | None]
+    ) -> AsyncGenerator[str, None]:
+        source: PlainTextSourceParam | Base64PDFSourceParam
+        if isinstance(window, str):
+            max_tokens = await self._chunking_reply_tokens(window)
+            source = {"type": "text", "media_type": "text/plain", "data": window}
+        else:
+            max_tokens = self.max_output_tokens
+            source = {
+                "type": "base64",
+                "media_type": "application/pdf",
+                "data": b64encode(window).decode("ascii"),
+            }
+
+        vertex_client = self.clients.acquire()
+        try:
+            async with vertex_client.messages.stream(
+                max_tokens=max_tokens,
+                messages=[
+                    {"role": "user", "content": self.CHUNKING_PROMPT},
+                    {
+                        "role": "user",
+                        "content": [{"type": "document", "source": source}],
+                    },
+                ],
+                model=self.model,
+                temperature=0,
+            ) as stream:
+                async for text in self._text_until_end(stream, finish_reasons):
+                    yield text
+        finally:
+            await self.clients.release(vertex_client)
+
+    async def _text_until_end(
+        self, stream: AsyncMessageStream, finish_reasons: list[str | None]
+    ) -> AsyncGenerator[str, None]:
+        """Text of `stream`, adding why the model stopped to `finish_reasons` once it has."""
+        async for text in stream.text_stream:
+            yield text
+        finish_reasons.append((await stream.get_final_message()).stop_reason)
@@ -0,0 +1,367 @@
+from __future__ import annotations
+
+from asyncio import Condition, TimeoutError, sleep, wait_for
+from io import BufferedIOBase, RawIOBase, TextIOBase
+from time import monotonic
+from typing import AsyncGenerator, AsyncIterator, cast
+
+from pydantic import BaseModel
+from sbilifeco.boundaries.llm import ILLM, LLMRequest
+from sbilifeco.boundaries.llm_metrics import LLMMetrics
+from sbilifeco.boundaries.material_reader import BaseMaterialReader
+from sbilifeco.models.base import Response
+from sbilifeco.gateways.vertex_tracked_stream import TrackedStream
+
+
+class AdmissionMetrics(BaseModel):
+    admitted: int = 0
+    rejected: int = 0
+    """Calls turned away because they could not be admitted before the deadline."""
+
+    rate_limited: int = 0
+    """Calls that Vertex answered with a 429 / RESOURCE_EXHAUSTED."""
+
+    in_flight: int = 0
+    concurrency_limit: float = 0.0
+    """Current adaptive limit on calls in flight."""
+
+
+class AdmissionRejected(Exception):
+    """Raised when a call cannot be admitted before its deadline."""
+
+
+class TokenBucket:
+    """Admits calls at a steady rate with bursts of up to `burst` calls."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated_at = monotonic()
+
+    async def acquire(self, deadline: float) -> None:
+        if self.rate <= 0:
+            return
+
+        while True:
+            now = monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                raise AdmissionRejected(
+                    f"Request rate is above {self.rate} per second"
+                )
+            await sleep(wait)
+
+
+class AdaptiveConcurrencyLimit:
+    """A limit on calls in flight, adjusted by additive increase / multiplicative decrease.
+
+    Every call that completes in good time raises the limit by `1 / limit`,
+    so about one per round of calls. A rate-limited call, or one much slower
+    than the running average, cuts the limit by `backoff`, but only once per
+    average latency: the calls in flight at the time of a cut report the same
+    overload as they end, and are not taken for fresh signs of it.
+    """
+
+    def __init__(self) -> None:
+        self.limit = 16.0
+        self.min_limit = 1
+        self.max_limit = 256
+        self.backoff = 0.5
+        self.latency_tolerance = 2.0
+        self.average_latency = 0.0
+        self.decreased_at = 0.0
+        self.in_flight = 0
+        self.changed = Condition()
+
+    async def acquire(self, deadline: float) -> None:
+        async with self.changed:
+            try:
+                await wait_for(
+                    self.changed.wait_for(lambda: self.in_flight < int(self.limit)),
+                    max(0.0, deadline - monotonic()),
+                )
+            except TimeoutError:
+                raise AdmissionRejected(
+                    f"{self.in_flight} calls are in flight, limit is {int(self.limit)}"
+                )
+            self.in_flight += 1
+
+    async def release(self, latency: float | None, is_rate_limited: bool) -> None:
+        if is_rate_limited:
+            self._decrease()
+        elif latency is not None:
+            is_outlier = (
+                self.average_latency > 0
+                and latency > self.average_latency * self.latency_tolerance
+            )
+            self.average_latency = (
+                latency
+                if self.average_latency == 0
+                else 0.9 * self.average_latency + 0.1 * latency
+            )
+            if is_outlier:
+                self._decrease()
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+        async with self.changed:
+            self.in_flight -= 1
+            self.changed.notify_all()
+
+    def _decrease(self) -> None:
+        # A second until the first latency is known
+        window = self.average_latency or 1.0
+        now = monotonic()
+        if now - self.decreased_at < window:
+            return
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        self.decreased_at = now
+
+
+class AdmissionControlledLLM(ILLM, BaseMaterialReader):
+    """Admits calls to one LLM gateway at a sustainable rate and concurrency.
+
+    A call first takes a token from the gateway's bucket and then a slot under
+    the adaptive concurrency limit. Calls wait for both up to `max_wait`
+    seconds and are otherwise answered with a 503 at once, so a burst near
+    quota is smoothed out instead of being retried in a storm. Streams hold
+    their slot until they end; their latency is the time to the first chunk.
+
+    Quota is per region and model, so each gateway gets an instance of its
+    own, and a router spreads calls over the admitted gateways. Material
+    reads are admitted too, as they are the heaviest calls: `read_and_chunk`
+    holds its slot until its chunks end, and `read_material` while the
+    material is opened. Their durations depend on the material's size, so
+    they are not taken as latency samples.
+    """
+
+    def __init__(self) -> None:
+        BaseMaterialReader.__init__(self)
+        self.llm: ILLM
+        self.rate = 0.0
+        self.burst = 10
+        self.max_wait = 10.0
+        self.bucket: TokenBucket | None = None
+        self.concurrency = AdaptiveConcurrencyLimit()
+        self.counters = AdmissionMetrics()
+        self.wait_metrics = LLMMetrics()
+
+    def set_llm(self, llm: ILLM) -> AdmissionControlledLLM:
+        self.llm = llm
+        return self
+
+    def set_rate(self, rate: float) -> AdmissionControlledLLM:
+        """Calls per second. 0 does not limit the rate."""
+        self.rate = rate
+        return self
+
+    def set_burst(self, burst: int) -> AdmissionControlledLLM:
+        self.burst = burst
+        return self
+
+    def set_max_wait(self, max_wait: float) -> AdmissionControlledLLM:
+        self.max_wait = max_wait
+        return self
+
+    def set_initial_concurrency(self, concurrency: int) -> AdmissionControlledLLM:
+        self.concurrency.limit = float(concurrency)
+        return self
+
+    def set_min_concurrency(self, concurrency: int) -> AdmissionControlledLLM:
+        self.concurrency.min_limit = max(1, concurrency)
+        return self
+
+    def set_max_concurrency(self, concurrency: int) -> AdmissionControlledLLM:
+        self.concurrency.max_limit = concurrency
+        return self
+
+    def set_latency_tolerance(self, tolerance: float) -> AdmissionControlledLLM:
+        """How many times slower than average a call may be before the limit is cut."""
+        self.concurrency.latency_tolerance = tolerance
+        return self
+
+    def set_metrics(self, metrics: LLMMetrics) -> AdmissionControlledLLM:
+        """Where the time calls wait for admission, and the admission counters, are recorded."""
+        self.wait_metrics = metrics
+        return self
+
+    @property
+    def region(self) -> str:
+        return getattr(self.llm, "region", "")
+
+    @property
+    def model(self) -> str:
+        return getattr(self.llm, "model", "")
+
+    @property
+    def max_output_tokens(self) -> int | None:
+        return getattr(self.llm, "max_output_tokens", None)
+
+    async def async_init(self) -> None:
+        labels = {"model": self.model, "region": self.region}
+        for name, help, read in [
+            (
+                "llm_admission_admitted_total",
+                "Calls let through admission control.",
+                lambda: self.counters.admitted,
+            ),
+            (
+                "llm_admission_rejected_total",
+                "Calls turned away because they could not be admitted before the deadline.",
+                lambda: self.counters.rejected,
+            ),
+            (
+                "llm_admission_rate_limited_total",
+                "Calls that Vertex answered with a 429 / RESOURCE_EXHAUSTED.",
+                lambda: self.counters.rate_limited,
+            ),
+        ]:
+            self.wait_metrics.add_counter(name, help, read, **labels)
+        self.wait_metrics.add_gauge(
+            "llm_admission_in_flight",
+            "Calls admitted and not yet done.",
+            lambda: self.concurrency.in_flight,
+            **labels,
+        ).add_gauge(
+            "llm_admission_concurrency_limit",
+            "Current adaptive limit on calls in flight.",
+            lambda: self.concurrency.limit,
+            **labels,
+        )
+        await getattr(self.llm, "async_init")()
+
+    async def async_shutdown(self) -> None:
+        await getattr(self.llm, "async_shutdown")()
+
+    async def generate_reply(self, context: str) -> Response[str]:
+        try:
+            await self._admit("generate_reply")
+        except AdmissionRejected as e:
+            return Response.fail(str(e), 503)
+
+        started_at = monotonic()
+        response: Response[str] | None = None
+        try:
+            response = await self.llm.generate_reply(context)
+            return response
+        finally:
+            await self._release(
+                monotonic() - started_at if response and response.is_success else None,
+                response is not None and response.code == 429,
+            )
+
+    async def generate_streamed_reply(
+        self, request: LLMRequest
+    ) -> Response[AsyncGenerator[str, None]]:
+        try:
+            await self._admit("generate_streamed_reply")
+        except AdmissionRejected as e:
+            return Response.fail(str(e), 503)
+
+        started_at = monotonic()
+        try:
+            response = await self.llm.generate_streamed_reply(request)
+        except BaseException:
+            await self._release(None, False)
+            raise
+
+        if not response.is_success or response.payload is None:
+            await self._release(None, response.code == 429)
+            return response
+
+        return Response.ok(
+            TrackedStream(
+                response.payload,
+                on_close=lambda time_to_first_chunk: self._release(
+                    time_to_first_chunk, False
+                ),
+                started_at=started_at,
+            )
+        )
+
+    async def read_and_chunk(
+        self,
+        material: str | bytes | bytearray | RawIOBase | BufferedIOBase | TextIOBase,
+    ) -> Response[AsyncIterator[str | bytes]]:
+        try:
+            await self._admit("read_and_chunk")
+        except AdmissionRejected as e:
+            return Response.fail(str(e), 503)
+
+        try:
+            response = await cast(BaseMaterialReader, self.llm).read_and_chunk(material)
+        except BaseException:
+            await self._release(None, False)
+            raise
+
+        if not response.is_success or response.payload is None:
+            await self._release(None, response.code == 429)
+            return response
+
+        return Response.ok(
+            TrackedStream(
+                response.payload,  # type: ignore[arg-type]
+                on_close=lambda _: self._release(None, False),
+            )
+        )
+
+    async def read_material(
+        self,
+        material: str | bytes | bytearray | RawIOBase | BufferedIOBase | TextIOBase,
+    ) -> Response[str]:
+        try:
+            await self._admit("read_material")
+        except AdmissionRejected as e:
+            return Response.fail(str(e), 503)
+
+        response: Response[str] | None = None
+        try:
+            response = await cast(BaseMaterialReader, self.llm).read_material(material)
+            return response
+        finally:
+            await self._release(None, response is not None and response.code == 429)
+
+    async def read_next_chunk(
+        self, material_id: str
+    ) -> Response[str | bytes | bytearray]:
+        return await cast(BaseMaterialReader, self.llm).read_next_chunk(material_id)
+
+    def metrics(self) -> AdmissionMetrics:
+        return self.counters.model_copy(
+            update={
+                "in_flight": self.concurrency.in_flight,
+                "concurrency_limit": self.concurrency.limit,
+            }
+        )
+
+    async def _admit(self, route: str) -> None:
+        arrived_at = monotonic()
+        deadline = arrived_at + self.max_wait
+        if self.bucket is None:
+            self.bucket = TokenBucket(self.rate, self.burst)
+
+        try:
+            await self.bucket.acquire(deadline)
+            await self.concurrency.acquire(deadline)
+        except AdmissionRejected:
+            self.counters.rejected += 1
+            raise
+        self.counters.admitted += 1
+        self.wait_metrics.admission_wait.observe(
+            route, self.model, monotonic() - arrived_at
+        )
+
+    async def _release(self, latency: float | None, is_rate_limited: bool) -> None:
+        if is_rate_limited:
+            self.counters.rate_limited += 1
+        await self.concurrency.release(latency, is_rate_limited)
@@ -0,0 +1,339 @@
+from __future__ import annotations
+
+from asyncio import get_running_loop, sleep
+from json import dumps, loads
+from time import monotonic
+from typing import Any, AsyncGenerator
+from urllib.parse import quote
+from uuid import uuid4
+
+import google.auth
+import google.auth.transport.requests
+from google.genai import types
+from google.genai.types import GenerateContentResponse, JobState
+from httpx import AsyncClient
+from sbilifeco.gateways.vertex_chunking_jobs import ChunkingCheckpoint
+from sbilifeco.gateways.vertex_gemini import VertexGemini
+from sbilifeco.gateways.vertex_material_source import MaterialSource
+
+
+class CloudStorage:
+    """The few Cloud Storage calls batch prediction needs, over the JSON API.
+
+    Calls share one pooled HTTP client, opened on first use.
+    """
+
+    SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+    API = "https://storage.googleapis.com"
+
+    def __init__(self) -> None:
+        self.credentials: Any = None
+        self.timeout = 300.0
+        self.transport: AsyncClient | None = None
+
+    async def async_shutdown(self) -> None:
+        if self.transport:
+            await self.transport.aclose()
+            self.transport = None
+
+    @staticmethod
+    def split(uri: str) -> tuple[str, str]:
+        """Bucket and object name of a gs:// URI."""
+        bucket, _, name = uri.removeprefix("gs://").partition("/")
+        return bucket, name
+
+    async def upload(self, uri: str, data: bytes, mime: str) -> None:
+        bucket, name = self.split(uri)
+        response = await self._transport().post(
+            f"{self.API}/upload/storage/v1/b/{bucket}/o",
+            params={"uploadType": "media", "name": name},
+            content=data,
+            headers={**await self._headers(), "Content-Type": mime},
+        )
+        response.raise_for_status()
+
+    async def list(self, uri: str) -> list[str]:
+        bucket, prefix = self.split(uri)
+        names: list[str] = []
+        page_token: str | None = None
+
+        while True:
+            params = {"prefix": prefix}
+            if page_token:
+                params["pageToken"] = page_token
+            response = await self._transport().get(
+                f"{self.API}/storage/v1/b/{bucket}/o",
+                params=params,
+                headers=await self._headers(),
+            )
+            response.raise_for_status()
+            listing = response.json()
+
+            names += [
+                f"gs://{bucket}/{item['name']}" for item in listing.get("items", [])
+            ]
+            page_token = listing.get("nextPageToken")
+            if not page_token:
+                return names
+
+    async def download(self, uri: str) -> bytes:
+        bucket, name = self.split(uri)
+        response = await self._transport().get(
+            f"{self.API}/storage/v1/b/{bucket}/o/{quote(name, safe='')}",
+            params={"alt": "media"},
+            headers=await self._headers(),
+        )
+        response.raise_for_status()
+        return response.content
+
+    def _transport(self) -> AsyncClient:
+        if self.transport is None:
+            self.transport = AsyncClient(timeout=self.timeout)
+        return self.transport
+
+    async def _headers(self) -> dict[str, str]:
+        return {
+            "Authorization": f"Bearer {await get_running_loop().run_in_executor(None, self._token)}"
+        }
+
+    def _token(self) -> str:
+        if self.credentials is None:
+            self.credentials, _ = google.auth.default(scopes=self.SCOPES)
+        if not self.credentials.valid:
+            self.credentials.refresh(google.auth.transport.requests.Request())
+        return self.credentials.token
+
+
+class VertexBatchChunkingBackend:
+    """Chunks many documents with one Vertex AI batch prediction job.
+
+    Batch prediction costs less than online calls and does not count against
+    the online quota, but takes minutes to hours. The documents and a JSON
+    lines file of requests are written under `staging_uri` in Cloud Storage,
+    and the predictions are read back from there once the job has ended.
+    Requests match the gateway's online chunking calls, and replies are cut
+    into chunks by the gateway the same way, so both give the same chunks.
+    The batch job and its staging location are saved with the chunking job as
+    soon as the batch job is created, so a restart waits for that batch job
+    instead of submitting the documents again, and cancelling the chunking
+    job cancels the batch job too.
+    """
+
+    TERMINAL_STATES = (
+        JobState.JOB_STATE_SUCCEEDED,
+        JobState.JOB_STATE_PARTIALLY_SUCCEEDED,
+        JobState.JOB_STATE_FAILED,
+        JobState.JOB_STATE_CANCELLED,
+        JobState.JOB_STATE_EXPIRED,
+    )
+
+    def __init__(self) -> None:
+        self.gateway: VertexGemini
+        self.staging_uri = ""
+        self.poll_interval = 30.0
+        self.max_wait = 24 * 3600.0
+        self.storage = CloudStorage()
+
+    def set_gateway(self, gateway: VertexGemini) -> VertexBatchChunkingBackend:
+        """Gemini gateway whose model, clients and chunking the batch job uses."""
+        self.gateway = gateway
+        return self
+
+    def set_staging_uri(self, staging_uri: str) -> VertexBatchChunkingBackend:
+        """gs://bucket/prefix under which documents, requests and predictions are kept."""
+        self.staging_uri = staging_uri.rstrip("/")
+        return self
+
+    def set_poll_interval(self, poll_interval: float) -> VertexBatchChunkingBackend:
+        self.poll_interval = poll_interval
+        return self
+
+    def set_max_wait(self, max_wait: float) -> VertexBatchChunkingBackend:
+        self.max_wait = max_wait
+        return self
+
+    def set_storage(self, storage: CloudStorage) -> VertexBatchChunkingBackend:
+        self.storage = storage
+        return self
+
+    async def async_shutdown(self) -> None:
+        await self.storage.async_shutdown()
+
+    async def chunk_many(
+        self, sources: list[tuple[int, str]], checkpoint: ChunkingCheckpoint
+    ) -> AsyncGenerator[tuple[int, list[str] | Exception], None]:
+        job_name = checkpoint.state.get("batch_job")
+        run_uri = checkpoint.state.get("run_uri")
+        document_uris: dict[str, int] = {}
+
+        if job_name and run_uri:
+            print(f"Resuming batch prediction job {job_name}", flush=True)
+            document_uris = {
+                f"{run_uri}/documents/{index}": index for index, _ in sources
+            }
+        else:
+            run_uri = f"{self.staging_uri}/{uuid4().hex}"
+            requests: list[str] = []
+
+            for index, source in sources:
+                try:
+                    document_uri = f"{run_uri}/documents/{index}"
+                    mime = await self._stage(source, document_uri)
+                    document_uris[document_uri] = index
+                    requests.append(
+                        dumps({"request": self._request(document_uri, mime)})
+                    )
+                except Exception as e:
+                    yield index, e
+
+            if not requests:
+                return
+
+            await self.storage.upload(
+                f"{run_uri}/requests.jsonl",
+                "\n".join(requests).encode("utf-8"),
+                "application/jsonl",
+            )
+            job_name = await self._create_job(
+                f"{run_uri}/requests.jsonl", f"{run_uri}/predictions"
+            )
+            await checkpoint.save(batch_job=job_name, run_uri=run_uri)
+
+        job = await self._wait_for_job(job_name)
+
+        if job.state not in (
+            JobState.JOB_STATE_SUCCEEDED,
+            JobState.JOB_STATE_PARTIALLY_SUCCEEDED,
+        ):
+            error = RuntimeError(
+                f"Batch prediction job {job.name} ended as {job.state}: {job.error}"
+            )
+            for index in document_uris.values():
+                yield index, error
+            return
+
+        for output_uri in await self.storage.list(f"{run_uri}/predictions"):
+            if not output_uri.endswith(".jsonl"):
+                continue
+
+            for line in (await self.storage.download(output_uri)).splitlines():
+                if not line.strip():
+                    continue
+
+                prediction = loads(line)
+                index = document_uris.pop(self._document_uri(prediction), None)
+                if index is not None:
+                    yield index, await self._chunks(prediction)
+
+        for index in document_uris.values():
+            yield index, RuntimeError(
+                "The batch prediction job returned no prediction for it"
+            )
+
+    async def _stage(self, source: str, document_uri: str) -> str:
+        material = await self.gateway.downloader.resolve(source)
+        material_source = await self.gateway.executor.run(
+            MaterialSource.open, material, text_as_bytes=True
+        )
+        if material_source is None:
+            raise ValueError("Unsupported source material")
+
+        try:
+            mime = await self.gateway.executor.run(material_source.mime)
+            data = await self.gateway.executor.run(material_source.as_bytes)
+        finally:
+            material_source.close()
+
+        mime = mime or "application/pdf"
+        await self.storage.upload(document_uri, data, mime)
+        return mime
+
+    async def cancel(self, checkpoint: ChunkingCheckpoint) -> None:
+        job_name = checkpoint.state.get("batch_job")
+        if job_name:
+            await self._cancel_job(job_name)
+
+    def _request(self, document_uri: str, mime: str) -> dict:
+        return {
+            "contents": [
+                {
+                    "role": "user",
+                    "parts": [
+                        {"fileData": {"fileUri": document_uri, "mimeType": mime}}
+                    ],
+                }
+            ],
+            "generationConfig": {
+                "temperature": 0.0,
+                "maxOutputTokens": self.gateway.max_output_tokens,
+            },
+        }
+
+    def _document_uri(self, prediction: dict) -> str:
+        try:
+            return prediction["request"]["contents"][0]["parts"][0]["fileData"][
+                "fileUri"
+            ]
+        except (KeyError, IndexError):
+            return ""
+
+    async def _create_job(self, requests_uri: str, predictions_uri: str) -> str:
+        vertex_client = self.gateway.clients.acquire()
+        try:
+            job = await vertex_client.aio.batches.create(
+                model=self.gateway.model,
+                src=requests_uri,
+                config=types.CreateBatchJobConfig(dest=predictions_uri),
+            )
+            print(f"Started batch prediction job {job.name}", flush=True)
+            return job.name or ""
+        finally:
+            await self.gateway.clients.release(vertex_client)
+
+    async def _wait_for_job(self, job_name: str) -> types.BatchJob:
+        """The batch job once it has ended, however long ago it was started.
+
+        The wait is limited to `max_wait` from now, as a resumed job's start
+        is not known. A client is leased only for each poll, not for the
+        hours between them.
+        """
+        job = await self._get_job(job_name)
+
+        deadline = monotonic() + self.max_wait
+        while job.state not in self.TERMINAL_STATES:
+            if monotonic() > deadline:
+                await self._cancel_job(job_name)
+                raise TimeoutError(
+                    f"Batch prediction job {job_name} did not end in {self.max_wait}s"
+                )
+            await sleep(self.poll_interval)
+            job = await self._get_job(job_name)
+
+        print(f"Batch prediction job {job.name} ended as {job.state}", flush=True)
+        return job
+
+    async def _get_job(self, job_name: str) -> types.BatchJob:
+        vertex_client = self.gateway.clients.acquire()
+        try:
+            return await vertex_client.aio.batches.get(name=job_name)
+        finally:
+            await self.gateway.clients.release(vertex_client)
+
+    async def _cancel_job(self, job_name: str) -> None:
+        vertex_client = self.gateway.clients.acquire()
+        try:
+            await vertex_client.aio.batches.cancel(name=job_name)
+            print(f"Cancelled batch prediction job {job_name}", flush=True)
+        finally:
+            await self.gateway.clients.release(vertex_client)
+
+    async def _chunks(self, prediction: dict) -> list[str] | Exception:
+        if "response" not in prediction:
+            return RuntimeError(prediction.get("status") or "No response in prediction")
+
+        async def replies():
+            yield GenerateContentResponse.model_validate(prediction["response"])
+
+        return [
+            chunk async for chunk in self.gateway._fetch_next_chunk(replies()) if chunk
+        ]
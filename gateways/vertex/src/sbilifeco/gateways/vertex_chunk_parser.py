@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+from typing import AsyncGenerator, AsyncIterator
+
+
+class DelimitedChunkParser:
+    """Cuts streamed model text into the chunks between delimiters, as it arrives.
+
+    Text is held as a list of pieces and joined once per chunk. Only each new
+    piece is searched for the delimiter, together with the few characters
+    before it that a delimiter split across pieces could start in, so text
+    is never rescanned however long a chunk grows.
+    """
+
+    def __init__(self, delimiter: str = "#=====#") -> None:
+        self.delimiter = delimiter
+        self.pieces: list[str] = []
+        self.tail = ""
+
+    def feed(self, text: str) -> list[str]:
+        """Chunks completed by `text`, if any."""
+        chunks: list[str] = []
+        overlap = len(self.delimiter) - 1
+
+        while text:
+            window = self.tail + text
+            found = window.find(self.delimiter)
+            if found < 0:
+                self.pieces.append(text)
+                self.tail = window[-overlap:] if overlap else ""
+                break
+
+            buffered = "".join(self.pieces)
+            before = found - len(self.tail)
+            if before >= 0:
+                chunk = buffered + text[:before]
+            else:
+                chunk = buffered[: len(buffered) + before]
+
+            self._emit(chunk, chunks)
+            self.pieces, self.tail = [], ""
+            text = text[before + len(self.delimiter) :]
+
+        return chunks
+
+    def close(self) -> list[str]:
+        """The chunk after the last delimiter, if it has any text."""
+        chunks: list[str] = []
+        self._emit("".join(self.pieces), chunks)
+        self.pieces, self.tail = [], ""
+        return chunks
+
+    async def parse(
+        self, deltas: AsyncIterator[str | bytes]
+    ) -> AsyncGenerator[str, None]:
+        """Whole chunks of streamed text, each yielded as soon as its delimiter is seen."""
+        try:
+            async for delta in deltas:
+                text = delta if isinstance(delta, str) else bytes(delta).decode()
+                for chunk in self.feed(text):
+                    yield chunk
+            for chunk in self.close():
+                yield chunk
+        finally:
+            if isinstance(deltas, AsyncGenerator):
+                await deltas.aclose()
+
+    def _emit(self, chunk: str, chunks: list[str]) -> None:
+        chunk = chunk.strip()
+        if chunk:
+            chunks.append(chunk)
+
+
+class SizedChunkParser:
+    """Gathers streamed model text into chunks of at least `min_chunk_size` characters.
+
+    A chunk ends on the last paragraph break at or past the minimum size, or
+    failing that the last sentence end. Text with neither is cut at a space
+    once it is twice the minimum size. Only the text left over when the
+    stream closes may be shorter. Like `DelimitedChunkParser`, pieces are
+    joined once per chunk and only new text is scanned for breaks.
+    """
+
+    SENTENCE_ENDS = (". ", "? ", "! ", ".\n")
+
+    def __init__(self, min_chunk_size: int) -> None:
+        self.min_chunk_size = min_chunk_size
+        self.pieces: list[str] = []
+        self.size = 0
+        self.paragraph_end = -1
+        self.sentence_end = -1
+        self.space_end = -1
+
+    def feed(self, text: str) -> str | None:
+        """A chunk completed by `text`, if any."""
+        self._scan(text)
+        self.pieces.append(text)
+        self.size += len(text)
+        if self.size < self.min_chunk_size:
+            return None
+
+        cut = self._cut()
+        if cut <= 0:
+            return None
+
+        buffered = "".join(self.pieces)
+        rest = buffered[cut:].lstrip()
+        self.pieces, self.size = [], 0
+        self.paragraph_end = self.sentence_end = self.space_end = -1
+        if rest:
+            self._scan(rest)
+            self.pieces, self.size = [rest], len(rest)
+        return buffered[:cut]
+
+    def close(self) -> str:
+        """Whatever text is left, however short."""
+        rest = "".join(self.pieces)
+        self.pieces, self.size = [], 0
+        return rest
+
+    def _scan(self, text: str) -> None:
+        # Breaks are two characters, so one character before the new text is enough
+        previous = self.pieces[-1][-1:] if self.pieces else ""
+        window = previous + text
+        start = self.size - len(previous)
+
+        found = window.rfind("\n\n")
+        if found >= 0:
+            self.paragraph_end = start + found + 1
+        found = max(window.rfind(end) for end in self.SENTENCE_ENDS)
+        if found >= 0:
+            self.sentence_end = start + found + 1
+        found = window.rfind(" ")
+        if found >= 0:
+            self.space_end = start + found + 1
+
+    def _cut(self) -> int:
+        if self.paragraph_end >= self.min_chunk_size:
+            return self.paragraph_end
+        if self.sentence_end >= self.min_chunk_size:
+            return self.sentence_end
+        if self.size >= 2 * self.min_chunk_size:
+            return (
+                self.space_end if self.space_end >= self.min_chunk_size else self.size
+            )
+        return 0
@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+from asyncio import get_running_loop
+from collections.abc import AsyncGenerator
+from functools import partial
+from hashlib import sha256
+from json import dumps, loads
+from os import makedirs, remove, replace, scandir, utime
+from os.path import exists, join
+from time import time
+from typing import AsyncIterator, TextIO
+from uuid import uuid4
+
+
+class ChunkStore:
+    """Chunking results on local disk, addressed by what produced them.
+
+    A key is derived from the material's bytes, the model, the version of the
+    chunking prompt and the chunk size, so the same document read the same way
+    is only ever sent to the model once. Each entry is a JSON-lines file of
+    chunks, written under a temporary name and renamed into place only when
+    the model's stream completed and the model ended its reply itself, so
+    partial or truncated results are never served.
+    """
+
+    SUFFIX = ".jsonl"
+    PARTIAL_SUFFIX = ".partial"
+
+    NATURAL_ENDS = ("end_turn", "stop_sequence", "STOP")
+    """Finish reasons of replies the model ended itself, rather than cut off at the output limit."""
+
+    def __init__(self) -> None:
+        self.directory = "./.chunk-store"
+        self.max_bytes = 1024 * 1024 * 1024
+        self.max_age = 30 * 24 * 3600.0
+        self.partial_max_age = 24 * 3600.0
+
+    def set_directory(self, directory: str) -> ChunkStore:
+        self.directory = directory
+        return self
+
+    def set_max_bytes(self, max_bytes: int) -> ChunkStore:
+        self.max_bytes = max_bytes
+        return self
+
+    def set_max_age(self, max_age: float) -> ChunkStore:
+        self.max_age = max_age
+        return self
+
+    def set_partial_max_age(self, partial_max_age: float) -> ChunkStore:
+        """Seconds after which an entry still being written is taken for left behind by a crash."""
+        self.partial_max_age = partial_max_age
+        return self
+
+    async def async_init(self) -> None:
+        makedirs(self.directory, exist_ok=True)
+        await self.evict()
+
+    @staticmethod
+    def key(
+        material_digest: str, model: str, prompt_version: str, min_chunk_size: int
+    ) -> str:
+        parts = dumps([material_digest, model, prompt_version, min_chunk_size])
+        return sha256(parts.encode("utf-8")).hexdigest()
+
+    def has(self, key: str) -> bool:
+        return exists(self._path(key))
+
+    async def read(self, key: str) -> AsyncGenerator[str, None]:
+        loop = get_running_loop()
+        path = self._path(key)
+
+        # Reading counts as a use, so eviction by age treats the entry as fresh
+        await loop.run_in_executor(None, partial(utime, path))
+        f: TextIO = await loop.run_in_executor(
+            None, partial(open, path, "r", encoding="utf-8")
+        )
+        try:
+            while line := await loop.run_in_executor(None, f.readline):
+                yield loads(line)
+        finally:
+            f.close()
+
+    async def tee(
+        self, key: str, chunks: AsyncIterator[str], finish_reasons: list[str | None]
+    ) -> AsyncGenerator[str, None]:
+        """Yield `chunks` unchanged while storing them under `key`.
+
+        `finish_reasons` is filled in by the model streams behind `chunks` as
+        each one ends. The chunks are kept only if every stream ended
+        naturally. Closing the returned generator also closes `chunks`.
+        """
+        loop = get_running_loop()
+        partial_path = join(
+            self.directory, f"{key}.{uuid4().hex}{self.PARTIAL_SUFFIX}"
+        )
+        f: TextIO = await loop.run_in_executor(
+            None, partial(open, partial_path, "w", encoding="utf-8")
+        )
+        is_complete = False
+
+        try:
+            async for chunk in chunks:
+                await loop.run_in_executor(None, f.write, dumps(chunk) + "\n")
+                yield chunk
+            is_complete = bool(finish_reasons) and all(
+                reason in self.NATURAL_ENDS for reason in finish_reasons
+            )
+            if not is_complete:
+                print(
+                    f"Not storing chunks that ended with {finish_reasons}", flush=True
+                )
+        finally:
+            f.close()
+            if isinstance(chunks, AsyncGenerator):
+                await chunks.aclose()
+
+            if is_complete:
+                await loop.run_in_executor(
+                    None, replace, partial_path, self._path(key)
+                )
+                await self.evict()
+            else:
+                await loop.run_in_executor(None, remove, partial_path)
+
+    async def evict(self) -> None:
+        await get_running_loop().run_in_executor(None, self._evict)
+
+    def _evict(self) -> None:
+        now = time()
+        entries: list[tuple[float, int, str]] = []
+
+        # Other workers may be evicting or writing the same entries meanwhile
+        for entry in scandir(self.directory):
+            try:
+                if entry.name.endswith(self.PARTIAL_SUFFIX):
+                    if now - entry.stat().st_mtime > self.partial_max_age:
+                        remove(entry.path)
+                    continue
+                if not entry.name.endswith(self.SUFFIX):
+                    continue
+
+                stat = entry.stat()
+                if self.max_age and now - stat.st_mtime > self.max_age:
+                    remove(entry.path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                continue
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def _path(self, key: str) -> str:
+        return join(self.directory, key + self.SUFFIX)
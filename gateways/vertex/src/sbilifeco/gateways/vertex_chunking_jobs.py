@@ -0,0 +1,463 @@
+from __future__ import annotations
+
+from asyncio import (
+    CancelledError,
+    Condition,
+    Semaphore,
+    Task,
+    as_completed,
+    create_task,
+    get_running_loop,
+    sleep,
+    wait,
+)
+from functools import partial
+from json import dumps, loads
+from os import makedirs, replace, scandir
+from os.path import exists, join
+from shutil import rmtree
+from time import time
+from traceback import format_exc
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, Protocol
+from uuid import uuid4
+
+from sbilifeco.boundaries.chunking_jobs import (
+    ChunkingDocument,
+    ChunkingJob,
+    ChunkingJobStatus,
+    IChunkingJobs,
+)
+from sbilifeco.boundaries.material_reader import BaseMaterialReader
+from sbilifeco.gateways.vertex_chunk_parser import DelimitedChunkParser
+from sbilifeco.models.base import Response
+
+
+class ChunkingCheckpoint:
+    """Backend state kept in a job's state file, for a resumed job to carry on from."""
+
+    def __init__(
+        self, job: ChunkingJob, save: Callable[[ChunkingJob], Awaitable[None]]
+    ) -> None:
+        self.job = job
+        self._save = save
+
+    @property
+    def state(self) -> dict[str, str]:
+        """State saved by the last run of the job, empty on its first."""
+        return self.job.backend_state
+
+    async def save(self, **state: str) -> None:
+        self.job.backend_state.update(state)
+        await self._save(self.job)
+
+
+class IChunkingBackend(Protocol):
+    def chunk_many(
+        self, sources: list[tuple[int, str]], checkpoint: ChunkingCheckpoint
+    ) -> AsyncIterator[tuple[int, list[str] | Exception]]:
+        """Chunks of each `(index, source)` pair, or why it failed, in any order."""
+        raise NotImplementedError()
+
+    async def cancel(self, checkpoint: ChunkingCheckpoint) -> None:
+        """Stop work a cancelled job started outside this process, found from its saved state."""
+        raise NotImplementedError()
+
+
+class StreamingChunkingBackend:
+    """Chunks documents through `read_and_chunk`, a few at a time."""
+
+    def __init__(self) -> None:
+        self.reader: BaseMaterialReader
+        self.concurrency = 4
+        self.delimiter = ""
+
+    def set_reader(self, reader: BaseMaterialReader) -> StreamingChunkingBackend:
+        self.reader = reader
+        return self
+
+    def set_concurrency(self, concurrency: int) -> StreamingChunkingBackend:
+        self.concurrency = max(1, concurrency)
+        return self
+
+    def set_delimiter(self, delimiter: str) -> StreamingChunkingBackend:
+        """Delimiter to split the reader's text on, where it streams raw model text rather than chunks.
+
+        Text in which the delimiter never shows is taken as already chunked.
+        """
+        self.delimiter = delimiter
+        return self
+
+    async def chunk_many(
+        self, sources: list[tuple[int, str]], checkpoint: ChunkingCheckpoint
+    ) -> AsyncGenerator[tuple[int, list[str] | Exception], None]:
+        slots = Semaphore(self.concurrency)
+
+        async def chunk(index: int, source: str) -> tuple[int, list[str] | Exception]:
+            async with slots:
+                try:
+                    response = await self.reader.read_and_chunk(source)
+                    if not response.is_success or response.payload is None:
+                        return index, RuntimeError(response.message)
+
+                    texts = [
+                        chunk if isinstance(chunk, str) else bytes(chunk).decode()
+                        async for chunk in response.payload
+                        if chunk
+                    ]
+                    if self.delimiter and any(self.delimiter in text for text in texts):
+                        parser = DelimitedChunkParser(self.delimiter)
+                        chunks = [
+                            chunk for text in texts for chunk in parser.feed(text)
+                        ]
+                        return index, chunks + parser.close()
+                    return index, texts
+                except Exception as e:
+                    return index, e
+
+        tasks = [create_task(chunk(index, source)) for index, source in sources]
+        try:
+            for next_result in as_completed(tasks):
+                yield await next_result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def cancel(self, checkpoint: ChunkingCheckpoint) -> None:
+        # All the work is in chunk_many's tasks, cancelled along with it
+        pass
+
+
+class ChunkingJobs(IChunkingJobs):
+    """Bulk chunking jobs, run in the background and kept on local disk.
+
+    Submitting returns a job ID at once; the backend chunks the documents
+    meanwhile. Each job is a directory holding its state as JSON, replaced
+    atomically on every change, and the chunks of each finished document as
+    JSON lines. Jobs still unfinished at startup are picked up again, and
+    only their unfinished documents are chunked again, by a backend that is
+    given back whatever state it saved for the job. Finished jobs older than
+    `max_age` are removed at startup and every `sweep_interval` after.
+    """
+
+    STATE_FILE = "job.json"
+
+    def __init__(self) -> None:
+        self.directory = "./.chunking-jobs"
+        self.backend: IChunkingBackend
+        self.max_documents = 1000
+        self.max_age = 7 * 24 * 3600.0
+        self.sweep_interval = 3600.0
+        self.jobs: dict[str, ChunkingJob] = {}
+        self.runners: dict[str, Task] = {}
+        self.changed = Condition()
+        self.sweeper: Task | None = None
+
+    def set_directory(self, directory: str) -> ChunkingJobs:
+        self.directory = directory
+        return self
+
+    def set_backend(self, backend: IChunkingBackend) -> ChunkingJobs:
+        self.backend = backend
+        return self
+
+    def set_max_documents(self, max_documents: int) -> ChunkingJobs:
+        self.max_documents = max_documents
+        return self
+
+    def set_max_age(self, max_age: float) -> ChunkingJobs:
+        """Seconds a finished job is kept. 0 keeps jobs forever."""
+        self.max_age = max_age
+        return self
+
+    def set_sweep_interval(self, sweep_interval: float) -> ChunkingJobs:
+        """Seconds between checks for finished jobs past `max_age`."""
+        self.sweep_interval = sweep_interval
+        return self
+
+    async def async_init(self) -> None:
+        loop = get_running_loop()
+        await loop.run_in_executor(
+            None, partial(makedirs, self.directory, exist_ok=True)
+        )
+
+        for job in await loop.run_in_executor(None, self._load_all):
+            if self._is_expired(job):
+                await loop.run_in_executor(
+                    None, partial(rmtree, self._path(job.job_id), True)
+                )
+                continue
+
+            self.jobs[job.job_id] = job
+            if job.status not in ChunkingJobStatus.FINISHED:
+                print(f"Resuming chunking job {job.job_id}", flush=True)
+                self._start(job)
+
+        if self.max_age and self.sweeper is None:
+            self.sweeper = create_task(self._sweep_forever())
+
+    async def async_shutdown(self) -> None:
+        if self.sweeper:
+            self.sweeper.cancel()
+            try:
+                await self.sweeper
+            except CancelledError:
+                ...
+            self.sweeper = None
+
+        # Unfinished jobs stay as they are on disk and resume on the next start
+        runners = list(self.runners.values())
+        for runner in runners:
+            runner.cancel()
+        if runners:
+            await wait(runners)
+
+    async def submit_job(self, sources: list[str]) -> Response[ChunkingJob]:
+        try:
+            if not sources:
+                return Response.fail("A chunking job needs at least one document", 400)
+            if self.max_documents and len(sources) > self.max_documents:
+                return Response.fail(
+                    f"{len(sources)} documents is over the limit of {self.max_documents} per job",
+                    413,
+                )
+
+            now = time()
+            job = ChunkingJob(
+                job_id=uuid4().hex,
+                created_at=now,
+                updated_at=now,
+                documents=[
+                    ChunkingDocument(index=index, source=source)
+                    for index, source in enumerate(sources)
+                ],
+            )
+            await self._save(job)
+            self.jobs[job.job_id] = job
+
+            print(
+                f"Submitted chunking job {job.job_id} with {len(sources)} documents",
+                flush=True,
+            )
+            self._start(job)
+            return Response.ok(job.model_copy(deep=True))
+        except Exception as e:
+            return Response.error(e)
+
+    async def get_job(self, job_id: str) -> Response[ChunkingJob]:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return Response.fail(f"Unable to find chunking job {job_id}", 404)
+        return Response.ok(job.model_copy(deep=True))
+
+    async def watch_job(
+        self, job_id: str
+    ) -> Response[AsyncGenerator[ChunkingJob, None]]:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return Response.fail(f"Unable to find chunking job {job_id}", 404)
+
+        async def watch() -> AsyncGenerator[ChunkingJob, None]:
+            seen_at = -1.0
+            while True:
+                async with self.changed:
+                    await self.changed.wait_for(lambda: job.updated_at != seen_at)
+                    seen_at = job.updated_at
+                    snapshot = job.model_copy(deep=True)
+
+                yield snapshot
+                if snapshot.status in ChunkingJobStatus.FINISHED:
+                    return
+
+        return Response.ok(watch())
+
+    async def read_job_chunks(self, job_id: str, index: int) -> Response[list[str]]:
+        try:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return Response.fail(f"Unable to find chunking job {job_id}", 404)
+            if not 0 <= index < len(job.documents):
+                return Response.fail(
+                    f"Chunking job {job_id} has no document {index}", 404
+                )
+
+            document = job.documents[index]
+            if document.status != ChunkingJobStatus.SUCCEEDED:
+                return Response.fail(
+                    f"Document {index} of chunking job {job_id} is {document.status}",
+                    409,
+                )
+
+            return Response.ok(
+                await get_running_loop().run_in_executor(
+                    None, self._read_chunks, job_id, index
+                )
+            )
+        except Exception as e:
+            return Response.error(e)
+
+    async def cancel_job(self, job_id: str) -> Response[ChunkingJob]:
+        try:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return Response.fail(f"Unable to find chunking job {job_id}", 404)
+            if job.status in ChunkingJobStatus.FINISHED:
+                return Response.ok(job.model_copy(deep=True))
+
+            runner = self.runners.get(job_id)
+            if runner:
+                runner.cancel()
+                await wait({runner})
+
+            try:
+                await self.backend.cancel(ChunkingCheckpoint(job, self._save))
+            except Exception as e:
+                print(
+                    f"Unable to cancel the backend's work for chunking job {job_id}: {e}",
+                    flush=True,
+                )
+
+            for document in job.documents:
+                if document.status not in ChunkingJobStatus.FINISHED:
+                    document.status = ChunkingJobStatus.CANCELLED
+            job.status = ChunkingJobStatus.CANCELLED
+            await self._update(job)
+            return Response.ok(job.model_copy(deep=True))
+        except Exception as e:
+            return Response.error(e)
+
+    def _start(self, job: ChunkingJob) -> None:
+        runner = create_task(self._run(job))
+        self.runners[job.job_id] = runner
+        runner.add_done_callback(lambda _: self.runners.pop(job.job_id, None))
+
+    async def _run(self, job: ChunkingJob) -> None:
+        loop = get_running_loop()
+        try:
+            pending = [
+                document
+                for document in job.documents
+                if document.status not in ChunkingJobStatus.FINISHED
+            ]
+            for document in pending:
+                document.status = ChunkingJobStatus.RUNNING
+            job.status = ChunkingJobStatus.RUNNING
+            await self._update(job)
+
+            results = self.backend.chunk_many(
+                [(document.index, document.source) for document in pending],
+                ChunkingCheckpoint(job, self._save),
+            )
+            async for index, chunks in results:
+                document = job.documents[index]
+                if isinstance(chunks, Exception):
+                    print(
+                        f"Chunking document {index} of job {job.job_id} failed: {chunks}",
+                        flush=True,
+                    )
+                    document.status = ChunkingJobStatus.FAILED
+                    document.error = str(chunks)
+                else:
+                    await loop.run_in_executor(
+                        None, self._write_chunks, job.job_id, index, chunks
+                    )
+                    document.status = ChunkingJobStatus.SUCCEEDED
+                    document.chunks = len(chunks)
+                await self._update(job)
+
+            for document in job.documents:
+                if document.status not in ChunkingJobStatus.FINISHED:
+                    document.status = ChunkingJobStatus.FAILED
+                    document.error = "The backend returned no result for it"
+
+            job.status = (
+                ChunkingJobStatus.SUCCEEDED
+                if all(
+                    document.status == ChunkingJobStatus.SUCCEEDED
+                    for document in job.documents
+                )
+                else ChunkingJobStatus.FAILED
+            )
+            await self._update(job)
+            print(f"Chunking job {job.job_id} {job.status}", flush=True)
+        except Exception as e:
+            print(f"Chunking job {job.job_id} failed: {e}", flush=True)
+            print(format_exc(), flush=True)
+            for document in job.documents:
+                if document.status not in ChunkingJobStatus.FINISHED:
+                    document.status = ChunkingJobStatus.FAILED
+                    document.error = str(e)
+            job.status = ChunkingJobStatus.FAILED
+            await self._update(job)
+
+    async def _update(self, job: ChunkingJob) -> None:
+        job.updated_at = time()
+        await self._save(job)
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def _save(self, job: ChunkingJob) -> None:
+        await get_running_loop().run_in_executor(None, self._write_state, job)
+
+    def _write_state(self, job: ChunkingJob) -> None:
+        makedirs(self._path(job.job_id), exist_ok=True)
+        path = join(self._path(job.job_id), self.STATE_FILE)
+        with open(path + ".partial", "w", encoding="utf-8") as f:
+            f.write(job.model_dump_json())
+        replace(path + ".partial", path)
+
+    def _write_chunks(self, job_id: str, index: int, chunks: list[str]) -> None:
+        path = join(self._path(job_id), f"{index}.jsonl")
+        with open(path + ".partial", "w", encoding="utf-8") as f:
+            for chunk in chunks:
+                f.write(dumps(chunk) + "\n")
+        replace(path + ".partial", path)
+
+    def _read_chunks(self, job_id: str, index: int) -> list[str]:
+        with open(
+            join(self._path(job_id), f"{index}.jsonl"), "r", encoding="utf-8"
+        ) as f:
+            return [loads(line) for line in f if line.strip()]
+
+    def _load_all(self) -> list[ChunkingJob]:
+        jobs: list[ChunkingJob] = []
+        for entry in scandir(self.directory):
+            path = join(entry.path, self.STATE_FILE)
+            if not entry.is_dir() or not exists(path):
+                continue
+
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    jobs.append(ChunkingJob.model_validate_json(f.read()))
+            except Exception as e:
+                print(f"Skipping unreadable chunking job in {entry.path}: {e}")
+        return jobs
+
+    async def remove_expired(self) -> None:
+        loop = get_running_loop()
+        for job in list(self.jobs.values()):
+            if not self._is_expired(job):
+                continue
+
+            print(f"Removing expired chunking job {job.job_id}", flush=True)
+            self.jobs.pop(job.job_id, None)
+            await loop.run_in_executor(
+                None, partial(rmtree, self._path(job.job_id), True)
+            )
+
+    async def _sweep_forever(self) -> None:
+        while True:
+            await sleep(self.sweep_interval)
+            try:
+                await self.remove_expired()
+            except Exception as e:
+                print(f"Unable to remove expired chunking jobs: {e}", flush=True)
+
+    def _is_expired(self, job: ChunkingJob) -> bool:
+        return (
+            bool(self.max_age)
+            and job.status in ChunkingJobStatus.FINISHED
+            and time() - job.updated_at > self.max_age
+        )
+
+    def _path(self, job_id: str) -> str:
+        return join(self.directory, job_id)
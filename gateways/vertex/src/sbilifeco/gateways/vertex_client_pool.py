@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+from asyncio import CancelledError, Task, create_task, sleep
+from contextlib import asynccontextmanager
+from time import monotonic
+from traceback import format_exc
+from typing import AsyncIterator, Awaitable, Callable, Generic, TypeVar
+
+ClientT = TypeVar("ClientT")
+
+
+class _PooledClient(Generic[ClientT]):
+    def __init__(self, client: ClientT) -> None:
+        self.client = client
+        self.created_at = monotonic()
+        self.in_use = 0
+        self.retired = False
+
+
+class VertexClientPool(Generic[ClientT]):
+    """A fixed-size set of long-lived Vertex SDK clients.
+
+    Clients are created once in `start` and handed out to callers with `lease`
+    (or `acquire` / `release` when the client must outlive a single block, as
+    with streams). Each lease goes to the least busy client, so concurrent calls
+    share the clients' warm connections instead of opening new ones.
+
+    Clients that fail their health check, or that a caller reports with
+    `discard`, are replaced. A replaced client is closed only once its last
+    lease is released, so streams in flight are never cut off.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], ClientT],
+        closer: Callable[[ClientT], Awaitable[None]],
+    ) -> None:
+        self.factory = factory
+        self.closer = closer
+        self.size = 4
+        self.max_client_age = 0.0
+        self.health_check: Callable[[ClientT], Awaitable[bool]] | None = None
+        self.health_check_interval = 60.0
+        self.slots: list[_PooledClient[ClientT]] = []
+        self.retired: list[_PooledClient[ClientT]] = []
+        self.health_check_task: Task | None = None
+        self.closing: set[Task] = set()
+
+    def set_size(self, size: int) -> VertexClientPool[ClientT]:
+        self.size = max(1, size)
+        return self
+
+    def set_max_client_age(self, max_client_age: float) -> VertexClientPool[ClientT]:
+        """Recycle clients older than this many seconds. 0 keeps them forever."""
+        self.max_client_age = max_client_age
+        return self
+
+    def set_health_check(
+        self, health_check: Callable[[ClientT], Awaitable[bool]]
+    ) -> VertexClientPool[ClientT]:
+        self.health_check = health_check
+        return self
+
+    def set_health_check_interval(
+        self, health_check_interval: float
+    ) -> VertexClientPool[ClientT]:
+        self.health_check_interval = health_check_interval
+        return self
+
+    async def start(self) -> None:
+        print(f"Warming up a pool of {self.size} Vertex AI clients", flush=True)
+        self.slots = [_PooledClient(self.factory()) for _ in range(self.size)]
+
+        if self.health_check_interval > 0:
+            self.health_check_task = create_task(self._check_health_forever())
+
+    async def stop(self) -> None:
+        print("Closing the pool of Vertex AI clients", flush=True)
+        if self.health_check_task:
+            self.health_check_task.cancel()
+            try:
+                await self.health_check_task
+            except CancelledError:
+                ...
+            self.health_check_task = None
+
+        for slot in self.slots + self.retired:
+            await self._close(slot)
+        self.slots = []
+        self.retired = []
+
+    def acquire(self) -> ClientT:
+        if not self.slots:
+            raise RuntimeError("Vertex client pool is not started")
+
+        slot = min(self.slots, key=lambda s: s.in_use)
+        if self.max_client_age and monotonic() - slot.created_at > self.max_client_age:
+            slot = self._replace(slot)
+
+        slot.in_use += 1
+        return slot.client
+
+    async def release(self, client: ClientT) -> None:
+        slot = self._find(client)
+        if slot is None:
+            return
+
+        slot.in_use = max(0, slot.in_use - 1)
+        if slot.retired and slot.in_use == 0:
+            self.retired.remove(slot)
+            await self._close(slot)
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[ClientT]:
+        client = self.acquire()
+        try:
+            yield client
+        finally:
+            await self.release(client)
+
+    def discard(self, client: ClientT) -> None:
+        """Replace a client that is known to be broken, e.g. after a connection error."""
+        slot = self._find(client)
+        if slot is not None and not slot.retired:
+            self._replace(slot)
+
+    @property
+    def leases(self) -> int:
+        return sum(slot.in_use for slot in self.slots + self.retired)
+
+    def _find(self, client: ClientT) -> _PooledClient[ClientT] | None:
+        for slot in self.slots + self.retired:
+            if slot.client is client:
+                return slot
+        return None
+
+    def _replace(self, slot: _PooledClient[ClientT]) -> _PooledClient[ClientT]:
+        fresh = _PooledClient(self.factory())
+        self.slots[self.slots.index(slot)] = fresh
+
+        slot.retired = True
+        if slot.in_use:
+            self.retired.append(slot)
+        else:
+            task = create_task(self._close(slot))
+            self.closing.add(task)
+            task.add_done_callback(self.closing.discard)
+
+        return fresh
+
+    async def _close(self, slot: _PooledClient[ClientT]) -> None:
+        try:
+            await self.closer(slot.client)
+        except Exception as e:
+            print(f"Error closing pooled Vertex AI client: {e}", flush=True)
+
+    async def _check_health_forever(self) -> None:
+        while True:
+            await sleep(self.health_check_interval)
+
+            for slot in list(self.slots):
+                try:
+                    is_healthy = (
+                        await self.health_check(slot.client)
+                        if self.health_check
+                        else True
+                    )
+                except Exception as e:
+                    print(f"Vertex AI client failed its health check: {e}", flush=True)
+                    print(format_exc(), flush=True)
+                    is_healthy = False
+
+                if not is_healthy and slot in self.slots:
+                    print("Replacing unhealthy Vertex AI client", flush=True)
+                    self._replace(slot)
@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+from asyncio import Task, create_task, get_running_loop, shield
+from functools import partial
+from hashlib import sha256
+from io import BufferedIOBase, RawIOBase, TextIOBase
+from json import dump, load
+from os import makedirs, remove, replace, scandir, utime
+from os.path import exists, join
+from time import time
+from typing import BinaryIO
+from uuid import uuid4
+
+from httpx import AsyncClient, Limits, Timeout
+
+
+class MaterialTooLarge(Exception):
+    """Raised when a downloaded material exceeds the configured maximum size."""
+
+
+class MaterialDownloader:
+    """Fetches http(s) materials into a local cache over pooled connections.
+
+    A cached document is revalidated with its ETag / Last-Modified, so an
+    unchanged brochure costs a 304 instead of a full download, and is not
+    revalidated at all within `fresh_for` seconds of the last fetch.
+    Concurrent downloads of the same URL share one request. Downloads are
+    streamed to disk and cut off past `max_bytes`.
+    """
+
+    METADATA_SUFFIX = ".json"
+    BODY_SUFFIX = ".body"
+
+    def __init__(self) -> None:
+        self.cache_directory = "./.download-cache"
+        self.max_bytes = 100 * 1024 * 1024
+        self.max_cache_bytes = 1024 * 1024 * 1024
+        self.fresh_for = 300.0
+        self.connect_timeout = 10.0
+        self.read_timeout = 60.0
+        self.max_connections = 32
+        self.transport: AsyncClient | None = None
+        self.downloads: dict[str, Task[str]] = {}
+
+    def set_cache_directory(self, cache_directory: str) -> MaterialDownloader:
+        self.cache_directory = cache_directory
+        return self
+
+    def set_max_bytes(self, max_bytes: int) -> MaterialDownloader:
+        self.max_bytes = max_bytes
+        return self
+
+    def set_max_cache_bytes(self, max_cache_bytes: int) -> MaterialDownloader:
+        self.max_cache_bytes = max_cache_bytes
+        return self
+
+    def set_fresh_for(self, fresh_for: float) -> MaterialDownloader:
+        self.fresh_for = fresh_for
+        return self
+
+    def set_connect_timeout(self, connect_timeout: float) -> MaterialDownloader:
+        self.connect_timeout = connect_timeout
+        return self
+
+    def set_read_timeout(self, read_timeout: float) -> MaterialDownloader:
+        self.read_timeout = read_timeout
+        return self
+
+    def set_max_connections(self, max_connections: int) -> MaterialDownloader:
+        self.max_connections = max_connections
+        return self
+
+    async def async_init(self) -> None:
+        # Gateways sharing a downloader each initialise it
+        if self.transport is not None:
+            return
+
+        makedirs(self.cache_directory, exist_ok=True)
+        self.transport = AsyncClient(
+            timeout=Timeout(self.read_timeout, connect=self.connect_timeout),
+            limits=Limits(max_connections=self.max_connections),
+            follow_redirects=True,
+        )
+
+    async def async_shutdown(self) -> None:
+        if self.transport:
+            await self.transport.aclose()
+            self.transport = None
+
+    async def resolve(
+        self,
+        material: str | bytes | bytearray | RawIOBase | BufferedIOBase | TextIOBase,
+    ) -> str | bytes | bytearray | RawIOBase | BufferedIOBase | TextIOBase:
+        """Turn an http(s) URL into a file:// URL of its cached copy. Other materials pass through."""
+        if isinstance(material, str) and (
+            material.startswith("http://") or material.startswith("https://")
+        ):
+            return "file://" + await self.download(material)
+        return material
+
+    async def download(self, url: str) -> str:
+        """Path of an up-to-date local copy of `url`."""
+        task = self.downloads.get(url)
+        if task is None:
+            task = create_task(self._download(url))
+            self.downloads[url] = task
+            task.add_done_callback(lambda _: self.downloads.pop(url, None))
+        return await shield(task)
+
+    async def _download(self, url: str) -> str:
+        if self.transport is None:
+            raise RuntimeError("Material downloader is not initialised")
+
+        loop = get_running_loop()
+        name = sha256(url.encode("utf-8")).hexdigest()
+        body_path = join(self.cache_directory, name + self.BODY_SUFFIX)
+        metadata_path = join(self.cache_directory, name + self.METADATA_SUFFIX)
+
+        metadata: dict = {}
+        if exists(body_path) and exists(metadata_path):
+            metadata = await loop.run_in_executor(
+                None, partial(self._read_metadata, metadata_path)
+            )
+
+        if metadata and time() - metadata.get("fetched_at", 0) < self.fresh_for:
+            await loop.run_in_executor(None, partial(utime, body_path))
+            return body_path
+
+        headers = {}
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+
+        async with self.transport.stream("GET", url, headers=headers) as http_response:
+            if http_response.status_code == 304 and metadata:
+                print(f"Material at {url} is unchanged, using cached copy", flush=True)
+                metadata["fetched_at"] = time()
+                await loop.run_in_executor(
+                    None, partial(self._write_metadata, metadata_path, metadata)
+                )
+                await loop.run_in_executor(None, partial(utime, body_path))
+                return body_path
+
+            http_response.raise_for_status()
+
+            content_length = int(http_response.headers.get("content-length", 0))
+            if content_length > self.max_bytes:
+                raise MaterialTooLarge(
+                    f"Material at {url} is {content_length} bytes, limit is {self.max_bytes}"
+                )
+
+            partial_path = f"{body_path}.{uuid4().hex}.partial"
+            f: BinaryIO = await loop.run_in_executor(
+                None, partial(open, partial_path, "wb")
+            )
+            size = 0
+            try:
+                async for block in http_response.aiter_bytes():
+                    size += len(block)
+                    if size > self.max_bytes:
+                        raise MaterialTooLarge(
+                            f"Material at {url} exceeds the limit of {self.max_bytes} bytes"
+                        )
+                    await loop.run_in_executor(None, f.write, block)
+            except BaseException:
+                f.close()
+                await loop.run_in_executor(None, remove, partial_path)
+                raise
+            f.close()
+
+            await loop.run_in_executor(None, replace, partial_path, body_path)
+            await loop.run_in_executor(
+                None,
+                partial(
+                    self._write_metadata,
+                    metadata_path,
+                    {
+                        "url": url,
+                        "etag": http_response.headers.get("etag"),
+                        "last_modified": http_response.headers.get("last-modified"),
+                        "fetched_at": time(),
+                    },
+                ),
+            )
+
+        await loop.run_in_executor(None, partial(self._evict, body_path))
+        return body_path
+
+    def _read_metadata(self, metadata_path: str) -> dict:
+        try:
+            with open(metadata_path, "r", encoding="utf-8") as f:
+                return load(f)
+        except FileNotFoundError:
+            # Evicted by another worker since it was seen
+            return {}
+
+    def _write_metadata(self, metadata_path: str, metadata: dict) -> None:
+        # Written aside and moved into place, as other workers read the same cache
+        partial_path = f"{metadata_path}.{uuid4().hex}.partial"
+        with open(partial_path, "w", encoding="utf-8") as f:
+            dump(metadata, f)
+        replace(partial_path, metadata_path)
+
+    def _evict(self, keep: str) -> None:
+        """Remove the least recently used bodies over `max_cache_bytes`, but never `keep`, which is about to be returned."""
+        bodies: list[tuple[float, int, str]] = []
+
+        # Other workers may be evicting the same entries meanwhile
+        for entry in scandir(self.cache_directory):
+            if not entry.name.endswith(self.BODY_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            bodies.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in bodies)
+        for _, size, path in sorted(bodies):
+            if total_bytes <= self.max_cache_bytes:
+                break
+            if path == keep:
+                continue
+            metadata_path = path[: -len(self.BODY_SUFFIX)] + self.METADATA_SUFFIX
+            for stale_path in (path, metadata_path):
+                try:
+                    remove(stale_path)
+                except FileNotFoundError:
+                    pass
+            total_bytes -= size
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+from asyncio import (
+    AbstractEventLoop,
+    Semaphore,
+    TimeoutError,
+    get_running_loop,
+    wait_for,
+    wrap_future,
+)
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, TypeVar
+
+from pydantic import BaseModel
+
+ResultT = TypeVar("ResultT")
+
+
+class ExecutorMetrics(BaseModel):
+    """Occupancy and wait times of a `BoundedExecutor`."""
+
+    workers: int = 0
+    """Number of worker threads."""
+
+    busy: int = 0
+    """Number of calls currently running on a worker."""
+
+    queued: int = 0
+    """Number of calls submitted and waiting for a free worker."""
+
+    submitted: int = 0
+    completed: int = 0
+
+    rejected: int = 0
+    """Number of calls refused because the queue stayed full for the queue timeout."""
+
+    total_wait_seconds: float = 0.0
+    """Time calls spent queued before a worker picked them up, summed."""
+
+    max_wait_seconds: float = 0.0
+
+
+class _QueuedCall:
+    def __init__(self) -> None:
+        self.submitted_at = monotonic()
+        self.started = False
+        self.abandoned = False
+
+
+class ExecutorSaturated(Exception):
+    """Raised when a call cannot be queued before the queue timeout."""
+
+
+class BoundedExecutor:
+    """A fixed number of threads for blocking SDK work, behind a bounded queue.
+
+    At most `workers + max_queue` calls are admitted at a time. Further calls
+    wait up to `queue_timeout` seconds for room and are then rejected with
+    `ExecutorSaturated`, so a saturated gateway says so quickly instead of
+    letting callers time out. A call keeps its place until it has finished on
+    its worker, even if its caller stopped waiting for it, as a thread cannot
+    be stopped midway.
+    """
+
+    def __init__(self) -> None:
+        self.workers = 32
+        self.max_queue = 256
+        self.queue_timeout = 5.0
+        self.pool: ThreadPoolExecutor | None = None
+        self.admissions: Semaphore
+        self.lock = Lock()
+        self.counters = ExecutorMetrics()
+        self.on_wait: Callable[[str, float], None] | None = None
+
+    def set_workers(self, workers: int) -> BoundedExecutor:
+        self.workers = max(1, workers)
+        return self
+
+    def set_max_queue(self, max_queue: int) -> BoundedExecutor:
+        self.max_queue = max(0, max_queue)
+        return self
+
+    def set_queue_timeout(self, queue_timeout: float) -> BoundedExecutor:
+        self.queue_timeout = queue_timeout
+        return self
+
+    def set_on_wait(self, on_wait: Callable[[str, float], None]) -> BoundedExecutor:
+        """Called from the worker thread with the name of each call and the seconds it was queued."""
+        self.on_wait = on_wait
+        return self
+
+    def start(self) -> None:
+        print(
+            f"Starting {self.workers} worker threads with room for {self.max_queue} queued calls",
+            flush=True,
+        )
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="vertex"
+        )
+        self.admissions = Semaphore(self.workers + self.max_queue)
+        self.counters = ExecutorMetrics(workers=self.workers)
+
+    def stop(self) -> None:
+        if self.pool:
+            print("Shutting down the worker threads", flush=True)
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+
+    async def run(self, call: Callable[..., ResultT], *args: Any, **kwargs: Any) -> ResultT:
+        if self.pool is None:
+            raise RuntimeError("Executor is not started")
+
+        try:
+            await wait_for(self.admissions.acquire(), self.queue_timeout)
+        except TimeoutError:
+            with self.lock:
+                self.counters.rejected += 1
+            raise ExecutorSaturated(
+                f"All {self.workers} workers are busy and {self.max_queue} calls are queued"
+            )
+
+        loop = get_running_loop()
+        queued = _QueuedCall()
+        with self.lock:
+            self.counters.submitted += 1
+            self.counters.queued += 1
+        try:
+            future = self.pool.submit(
+                partial(self._measured, queued, call, *args, **kwargs)
+            )
+            future.add_done_callback(lambda _: self._release(loop))
+        except BaseException:
+            with self.lock:
+                self.counters.queued -= 1
+            self.admissions.release()
+            raise
+
+        try:
+            return await wrap_future(future)
+        finally:
+            with self.lock:
+                if not queued.started:
+                    # Cancelled before a worker picked it up
+                    queued.abandoned = True
+                    self.counters.queued -= 1
+
+    def metrics(self) -> ExecutorMetrics:
+        with self.lock:
+            return self.counters.model_copy()
+
+    def _release(self, loop: AbstractEventLoop) -> None:
+        try:
+            loop.call_soon_threadsafe(self.admissions.release)
+        except RuntimeError:
+            # The loop has closed, and the semaphore with it
+            pass
+
+    def _measured(
+        self,
+        queued: _QueuedCall,
+        call: Callable[..., ResultT],
+        *args: Any,
+        **kwargs: Any,
+    ) -> ResultT:
+        waited = monotonic() - queued.submitted_at
+        with self.lock:
+            queued.started = True
+            if not queued.abandoned:
+                self.counters.queued -= 1
+            self.counters.busy += 1
+            self.counters.total_wait_seconds += waited
+            self.counters.max_wait_seconds = max(
+                self.counters.max_wait_seconds, waited
+            )
+        if self.on_wait:
+            self.on_wait(_name(call), waited)
+
+        try:
+            return call(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.counters.busy -= 1
+                self.counters.completed += 1
+
+
+def _name(call: Callable) -> str:
+    """Name of `call` for metrics, such as MaterialSource.digest."""
+    while isinstance(call, partial):
+        call = call.func
+    return getattr(call, "__qualname__", type(call).__name__)
@@ -1,27 +1,58 @@
 from __future__ import annotations
 
 import traceback
-from asyncio import get_running_loop
-from concurrent.futures import ThreadPoolExecutor
+from asyncio import TimeoutError
 from functools import partial
+from time import monotonic
 from io import BufferedIOBase, RawIOBase, TextIOBase
-from typing import AsyncGenerator, Iterator
+from typing import AsyncGenerator, AsyncIterator
 from uuid import uuid4
 
 from google import genai
 from google.genai import Client as VertexClient
 from google.genai import types
+from google.genai.errors import APIError
+from httpx import AsyncClient, HTTPError, Limits
 from google.genai.types import GenerateContentResponse, Part
-from magic import from_buffer
-from sbilifeco.boundaries.llm import ILLM
+from sbilifeco.boundaries.llm import ILLM, LLMRequest, ReplyStats, ReplyStream
+from sbilifeco.boundaries.llm_metrics import LLMMetrics
+from sbilifeco.boundaries.llm_streams import (
+    StreamAlreadyExists,
+    StreamLimitExceeded,
+    StreamRegistry,
+)
 from sbilifeco.boundaries.material_reader import (
     BaseMaterialReader,
     IMaterialReaderListener,
 )
 from sbilifeco.models.base import Response
+from sbilifeco.gateways.vertex_chunk_parser import SizedChunkParser
+from sbilifeco.gateways.vertex_chunk_store import ChunkStore
+from sbilifeco.gateways.vertex_client_pool import VertexClientPool
+from sbilifeco.gateways.vertex_downloader import MaterialDownloader, MaterialTooLarge
+from sbilifeco.gateways.vertex_executor import (
+    BoundedExecutor,
+    ExecutorMetrics,
+    ExecutorSaturated,
+)
+from sbilifeco.gateways.vertex_material_source import MaterialSource
+from sbilifeco.gateways.vertex_prechunker import PreChunker, merge_in_order
+from sbilifeco.gateways.vertex_prompt_cache import (
+    PromptCacheMetrics,
+    PromptCacheRegistry,
+)
+from sbilifeco.gateways.vertex_retry import RetryMetrics, RetryPolicy
+from sbilifeco.gateways.vertex_token_budget import (
+    TokenBudget,
+    TokenBudgetExceeded,
+    TokenBudgetMetrics,
+)
 
 
 class VertexGemini(ILLM, BaseMaterialReader):
+    CHUNKING_PROMPT_VERSION = "2"
+    """Bump whenever the way materials are sent for chunking changes, so stored chunks are not reused."""
+
     def __init__(self) -> None:
         BaseMaterialReader.__init__(self)
         self.region: str = ""
@@ -29,8 +60,25 @@ class VertexGemini(ILLM, BaseMaterialReader):
         self.model: str = ""
         self.max_output_tokens = 8192
         self.min_chunk_size = 4000
-        self.streams: dict[str, AsyncGenerator] = {}
-        self.pool: ThreadPoolExecutor
+        self.streams: StreamRegistry[AsyncGenerator] = StreamRegistry(
+            closer=lambda chunks: chunks.aclose()
+        )
+        self.executor = BoundedExecutor()
+        self.pool_size = 4
+        self.keep_alive = 300.0
+        self.health_check_interval = 60.0
+        self.clients: VertexClientPool[VertexClient]
+        self.transports: dict[VertexClient, AsyncClient] = {}
+        self.chunk_store: ChunkStore | None = None
+        self.downloader = MaterialDownloader()
+        self.retries: RetryPolicy[str | None] = RetryPolicy()
+        self.prechunker: PreChunker | None = None
+        self.range_parallelism = 4
+        self.prompt_caches = PromptCacheRegistry(
+            self._create_prompt_cache, self._delete_prompt_cache
+        )
+        self.token_budget: TokenBudget | None = None
+        self.metrics = LLMMetrics()
 
     def set_region(self, region: str) -> VertexGemini:
         self.region = region
@@ -52,35 +100,226 @@ class VertexGemini(ILLM, BaseMaterialReader):
         self.min_chunk_size = min_chunk_size
         return self
 
+    def set_pool_size(self, pool_size: int) -> VertexGemini:
+        self.pool_size = pool_size
+        return self
+
+    def set_keep_alive(self, keep_alive: float) -> VertexGemini:
+        """Seconds an idle connection to Vertex AI is kept open for reuse."""
+        self.keep_alive = keep_alive
+        return self
+
+    def set_health_check_interval(self, health_check_interval: float) -> VertexGemini:
+        self.health_check_interval = health_check_interval
+        return self
+
+    def set_executor_workers(self, workers: int) -> VertexGemini:
+        """Threads for opening, hashing and splitting materials, which are CPU and disk bound. Size to the cores available."""
+        self.executor.set_workers(workers)
+        return self
+
+    def set_executor_max_queue(self, max_queue: int) -> VertexGemini:
+        self.executor.set_max_queue(max_queue)
+        return self
+
+    def set_executor_queue_timeout(self, queue_timeout: float) -> VertexGemini:
+        self.executor.set_queue_timeout(queue_timeout)
+        return self
+
+    def set_chunk_store(self, chunk_store: ChunkStore) -> VertexGemini:
+        self.chunk_store = chunk_store
+        return self
+
+    def set_downloader(self, downloader: MaterialDownloader) -> VertexGemini:
+        self.downloader = downloader
+        return self
+
+    def set_retry_policy(self, retries: RetryPolicy[str | None]) -> VertexGemini:
+        """Deadline, retries and hedging for `generate_reply`."""
+        self.retries = retries
+        return self
+
+    def set_prechunker(self, prechunker: PreChunker) -> VertexGemini:
+        """Splits PDFs by page range, so `read_material` chunks the ranges in parallel."""
+        self.prechunker = prechunker
+        return self
+
+    def set_range_parallelism(self, parallelism: int) -> VertexGemini:
+        """Most page ranges of one material chunked at a time."""
+        self.range_parallelism = max(1, parallelism)
+        return self
+
+    def set_prompt_cache_ttl(self, ttl: float) -> VertexGemini:
+        """Lifetime of the context caches made for cacheable prefixes. 0 sends prefixes inline."""
+        self.prompt_caches.set_ttl(ttl)
+        return self
+
+    def set_prompt_cache_min_chars(self, min_chars: int) -> VertexGemini:
+        self.prompt_caches.set_min_chars(min_chars)
+        return self
+
+    def prompt_cache_metrics(self) -> PromptCacheMetrics:
+        return self.prompt_caches.metrics()
+
+    def set_token_budget(self, token_budget: TokenBudget) -> VertexGemini:
+        """Sizes prompts against the context window and the reply's max_output_tokens to what is left of it."""
+        self.token_budget = token_budget.set_count_tokens(self._count_tokens)
+        return self
+
+    def token_budget_metrics(self) -> TokenBudgetMetrics:
+        if self.token_budget is None:
+            return TokenBudgetMetrics()
+        return self.token_budget.metrics()
+
+    def set_metrics(self, metrics: LLMMetrics) -> VertexGemini:
+        """Where waits for worker threads, the time to open streams and executor occupancy are recorded."""
+        self.metrics = metrics
+        return self
+
+    def retry_metrics(self) -> RetryMetrics:
+        return self.retries.metrics()
+
+    def set_max_streams(self, max_streams: int) -> VertexGemini:
+        self.streams.set_max_streams(max_streams)
+        return self
+
+    def set_stream_idle_timeout(self, idle_timeout: float) -> VertexGemini:
+        self.streams.set_idle_timeout(idle_timeout)
+        return self
+
     async def async_init(self) -> None:
         print(
-            "Creating a thread pool for Vertex AI calls, so that each call will not block the event loop",
+            "Creating a thread pool for opening and splitting materials, so that they do not block the event loop",
             flush=True,
         )
-        self.pool = ThreadPoolExecutor(max_workers=256)
+        self.executor.set_on_wait(
+            lambda call, waited: self.metrics.executor_wait.observe(
+                call, self.model, waited
+            )
+        ).start()
+        for name, help, read in [
+            (
+                "llm_executor_busy_threads",
+                "Worker threads running a blocking Vertex AI call.",
+                lambda: self.executor.metrics().busy,
+            ),
+            (
+                "llm_executor_queued_calls",
+                "Blocking calls waiting for a worker thread.",
+                lambda: self.executor.metrics().queued,
+            ),
+            (
+                "llm_executor_threads",
+                "Worker threads for blocking Vertex AI calls.",
+                lambda: self.executor.metrics().workers,
+            ),
+        ]:
+            self.metrics.add_gauge(
+                name, help, read, model=self.model, region=self.region
+            )
+        self.retries.add_metrics(self.metrics, model=self.model, region=self.region)
+        self.prompt_caches.add_metrics(
+            self.metrics, model=self.model, region=self.region
+        )
+        if self.token_budget is not None:
+            self.token_budget.add_metrics(
+                self.metrics, model=self.model, region=self.region
+            )
+
+        self.clients = (
+            VertexClientPool(self._create_client, self._close_client)
+            .set_size(self.pool_size)
+            .set_health_check(self._is_client_healthy)
+            .set_health_check_interval(self.health_check_interval)
+        )
+        await self.clients.start()
+        await self.streams.start()
+        await self.downloader.async_init()
 
     async def async_shutdown(self) -> None:
-        print("Shutting down the thread pool for Vertex AI calls", flush=True)
-        self.pool.shutdown(wait=True, cancel_futures=True)
+        await self.streams.stop()
+        await self.prompt_caches.clear()
+        await self.clients.stop()
+        await self.downloader.async_shutdown()
+
+        self.executor.stop()
+
+    def executor_metrics(self) -> ExecutorMetrics:
+        return self.executor.metrics()
+
+    def _create_client(self) -> VertexClient:
+        # An httpx client of our own, so its keep-alive is ours to set and
+        # its state can be checked without a call to Vertex AI
+        transport = AsyncClient(
+            limits=Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=self.keep_alive,
+            )
+        )
+        vertex_client = VertexClient(
+            vertexai=True,
+            location=self.region,
+            project=self.project_id,
+            http_options=types.HttpOptions(httpx_async_client=transport),
+        )
+        self.transports[vertex_client] = transport
+        return vertex_client
+
+    async def _close_client(self, vertex_client: VertexClient) -> None:
+        vertex_client.close()
+        await vertex_client.aio.aclose()
+        transport = self.transports.pop(vertex_client, None)
+        if transport is not None:
+            await transport.aclose()
+
+    async def _is_client_healthy(self, vertex_client: VertexClient) -> bool:
+        # Clients whose connection fails are discarded by the call that saw
+        # it, so this only catches transports closed underneath us
+        transport = self.transports.get(vertex_client)
+        return transport is not None and not transport.is_closed
+
+    def _is_rate_limited(self, e: Exception) -> bool:
+        """Whether Vertex refused the call for quota, i.e. 429 / RESOURCE_EXHAUSTED."""
+        return isinstance(e, APIError) and e.code == 429
 
     async def generate_reply(self, context: str) -> Response[str]:
-        vertex_client: VertexClient | None = None
-
         try:
-            print("Connecting to Vertex AI", flush=True)
-            vertex_client = VertexClient(
-                vertexai=True, location=self.region, project=self.project_id
+            context, max_tokens = await self._fit(context)
+            return Response.ok(
+                await self.retries.call(
+                    lambda: self._generate_reply_once(context, max_tokens),
+                    self._is_retryable,
+                )
+            )
+        except TokenBudgetExceeded as e:
+            return Response.fail(str(e), 413)
+        except TimeoutError:
+            return Response.fail(
+                f"Vertex AI did not reply within {self.retries.deadline} seconds", 504
             )
+        except ExecutorSaturated as e:
+            return Response.fail(str(e), 503)
+        except Exception as e:
+            traceback.print_exc()
+            if self._is_rate_limited(e):
+                return Response.fail(str(e), 429)
+            return Response.error(e)
+
+    async def _generate_reply_once(self, context: str, max_tokens: int) -> str | None:
+        vertex_client = self.clients.acquire()
 
-            _p = partial(
-                vertex_client.models.generate_content,
+        try:
+            # The async API, so a call cancelled by its deadline or a hedge
+            # closes its connection rather than running on in a thread
+            print("Sending request to Vertex AI and awaiting response", flush=True)
+            llm_response = await vertex_client.aio.models.generate_content(
                 model=self.model,
                 contents=context,
-                config=types.GenerateContentConfig(temperature=0.0),
+                config=types.GenerateContentConfig(
+                    temperature=0.0, max_output_tokens=max_tokens
+                ),
             )
-
-            print("Sending request to Vertex AI and awaiting response", flush=True)
-            llm_response = await get_running_loop().run_in_executor(None, _p)
             print("Received response from Vertex AI", flush=True)
 
             if llm_response.usage_metadata:
@@ -89,69 +328,288 @@ class VertexGemini(ILLM, BaseMaterialReader):
                     flush=True,
                 )
 
-            return Response.ok(llm_response.text)
+            return llm_response.text
+        except (ConnectionError, HTTPError):
+            self.clients.discard(vertex_client)
+            raise
+        finally:
+            await self.clients.release(vertex_client)
+
+    async def _fit(self, context: str, prefix: str = "") -> tuple[str, int]:
+        """The context, cut to the token budget if there is one, and max_output_tokens for the reply."""
+        if self.token_budget is None:
+            return context, self.max_output_tokens
+        return await self.token_budget.fit(context, self.max_output_tokens, prefix)
+
+    async def _chunking_reply_tokens(self, material: bytes, mime: str) -> int:
+        """max_output_tokens for chunking `material`, which is never cut to fit the budget.
+
+        Only text can be sized locally; a PDF's tokens cannot be told from its
+        size, so it gets the whole output limit.
+        """
+        if self.token_budget is None or not mime.startswith("text/"):
+            return self.max_output_tokens
+        return await self.token_budget.reply_tokens(
+            material.decode("utf-8", errors="replace"), self.max_output_tokens
+        )
+
+    async def _count_tokens(self, text: str) -> int:
+        vertex_client = self.clients.acquire()
+        try:
+            count = await vertex_client.aio.models.count_tokens(
+                model=self.model, contents=text
+            )
+            return count.total_tokens or 0
+        finally:
+            await self.clients.release(vertex_client)
+
+    def _is_retryable(self, e: Exception) -> bool:
+        """429s and 5xx are worth another try, as is a failure to connect at all."""
+        if isinstance(e, APIError):
+            return e.code == 429 or e.code >= 500
+        return isinstance(e, (ConnectionError, HTTPError))
+
+    async def generate_streamed_reply(
+        self, request: LLMRequest
+    ) -> Response[AsyncGenerator[str, None]]:
+        vertex_client: VertexClient | None = None
+        is_reserved = False
+
+        try:
+            try:
+                self.streams.reserve(request.request_id)
+                is_reserved = True
+            except StreamLimitExceeded as e:
+                return Response.fail(str(e), 429)
+            except StreamAlreadyExists as e:
+                return Response.fail(str(e), 409)
+
+            try:
+                context, max_tokens = await self._fit(
+                    request.context, request.cacheable_prefix
+                )
+            except TokenBudgetExceeded as e:
+                return Response.fail(str(e), 413)
+
+            contents: list[str] = [context]
+            cached_content: str | None = None
+            if request.cacheable_prefix:
+                cached_content = await self.prompt_caches.handle(
+                    self.model, request.cacheable_prefix
+                )
+                if cached_content is None:
+                    contents.insert(0, request.cacheable_prefix)
+
+            vertex_client = self.clients.acquire()
+
+            print(
+                f"Sending prompt and obtaining streamed response from Vertex AI for request_id: {request.request_id}",
+                flush=True,
+            )
+            connecting_at = monotonic()
+            llm_stream = await vertex_client.aio.models.generate_content_stream(
+                model=self.model,
+                contents=contents,
+                config=types.GenerateContentConfig(
+                    temperature=request.randomness,
+                    max_output_tokens=max_tokens,
+                    cached_content=cached_content,
+                ),
+            )
+            self.metrics.connect_time.observe(
+                "generate_streamed_reply", self.model, monotonic() - connecting_at
+            )
+
+            async def close_stream(
+                llm_stream: AsyncIterator[GenerateContentResponse] = llm_stream,
+                vertex_client: VertexClient = vertex_client,
+            ) -> None:
+                print(
+                    f"Vertex Gateway: Closing the open stream for request_id: {request.request_id}",
+                    flush=True,
+                )
+                try:
+                    if isinstance(llm_stream, AsyncGenerator):
+                        await llm_stream.aclose()
+                finally:
+                    await self.clients.release(vertex_client)
+
+            async def process_stream(
+                request_id: str, stats: ReplyStats
+            ) -> AsyncGenerator[str, None]:
+                is_complete = False
+
+                try:
+                    llm_stream = self.streams.get(request_id)
+                    if llm_stream is None:
+                        return
+
+                    async for chunk in llm_stream:
+                        self.streams.touch(request_id)
+                        self._update_stats(stats, chunk)
+                        if chunk.text:
+                            yield chunk.text
+                    is_complete = True
+                except Exception as e:
+                    print(
+                        f"Vertex Gateway: Error processing Vertex AI stream for request_id: {request_id}: {e}",
+                        flush=True,
+                    )
+                    print(traceback.format_exc(), flush=True)
+                    raise e
+                finally:
+                    await self.streams.unregister(request_id, completed=is_complete)
+
+            self.streams.register(request.request_id, llm_stream, on_close=close_stream)
+            vertex_client = None
+
+            stats = ReplyStats(model=self.model)
+            return Response.ok(
+                ReplyStream(process_stream(request.request_id, stats), stats)
+            )
         except Exception as e:
-            traceback.print_exc()
+            print(
+                f"Vertex Gateway: Error generating streamed reply with Vertex AI for request_id: {request.request_id}: {e}",
+                flush=True,
+            )
+            print(traceback.format_exc(), flush=True)
+            if vertex_client:
+                await self.clients.release(vertex_client)
+            if self._is_rate_limited(e):
+                return Response.fail(str(e), 429)
             return Response.error(e)
         finally:
-            if vertex_client:
-                vertex_client.close()
+            if is_reserved:
+                # Frees the place unless the stream was registered in it
+                self.streams.unreserve(request.request_id)
+
+    def _update_stats(self, stats: ReplyStats, chunk: GenerateContentResponse) -> None:
+        # Usage is cumulative and the finish reason comes with the last chunk
+        if chunk.usage_metadata:
+            stats.input_tokens = chunk.usage_metadata.prompt_token_count
+            stats.output_tokens = chunk.usage_metadata.candidates_token_count
+            stats.cached_input_tokens = chunk.usage_metadata.cached_content_token_count
+        if chunk.candidates and chunk.candidates[0].finish_reason:
+            finish_reason = chunk.candidates[0].finish_reason
+            stats.finish_reason = getattr(finish_reason, "value", str(finish_reason))
+
+    async def _create_prompt_cache(self, prefix: str, ttl: float) -> str:
+        vertex_client = self.clients.acquire()
+        try:
+            cached_content = await vertex_client.aio.caches.create(
+                model=self.model,
+                config=types.CreateCachedContentConfig(
+                    contents=[
+                        types.Content(role="user", parts=[Part.from_text(text=prefix)])
+                    ],
+                    ttl=f"{int(ttl)}s",
+                ),
+            )
+            print(f"Created context cache {cached_content.name}", flush=True)
+            return cached_content.name or ""
+        finally:
+            await self.clients.release(vertex_client)
+
+    async def _delete_prompt_cache(self, name: str) -> None:
+        vertex_client = self.clients.acquire()
+        try:
+            await vertex_client.aio.caches.delete(name=name)
+        finally:
+            await self.clients.release(vertex_client)
 
     async def read_material(
         self,
         material: str | bytes | bytearray | RawIOBase | BufferedIOBase | TextIOBase,
     ) -> Response[str]:
         vertex_client: VertexClient | None = None
+        material_id = uuid4().hex
 
         try:
-            vertex_client = VertexClient(
-                vertexai=True, location=self.region, project=self.project_id
-            )
-
-            material_id = uuid4().hex
             print(
                 f"Received material to read, tagging it as material ID {material_id}",
                 flush=True,
             )
 
-            material_as_bytes: bytes | None = None
-            referred_mime: str | None = None
-
-            if isinstance(material, bytearray):
-                material_as_bytes = bytes(material)
-            elif isinstance(material, bytes):
-                material_as_bytes = material
-            elif isinstance(material, str):
-                if material.lower().startswith("file://"):
-                    file_path = material[7:]
-                    with open(file_path, "rb") as f:
-                        material_as_bytes = f.read()
-                else:
-                    material_as_bytes = material.encode("utf-8")
-            elif isinstance(material, (RawIOBase, BufferedIOBase)):
-                material_as_bytes = material.read()
-            elif isinstance(material, TextIOBase):
-                material_as_bytes = material.read().encode("utf-8")
-
-            if material_as_bytes is None:
+            try:
+                self.streams.reserve(material_id)
+            except StreamLimitExceeded as e:
+                return Response.fail(str(e), 429)
+
+            # File reads, hashing and MIME sniffing are blocking, keep them off the event loop
+            material = await self.downloader.resolve(material)
+            source = await self.executor.run(
+                MaterialSource.open, material, text_as_bytes=True
+            )
+
+            if source is None:
                 return Response.fail("Unsupported sourcer material provided.", 400)
 
-            referred_mime = from_buffer(material_as_bytes, mime=True)
+            try:
+                chunk_store_key: str | None = None
+                if self.chunk_store:
+                    material_digest = await self.executor.run(source.digest)
+                    chunk_store_key = self.chunk_store.key(
+                        material_digest,
+                        self.model,
+                        self._chunking_version(),
+                        self.min_chunk_size,
+                    )
+
+                    if self.chunk_store.has(chunk_store_key):
+                        print(
+                            f"Serving chunks for material ID {material_id} from the chunk store",
+                            flush=True,
+                        )
+                        self.streams.register(
+                            material_id, self.chunk_store.read(chunk_store_key)
+                        )
+                        return Response.ok(material_id)
+
+                referred_mime = await self.executor.run(source.mime)
+                material_as_bytes = await self.executor.run(source.as_bytes)
+            finally:
+                source.close()
+
+            referred_mime = referred_mime or "application/pdf"
+            page_ranges: list[bytes] = []
+            if self.prechunker and referred_mime == "application/pdf":
+                page_ranges = await self.executor.run(
+                    self.prechunker.page_ranges, material_as_bytes
+                )
+
+            if len(page_ranges) > 1:
+                print(
+                    f"Sending {len(page_ranges)} page ranges of material ID {material_id} to Vertex in parallel",
+                    flush=True,
+                )
+                finish_reasons: list[str | None] = []
+                chunks = self._chunk_page_ranges(page_ranges, finish_reasons)
+                if self.chunk_store and chunk_store_key:
+                    chunks = self.chunk_store.tee(
+                        chunk_store_key, chunks, finish_reasons
+                    )
+                self.streams.register(material_id, chunks)
+                return Response.ok(material_id)
 
+            max_tokens = await self._chunking_reply_tokens(
+                material_as_bytes, referred_mime
+            )
             print(
                 f"Sending Vertex call for material ID {material_id} with MIME type {referred_mime}",
                 flush=True,
             )
 
-            llm_result = vertex_client.models.generate_content_stream(
+            vertex_client = self.clients.acquire()
+            llm_result = await vertex_client.aio.models.generate_content_stream(
                 model=self.model,
                 contents=[
                     types.Part.from_bytes(
-                        data=material_as_bytes,
-                        mime_type=referred_mime or "application/pdf",
+                        data=material_as_bytes, mime_type=referred_mime
                     )
                 ],
-                config=types.GenerateContentConfig(temperature=0.0),
+                config=types.GenerateContentConfig(
+                    temperature=0.0, max_output_tokens=max_tokens
+                ),
             )
 
             print(
@@ -159,13 +617,34 @@ class VertexGemini(ILLM, BaseMaterialReader):
                 flush=True,
             )
 
-            self.streams[material_id] = self._fetch_next_chunk(llm_result)
+            finish_reasons = []
+            chunks = self._fetch_next_chunk(llm_result, finish_reasons)
+            if self.chunk_store and chunk_store_key:
+                chunks = self.chunk_store.tee(chunk_store_key, chunks, finish_reasons)
+
+            async def close_chunks(
+                chunks: AsyncGenerator = chunks,
+                vertex_client: VertexClient = vertex_client,
+            ) -> None:
+                try:
+                    await chunks.aclose()
+                finally:
+                    await self.clients.release(vertex_client)
+
+            self.streams.register(material_id, chunks, on_close=close_chunks)
             return Response.ok(material_id)
+        except (MaterialTooLarge, TokenBudgetExceeded) as e:
+            return Response.fail(str(e), 413)
+        except ExecutorSaturated as e:
+            return Response.fail(str(e), 503)
         except Exception as e:
+            if vertex_client:
+                await self.clients.release(vertex_client)
+            if self._is_rate_limited(e):
+                return Response.fail(str(e), 429)
             return Response.error(e)
         finally:
-            if vertex_client:
-                vertex_client.close()
+            self.streams.unreserve(material_id)
 
     async def read_next_chunk(
         self, material_id: str
@@ -182,21 +661,67 @@ class VertexGemini(ILLM, BaseMaterialReader):
             chunk = await anext(chunk_source)
             return Response.ok(chunk)
         except StopAsyncIteration:
+            await self.streams.unregister(material_id)
             return Response.ok(None)
         except Exception as e:
+            # A broken stream cannot go on, so free its slot and client now
+            await self.streams.unregister(material_id, completed=False)
             return Response.error(e)
 
+    def _chunking_version(self) -> str:
+        # Chunks of page ranges differ from those of whole PDFs, so store them apart
+        if self.prechunker and self.prechunker.pages_per_range:
+            return f"{self.CHUNKING_PROMPT_VERSION}-{self.prechunker.pages_per_range}p"
+        return self.CHUNKING_PROMPT_VERSION
+
+    async def _chunk_page_ranges(
+        self, page_ranges: list[bytes], finish_reasons: list[str | None]
+    ) -> AsyncGenerator[str, None]:
+        """Chunks of each page range, chunked concurrently, in page order."""
+        producers = [
+            partial(self._chunk_page_range, pdf, finish_reasons) for pdf in page_ranges
+        ]
+        async for _, chunk in merge_in_order(producers, self.range_parallelism):
+            yield chunk
+
+    async def _chunk_page_range(
+        self, pdf: bytes, finish_reasons: list[str | None]
+    ) -> AsyncGenerator[str, None]:
+        vertex_client = self.clients.acquire()
+        try:
+            llm_result = await vertex_client.aio.models.generate_content_stream(
+                model=self.model,
+                contents=[types.Part.from_bytes(data=pdf, mime_type="application/pdf")],
+                config=types.GenerateContentConfig(
+                    temperature=0.0, max_output_tokens=self.max_output_tokens
+                ),
+            )
+            async for chunk in self._fetch_next_chunk(llm_result, finish_reasons):
+                if chunk:
+                    yield chunk
+        finally:
+            await self.clients.release(vertex_client)
+
     async def _fetch_next_chunk(
-        self, chunks_by_llm: Iterator[GenerateContentResponse]
+        self,
+        chunks_by_llm: AsyncIterator[GenerateContentResponse],
+        finish_reasons: list[str | None] | None = None,
     ) -> AsyncGenerator[str | None, None]:
-        right_sized_chunk = ""
-        for chunk in chunks_by_llm:
+        """Chunks of at least `min_chunk_size` cut from the model's text.
+
+        Why the model stopped is added to `finish_reasons` once it has.
+        """
+        parser = SizedChunkParser(self.min_chunk_size)
+        stats = ReplyStats()
+        async for chunk in chunks_by_llm:
+            self._update_stats(stats, chunk)
             if not chunk.text:
                 continue
 
-            right_sized_chunk += chunk.text
-            if len(right_sized_chunk) >= self.min_chunk_size:
+            right_sized_chunk = parser.feed(chunk.text)
+            if right_sized_chunk is not None:
                 yield right_sized_chunk
-                right_sized_chunk = ""
 
-        yield right_sized_chunk
+        if finish_reasons is not None:
+            finish_reasons.append(stats.finish_reason)
+        yield parser.close()
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+from base64 import b64encode
+from hashlib import sha256
+from io import BufferedIOBase, RawIOBase, TextIOBase, UnsupportedOperation
+from mmap import ACCESS_READ, PAGESIZE, mmap
+from os import fstat, pread
+from shutil import copyfileobj
+from tempfile import SpooledTemporaryFile
+from typing import IO
+
+from magic import from_buffer
+
+try:
+    from mmap import MADV_DONTNEED
+except ImportError:  # No madvise on Windows
+    MADV_DONTNEED = None
+
+
+class MaterialSource:
+    """A material opened for sending to Vertex with as few copies as possible.
+
+    Files are memory-mapped instead of read, so their pages are backed by the
+    page cache rather than the Python heap. Non-file streams are spooled to a
+    temporary file that stays in memory only while small. http(s) materials
+    are expected to have been downloaded already, by `MaterialDownloader`.
+
+    Hashing, MIME sniffing and base64 encoding all work on slices of the
+    mapping, and drop each slice's pages from the process once done with
+    them, so a mapped file is never resident whole.
+
+    Opening and encoding are blocking, so callers run them in an executor.
+    """
+
+    SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+    """Spooled streams larger than this are moved from memory to a temporary file."""
+
+    READ_SIZE = 1024 * 1024
+
+    BASE64_SLICE = 3 * 256 * 1024
+    """Bytes encoded per step. A multiple of 3, so slices encode without padding."""
+
+    def __init__(self) -> None:
+        self.text: str | None = None
+        self.view: memoryview = memoryview(b"")
+        self.mapping: mmap | None = None
+        self.offset = 0
+        self.fileno: int | None = None
+        self.file: IO[bytes] | None = None
+
+    @classmethod
+    def open(
+        cls,
+        material: str | bytes | bytearray | RawIOBase | BufferedIOBase | TextIOBase,
+        text_as_bytes: bool = False,
+    ) -> MaterialSource | None:
+        """Open `material`, or return None if it is not a supported source.
+
+        Plain strings become text sources, unless `text_as_bytes` asks for
+        them as UTF-8 bytes.
+        """
+        source = cls()
+
+        if isinstance(material, (bytes, bytearray)):
+            source.view = memoryview(material)
+        elif isinstance(material, str):
+            if material.lower().startswith("file://"):
+                source._map(open(material[len("file://") :], "rb"))
+            elif material.startswith("http://") or material.startswith("https://"):
+                raise ValueError("Download URL materials before opening them")
+            elif text_as_bytes:
+                source.view = memoryview(material.encode("utf-8"))
+            else:
+                source.text = material
+        elif isinstance(material, (RawIOBase, BufferedIOBase)):
+            source._map_stream(material)
+        elif isinstance(material, TextIOBase):
+            text = material.read()
+            if text_as_bytes:
+                source.view = memoryview(text.encode("utf-8"))
+            else:
+                source.text = text
+        else:
+            return None
+
+        return source
+
+    @property
+    def is_text(self) -> bool:
+        return self.text is not None
+
+    @property
+    def size(self) -> int:
+        return len(self.text) if self.text is not None else self.view.nbytes
+
+    def digest(self) -> str:
+        if self.text is not None:
+            return sha256(self.text.encode("utf-8")).hexdigest()
+
+        digest = sha256()
+        for start in range(0, self.view.nbytes, self.READ_SIZE):
+            digest.update(self.view[start : start + self.READ_SIZE])
+            self._release(start, start + self.READ_SIZE)
+        return digest.hexdigest()
+
+    def mime(self) -> str:
+        if self.text is not None:
+            return "text/plain"
+        return from_buffer(bytes(self.view[:2048]), mime=True)
+
+    def base64(self) -> str:
+        """Base64 of the bytes, encoded slice by slice.
+
+        The input is never copied whole, but the encoded slices and the string
+        they are joined into are alive together for a moment, so the peak is
+        about twice the size of the output.
+        """
+        return "".join(
+            self._encode_slice(start)
+            for start in range(0, self.view.nbytes, self.BASE64_SLICE)
+        )
+
+    def as_bytes(self) -> bytes:
+        """The bytes as one bytes object, as SDKs that take raw bytes need.
+
+        That is one full-size copy, except for materials given as bytes. A
+        mapped file is read into it directly rather than through the mapping,
+        so the file's pages are not resident as well.
+        """
+        if self.text is not None:
+            return self.text.encode("utf-8")
+        if isinstance(self.view.obj, bytes) and self.view.nbytes == len(self.view.obj):
+            return self.view.obj
+        if self.fileno is not None:
+            data = pread(self.fileno, self.view.nbytes, self.offset)
+            if len(data) == self.view.nbytes:
+                return data
+        return self.view.tobytes()
+
+    def close(self) -> None:
+        self.view.release()
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _encode_slice(self, start: int) -> str:
+        encoded = b64encode(self.view[start : start + self.BASE64_SLICE])
+        self._release(start, start + self.BASE64_SLICE)
+        return encoded.decode("ascii")
+
+    def _release(self, start: int, end: int) -> None:
+        """Drops the mapped pages of `view[start:end]` from the process; the page cache keeps them."""
+        if self.mapping is None or MADV_DONTNEED is None:
+            return
+        start += self.offset - (self.offset + start) % PAGESIZE
+        end = min(self.offset + end, len(self.mapping))
+        try:
+            self.mapping.madvise(MADV_DONTNEED, start, end - start)
+        except (OSError, ValueError):
+            pass
+
+    def _map(self, file: IO[bytes], offset: int = 0) -> None:
+        self.file = file
+        if fstat(file.fileno()).st_size <= offset:
+            return
+
+        self.mapping = mmap(file.fileno(), 0, access=ACCESS_READ)
+        self.view = memoryview(self.mapping)[offset:]
+        self.offset = offset
+        self.fileno = file.fileno()
+
+    def _map_stream(self, stream: RawIOBase | BufferedIOBase) -> None:
+        try:
+            stream.fileno()
+            offset = stream.tell()
+        except (OSError, UnsupportedOperation, AttributeError):
+            spooled = SpooledTemporaryFile(max_size=self.SPOOL_MAX_MEMORY)
+            copyfileobj(stream, spooled, self.READ_SIZE)
+            self._map_spooled(spooled)
+        else:
+            # Map from where the caller's stream is, as reading it would have
+            self._map(stream, offset)  # type: ignore[arg-type]
+            # The caller still owns the stream
+            self.file = None
+
+    def _map_spooled(self, spooled: SpooledTemporaryFile) -> None:
+        spooled.seek(0)
+        if spooled._rolled:
+            self._map(spooled)  # type: ignore[arg-type]
+        else:
+            self.file = spooled  # type: ignore[assignment]
+            self.view = spooled._file.getbuffer()  # type: ignore[union-attr]
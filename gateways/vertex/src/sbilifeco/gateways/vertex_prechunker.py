@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+from asyncio import Queue, Semaphore, create_task
+from io import BytesIO
+from re import compile
+from typing import AsyncGenerator, Callable, Iterator
+
+
+class PreChunker:
+    """Splits a document locally into parts the model can chunk in parallel.
+
+    Text is split into windows packed from whole paragraphs, or whole
+    sentences where a paragraph alone is too long, so a window never ends
+    mid-sentence and the chunks cut from it do not either. PDFs are only ever
+    split by page range, each range a PDF itself, so the model still sees
+    their tables laid out; this needs pypdf, the optional `pdf` dependency
+    (`sbilifeco-gateway-vertex[pdf]`).
+
+    Splitting is blocking, so callers run it in an executor.
+    """
+
+    PARAGRAPH_BREAK = compile(r"\n\s*\n")
+    SENTENCE_BREAK = compile(r"(?<=[.!?:;])\s+")
+
+    def __init__(self) -> None:
+        self.window_chars = 24000
+        self.pages_per_range = 20
+
+    def set_window_chars(self, window_chars: int) -> PreChunker:
+        """Most characters sent to the model in one call."""
+        self.window_chars = window_chars
+        return self
+
+    def set_pages_per_range(self, pages_per_range: int) -> PreChunker:
+        """Pages per PDF for models that are sent PDFs split by page range. 0 sends PDFs whole."""
+        self.pages_per_range = pages_per_range
+        return self
+
+    def page_ranges(self, data: bytes | memoryview) -> list[bytes]:
+        """The PDF split into PDFs of `pages_per_range` pages each, or none if it fits in one."""
+        try:
+            from pypdf import PdfReader, PdfWriter
+        except ImportError:
+            print("pypdf is not installed, sending PDFs whole", flush=True)
+            return []
+
+        try:
+            reader = PdfReader(BytesIO(data))
+            if not 0 < self.pages_per_range < len(reader.pages):
+                return []
+
+            ranges: list[bytes] = []
+            for start in range(0, len(reader.pages), self.pages_per_range):
+                writer = PdfWriter()
+                for page in reader.pages[start : start + self.pages_per_range]:
+                    writer.add_page(page)
+                output = BytesIO()
+                writer.write(output)
+                ranges.append(output.getvalue())
+            return ranges
+        except Exception as e:
+            print(f"Unable to split the PDF by pages, sending it whole: {e}")
+            return []
+
+    def windows(self, text: str) -> list[str]:
+        windows: list[str] = []
+        window: list[str] = []
+        size = 0
+
+        for piece, separator in self._pieces(text):
+            if window and size + len(separator) + len(piece) > self.window_chars:
+                windows.append("".join(window))
+                window, size = [], 0
+            if window:
+                window.append(separator)
+                size += len(separator)
+            window.append(piece)
+            size += len(piece)
+
+        if window:
+            windows.append("".join(window))
+        return windows
+
+    def _pieces(self, text: str) -> Iterator[tuple[str, str]]:
+        """Paragraphs, with those too long for a window split into sentences, and sentences at spaces.
+
+        Each piece comes with the separator that went before it.
+        """
+        for paragraph in self.PARAGRAPH_BREAK.split(text):
+            paragraph = paragraph.strip()
+            if len(paragraph) <= self.window_chars:
+                if paragraph:
+                    yield paragraph, "\n\n"
+                continue
+
+            separator = "\n\n"
+            for sentence in self.SENTENCE_BREAK.split(paragraph):
+                while len(sentence) > self.window_chars:
+                    cut = sentence.rfind(" ", 0, self.window_chars)
+                    cut = cut if cut > 0 else self.window_chars
+                    yield sentence[:cut], separator
+                    sentence = sentence[cut:].lstrip()
+                    separator = " "
+                if sentence:
+                    yield sentence, separator
+                    separator = " "
+
+
+async def merge_in_order(
+    producers: list[Callable[[], AsyncGenerator[str, None]]], parallelism: int
+) -> AsyncGenerator[tuple[int, str], None]:
+    """Runs up to `parallelism` producers at a time, yielding their text in producer order.
+
+    Each text comes with the index of its producer. Later producers run while
+    earlier ones are still being yielded, and their text is held until their
+    turn. An error in any producer ends the merge, at its turn.
+    """
+    slots = Semaphore(max(1, parallelism))
+    outputs: list[Queue[str | Exception | None]] = [Queue() for _ in producers]
+
+    async def run(producer: Callable[[], AsyncGenerator[str, None]], output: Queue):
+        async with slots:
+            texts = producer()
+            try:
+                async for text in texts:
+                    output.put_nowait(text)
+                output.put_nowait(None)
+            except Exception as e:
+                output.put_nowait(e)
+            finally:
+                await texts.aclose()
+
+    tasks = [
+        create_task(run(producer, output))
+        for producer, output in zip(producers, outputs)
+    ]
+    try:
+        for index, output in enumerate(outputs):
+            while (text := await output.get()) is not None:
+                if isinstance(text, Exception):
+                    raise text
+                yield index, text
+    finally:
+        for task in tasks:
+            task.cancel()
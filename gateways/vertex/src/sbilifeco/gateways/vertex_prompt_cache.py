@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+from asyncio import Future, get_running_loop, shield
+from collections import OrderedDict
+from hashlib import sha256
+from time import monotonic
+from typing import Awaitable, Callable
+
+from pydantic import BaseModel
+from sbilifeco.boundaries.llm_metrics import LLMMetrics
+
+
+class PromptCacheMetrics(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    creations: int = 0
+    failures: int = 0
+    entries: int = 0
+
+
+class PromptCacheRegistry:
+    """Model-side caches of prompt prefixes, by hash of model and prefix.
+
+    The model keeps a cached prefix until its TTL runs out, and a request
+    naming the cache skips reprocessing the prefix. The registry remembers
+    each cache's handle and expiry, so a prefix is cached once and reused
+    until shortly before it expires. Concurrent requests for an uncached
+    prefix wait on a single creation. A prefix the model refuses to cache,
+    e.g. for being too short, is sent inline until the retry interval has
+    passed.
+    """
+
+    def __init__(
+        self,
+        create: Callable[[str, float], Awaitable[str]],
+        delete: Callable[[str], Awaitable[None]] | None = None,
+    ) -> None:
+        self.create = create
+        self.delete = delete
+        self.ttl = 3600.0
+        self.refresh_margin = 60.0
+        self.retry_interval = 300.0
+        self.min_chars = 4096
+        self.max_entries = 256
+        self.entries: OrderedDict[str, tuple[str | None, float]] = OrderedDict()
+        self.creating: dict[str, Future[str | None]] = {}
+        self.counters = PromptCacheMetrics()
+
+    def set_ttl(self, ttl: float) -> PromptCacheRegistry:
+        self.ttl = ttl
+        return self
+
+    def set_refresh_margin(self, refresh_margin: float) -> PromptCacheRegistry:
+        """Seconds before expiry after which a cache is no longer handed out."""
+        self.refresh_margin = refresh_margin
+        return self
+
+    def set_retry_interval(self, retry_interval: float) -> PromptCacheRegistry:
+        self.retry_interval = retry_interval
+        return self
+
+    def set_min_chars(self, min_chars: int) -> PromptCacheRegistry:
+        """Shorter prefixes are sent inline, as models only cache a few thousand tokens or more."""
+        self.min_chars = min_chars
+        return self
+
+    def set_max_entries(self, max_entries: int) -> PromptCacheRegistry:
+        self.max_entries = max_entries
+        return self
+
+    @staticmethod
+    def key(model: str, prefix: str) -> str:
+        return sha256(f"{model}\n{prefix}".encode("utf-8")).hexdigest()
+
+    async def handle(self, model: str, prefix: str) -> str | None:
+        """Name of a live cache of `prefix`, created if need be, or None to send it inline."""
+        if len(prefix) < self.min_chars or self.ttl <= 0:
+            return None
+
+        key = self.key(model, prefix)
+        entry = self.entries.get(key)
+        if entry is not None:
+            handle, expires_at = entry
+            if monotonic() < expires_at - (self.refresh_margin if handle else 0):
+                self.entries.move_to_end(key)
+                if handle:
+                    self.counters.hits += 1
+                return handle
+            del self.entries[key]
+
+        creating = self.creating.get(key)
+        if creating is not None:
+            return await shield(creating)
+
+        self.counters.misses += 1
+        creating = get_running_loop().create_future()
+        self.creating[key] = creating
+
+        handle: str | None = None
+        try:
+            handle = await self.create(prefix, self.ttl)
+            self.counters.creations += 1
+            self._remember(key, handle, monotonic() + self.ttl)
+        except Exception as e:
+            print(f"Unable to cache prompt prefix, sending it inline: {e}", flush=True)
+            self.counters.failures += 1
+            self._remember(key, None, monotonic() + self.retry_interval)
+        finally:
+            del self.creating[key]
+            creating.set_result(handle)
+
+        return handle
+
+    async def clear(self) -> None:
+        """Deletes the caches still alive, so the model stops charging for their storage."""
+        entries, self.entries = self.entries, OrderedDict()
+        if self.delete is None:
+            return
+
+        for handle, expires_at in entries.values():
+            if handle and monotonic() < expires_at:
+                try:
+                    await self.delete(handle)
+                except Exception as e:
+                    print(f"Unable to delete prompt cache {handle}: {e}", flush=True)
+
+    def metrics(self) -> PromptCacheMetrics:
+        return self.counters.model_copy(update={"entries": len(self.entries)})
+
+    def add_metrics(self, metrics: LLMMetrics, **labels: str) -> None:
+        """Reports the counters and the number of caches to `metrics` with `labels`."""
+        for name, help, read in [
+            (
+                "llm_prompt_cache_hits_total",
+                "Prompts whose prefix was already cached by the model.",
+                lambda: self.counters.hits,
+            ),
+            (
+                "llm_prompt_cache_misses_total",
+                "Prompts whose prefix was not cached by the model.",
+                lambda: self.counters.misses,
+            ),
+            (
+                "llm_prompt_cache_creations_total",
+                "Prefixes cached with the model.",
+                lambda: self.counters.creations,
+            ),
+            (
+                "llm_prompt_cache_failures_total",
+                "Prefixes the model failed to cache.",
+                lambda: self.counters.failures,
+            ),
+        ]:
+            metrics.add_counter(name, help, read, **labels)
+        metrics.add_gauge(
+            "llm_prompt_cache_entries",
+            "Prefixes currently cached with the model.",
+            lambda: len(self.entries),
+            **labels,
+        )
+
+    def _remember(self, key: str, handle: str | None, expires_at: float) -> None:
+        # Evicted caches are left to expire on the model's side, they may still be in use
+        self.entries[key] = (handle, expires_at)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
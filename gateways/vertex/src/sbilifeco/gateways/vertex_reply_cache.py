@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from hashlib import sha256
+from json import dumps
+from time import monotonic
+from typing import AsyncGenerator, Protocol
+
+from pydantic import BaseModel
+from sbilifeco.boundaries.llm import ILLM, LLMRequest
+from sbilifeco.boundaries.llm_metrics import LLMMetrics
+from sbilifeco.models.base import Response
+
+
+class ReplyCacheMetrics(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    entries: int = 0
+    bytes: int = 0
+
+
+class IReplyCacheBackend(Protocol):
+    async def get(self, key: str) -> str | None:
+        raise NotImplementedError()
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        raise NotImplementedError()
+
+
+class InMemoryReplyCache(IReplyCacheBackend):
+    """Least-recently-used replies, bounded by total size in bytes, each with a TTL."""
+
+    def __init__(self) -> None:
+        self.max_bytes = 64 * 1024 * 1024
+        self.entries: OrderedDict[str, tuple[str, float, int]] = OrderedDict()
+        self.bytes = 0
+
+    def set_max_bytes(self, max_bytes: int) -> InMemoryReplyCache:
+        self.max_bytes = max_bytes
+        return self
+
+    async def get(self, key: str) -> str | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at, _ = entry
+        if expires_at < monotonic():
+            self._remove(key)
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self._remove(key)
+
+        self.entries[key] = (value, monotonic() + ttl, size)
+        self.bytes += size
+
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: str) -> None:
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
+
+
+class RedisReplyCache(IReplyCacheBackend):
+    """Replies shared between processes and replicas through Redis.
+
+    Needs the optional `redis` dependency (`sbilifeco-gateway-vertex[redis]`).
+    """
+
+    def __init__(self) -> None:
+        self.url = "redis://localhost:6379/0"
+        self.key_prefix = "llm-reply:"
+        self.redis = None
+
+    def set_url(self, url: str) -> RedisReplyCache:
+        self.url = url
+        return self
+
+    def set_key_prefix(self, key_prefix: str) -> RedisReplyCache:
+        self.key_prefix = key_prefix
+        return self
+
+    async def async_init(self) -> None:
+        from redis.asyncio import Redis
+
+        self.redis = Redis.from_url(self.url, decode_responses=True)
+
+    async def async_shutdown(self) -> None:
+        if self.redis is not None:
+            await self.redis.aclose()
+            self.redis = None
+
+    async def get(self, key: str) -> str | None:
+        if self.redis is None:
+            return None
+        return await self.redis.get(self.key_prefix + key)
+
+    async def set(self, key: str, value: str, ttl: float) -> None:
+        if self.redis is None:
+            return
+        await self.redis.set(self.key_prefix + key, value, px=int(ttl * 1000))
+
+
+class CachedLLM(ILLM):
+    """Serves repeated `generate_reply` calls from a cache.
+
+    Replies from the wrapped gateway are deterministic (temperature 0), so a
+    reply can be reused for the same model, output limit and context. Streamed
+    replies are passed through untouched.
+    """
+
+    def __init__(self) -> None:
+        self.llm: ILLM
+        self.backend: IReplyCacheBackend = InMemoryReplyCache()
+        self.ttl = 3600.0
+        self.counters = ReplyCacheMetrics()
+
+    def set_llm(self, llm: ILLM) -> CachedLLM:
+        self.llm = llm
+        return self
+
+    def set_backend(self, backend: IReplyCacheBackend) -> CachedLLM:
+        self.backend = backend
+        return self
+
+    def set_ttl(self, ttl: float) -> CachedLLM:
+        self.ttl = ttl
+        return self
+
+    def cache_key(self, context: str) -> str:
+        parameters = {
+            "model": getattr(self.llm, "model", ""),
+            "max_output_tokens": getattr(self.llm, "max_output_tokens", None),
+            "temperature": 0,
+            "context": sha256(context.encode("utf-8")).hexdigest(),
+        }
+        return sha256(dumps(parameters, sort_keys=True).encode("utf-8")).hexdigest()
+
+    async def generate_reply(self, context: str) -> Response[str]:
+        key = self.cache_key(context)
+
+        try:
+            cached = await self.backend.get(key)
+        except Exception as e:
+            print(f"Reply cache lookup failed, going to the LLM: {e}", flush=True)
+            cached = None
+
+        if cached is not None:
+            self.counters.hits += 1
+            return Response.ok(cached)
+
+        self.counters.misses += 1
+        response = await self.llm.generate_reply(context)
+
+        if response.is_success and response.payload is not None:
+            try:
+                await self.backend.set(key, response.payload, self.ttl)
+                self.counters.stores += 1
+            except Exception as e:
+                print(f"Unable to store reply in cache: {e}", flush=True)
+
+        return response
+
+    async def generate_streamed_reply(
+        self, request: LLMRequest
+    ) -> Response[AsyncGenerator[str, None]]:
+        return await self.llm.generate_streamed_reply(request)
+
+    def metrics(self) -> ReplyCacheMetrics:
+        update = {}
+        if isinstance(self.backend, InMemoryReplyCache):
+            update = {
+                "entries": len(self.backend.entries),
+                "bytes": self.backend.bytes,
+            }
+        return self.counters.model_copy(update=update)
+
+    def add_metrics(self, metrics: LLMMetrics) -> None:
+        """Reports the counters, and the size of an in-memory cache, to `metrics`."""
+        for name, help, read in [
+            (
+                "llm_reply_cache_hits_total",
+                "Replies served from the cache.",
+                lambda: self.counters.hits,
+            ),
+            (
+                "llm_reply_cache_misses_total",
+                "Replies not found in the cache.",
+                lambda: self.counters.misses,
+            ),
+            (
+                "llm_reply_cache_stores_total",
+                "Replies stored in the cache.",
+                lambda: self.counters.stores,
+            ),
+        ]:
+            metrics.add_counter(name, help, read)
+        if isinstance(self.backend, InMemoryReplyCache):
+            metrics.add_gauge(
+                "llm_reply_cache_entries",
+                "Replies held in the cache.",
+                lambda: self.metrics().entries,
+            )
+            metrics.add_gauge(
+                "llm_reply_cache_bytes",
+                "Size of the replies held in the cache.",
+                lambda: self.metrics().bytes,
+            )
@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+from asyncio import (
+    FIRST_COMPLETED,
+    Task,
+    TimeoutError,
+    create_task,
+    sleep,
+    wait,
+    wait_for,
+)
+from collections import deque
+from random import uniform
+from time import monotonic
+from typing import Awaitable, Callable, Generic, TypeVar
+
+from pydantic import BaseModel
+from sbilifeco.boundaries.llm_metrics import LLMMetrics
+
+ResultT = TypeVar("ResultT")
+
+
+class RetryMetrics(BaseModel):
+    calls: int = 0
+    attempts: int = 0
+    """Upstream attempts made, including retries and hedges."""
+
+    retries: int = 0
+    hedges: int = 0
+    """Second attempts launched because the first was slower than the hedge delay."""
+
+    hedges_won: int = 0
+    """Hedges that returned before the attempt they were hedging."""
+
+    deadlines_exceeded: int = 0
+
+
+class RetryPolicy(Generic[ResultT]):
+    """Runs a call within a deadline, retrying and optionally hedging it.
+
+    Retryable failures are retried with full-jitter exponential backoff for
+    as long as attempts and the deadline allow. With hedging on, an attempt
+    still running after the recent p95 latency gets a twin, and whichever
+    succeeds first wins; the other is cancelled.
+    """
+
+    def __init__(self) -> None:
+        self.deadline = 120.0
+        self.max_attempts = 3
+        self.base_delay = 0.5
+        self.max_delay = 8.0
+        self.is_hedging = False
+        self.hedge_percentile = 0.95
+        self.min_hedge_delay = 1.0
+        self.min_latency_samples = 20
+        self.latencies: deque[float] = deque(maxlen=500)
+        self.counters = RetryMetrics()
+
+    def set_deadline(self, deadline: float) -> RetryPolicy[ResultT]:
+        """Seconds allowed for the call, all attempts included. 0 means no deadline."""
+        self.deadline = deadline
+        return self
+
+    def set_max_attempts(self, max_attempts: int) -> RetryPolicy[ResultT]:
+        self.max_attempts = max(1, max_attempts)
+        return self
+
+    def set_base_delay(self, base_delay: float) -> RetryPolicy[ResultT]:
+        self.base_delay = base_delay
+        return self
+
+    def set_max_delay(self, max_delay: float) -> RetryPolicy[ResultT]:
+        self.max_delay = max_delay
+        return self
+
+    def set_hedging(self, is_hedging: bool) -> RetryPolicy[ResultT]:
+        self.is_hedging = is_hedging
+        return self
+
+    def set_hedge_percentile(self, hedge_percentile: float) -> RetryPolicy[ResultT]:
+        self.hedge_percentile = hedge_percentile
+        return self
+
+    def set_min_hedge_delay(self, min_hedge_delay: float) -> RetryPolicy[ResultT]:
+        self.min_hedge_delay = min_hedge_delay
+        return self
+
+    def hedge_delay(self) -> float | None:
+        """Latency after which an attempt is hedged, or None while it is not known yet."""
+        if not self.is_hedging or len(self.latencies) < self.min_latency_samples:
+            return None
+
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile))
+        return max(self.min_hedge_delay, ordered[index])
+
+    async def call(
+        self,
+        attempt: Callable[[], Awaitable[ResultT]],
+        is_retryable: Callable[[Exception], bool],
+    ) -> ResultT:
+        """Result of `attempt`. Raises `TimeoutError` once the deadline has passed."""
+        self.counters.calls += 1
+        try:
+            if self.deadline > 0:
+                return await wait_for(
+                    self._call(attempt, is_retryable), self.deadline
+                )
+            return await self._call(attempt, is_retryable)
+        except TimeoutError:
+            self.counters.deadlines_exceeded += 1
+            raise
+
+    def metrics(self) -> RetryMetrics:
+        return self.counters.model_copy()
+
+    def add_metrics(self, metrics: LLMMetrics, **labels: str) -> None:
+        """Reports the counters to `metrics` with `labels`."""
+        for name, help, read in [
+            (
+                "llm_vertex_calls_total",
+                "Calls to Vertex AI, however many attempts each took.",
+                lambda: self.counters.calls,
+            ),
+            (
+                "llm_vertex_attempts_total",
+                "Attempts at Vertex AI calls, including retries and hedges.",
+                lambda: self.counters.attempts,
+            ),
+            (
+                "llm_vertex_retries_total",
+                "Attempts retried after a retryable error.",
+                lambda: self.counters.retries,
+            ),
+            (
+                "llm_vertex_hedges_total",
+                "Second attempts launched because the first was slower than the hedge delay.",
+                lambda: self.counters.hedges,
+            ),
+            (
+                "llm_vertex_hedges_won_total",
+                "Hedges that returned before the attempt they were hedging.",
+                lambda: self.counters.hedges_won,
+            ),
+            (
+                "llm_vertex_deadlines_exceeded_total",
+                "Calls that ran out of time, retries and all.",
+                lambda: self.counters.deadlines_exceeded,
+            ),
+        ]:
+            metrics.add_counter(name, help, read, **labels)
+
+    async def _call(
+        self,
+        attempt: Callable[[], Awaitable[ResultT]],
+        is_retryable: Callable[[Exception], bool],
+    ) -> ResultT:
+        for attempt_number in range(1, self.max_attempts + 1):
+            try:
+                return await self._hedged(attempt)
+            except Exception as e:
+                if attempt_number == self.max_attempts or not is_retryable(e):
+                    raise
+
+                delay = uniform(
+                    0, min(self.max_delay, self.base_delay * 2 ** (attempt_number - 1))
+                )
+                print(
+                    f"Attempt {attempt_number} failed with {e!r}, retrying in {delay:.2f}s",
+                    flush=True,
+                )
+                self.counters.retries += 1
+                await sleep(delay)
+
+        raise RuntimeError("No attempts were made")
+
+    async def _hedged(self, attempt: Callable[[], Awaitable[ResultT]]) -> ResultT:
+        first = create_task(self._timed(attempt))
+        pending: set[Task[ResultT]] = {first}
+
+        try:
+            hedge_delay = self.hedge_delay()
+            if hedge_delay is None:
+                return await first
+
+            done, _ = await wait(pending, timeout=hedge_delay)
+            if not done:
+                print(
+                    f"No reply after {hedge_delay:.2f}s, hedging with a second attempt",
+                    flush=True,
+                )
+                self.counters.hedges += 1
+                pending.add(create_task(self._timed(attempt)))
+
+            error: BaseException | None = None
+            while pending:
+                done, pending = await wait(pending, return_when=FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.counters.hedges_won += 1
+                        return task.result()
+                    error = task.exception()
+
+            assert error is not None
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _timed(self, attempt: Callable[[], Awaitable[ResultT]]) -> ResultT:
+        self.counters.attempts += 1
+        started_at = monotonic()
+        result = await attempt()
+        self.latencies.append(monotonic() - started_at)
+        return result
@@ -0,0 +1,404 @@
+from __future__ import annotations
+
+from io import BufferedIOBase, RawIOBase, TextIOBase
+from statistics import median
+from time import monotonic
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, TypeVar
+
+from pydantic import BaseModel
+from sbilifeco.boundaries.llm import ILLM, LLMRequest
+from sbilifeco.boundaries.llm_metrics import LLMMetrics
+from sbilifeco.boundaries.material_reader import BaseMaterialReader
+from sbilifeco.models.base import Response
+from sbilifeco.gateways.vertex import VertexAI
+from sbilifeco.gateways.vertex_admission import AdmissionControlledLLM
+from sbilifeco.gateways.vertex_gemini import VertexGemini
+from sbilifeco.gateways.vertex_tracked_stream import TrackedStream
+
+PayloadT = TypeVar("PayloadT")
+
+
+class BackendMetrics(BaseModel):
+    name: str
+    weight: float
+    outstanding: int
+    circuit: str
+    """closed, open or half-open."""
+
+    successes: int
+    failures: int
+    average_latency: float
+
+
+class CircuitBreaker:
+    """Stops sending calls to a backend after repeated failures.
+
+    After `failure_threshold` consecutive failures the circuit opens and the
+    backend gets no calls for `open_for` seconds. Then a single trial call is
+    let through (half-open): its success closes the circuit again, its
+    failure opens it for another `open_for` seconds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = 5, open_for: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.open_for = open_for
+        self.consecutive_failures = 0
+        self.opened_at: float | None = None
+        self.is_trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        if monotonic() - self.opened_at < self.open_for:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allows(self) -> bool:
+        state = self.state
+        return state == self.CLOSED or (
+            state == self.HALF_OPEN and not self.is_trial_in_flight
+        )
+
+    def on_call(self) -> None:
+        if self.state == self.HALF_OPEN:
+            self.is_trial_in_flight = True
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.is_trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if (
+            self.state == self.HALF_OPEN
+            or self.consecutive_failures >= self.failure_threshold
+        ):
+            self.opened_at = monotonic()
+        self.is_trial_in_flight = False
+
+    def record_skipped(self) -> None:
+        """A call the backend turned away without trying it, which says nothing of its health."""
+        self.is_trial_in_flight = False
+
+
+class _Backend:
+    def __init__(
+        self,
+        gateway: VertexAI | VertexGemini | AdmissionControlledLLM,
+        weight: float,
+        breaker: CircuitBreaker,
+    ) -> None:
+        self.gateway = gateway
+        self.weight = weight
+        self.breaker = breaker
+        self.outstanding = 0
+        self.successes = 0
+        self.failures = 0
+        self.average_latency = 0.0
+
+    @property
+    def name(self) -> str:
+        return f"{self.gateway.region}/{self.gateway.model}"
+
+
+class VertexRouter(ILLM, BaseMaterialReader):
+    """Spreads calls over several Vertex gateways across regions and models.
+
+    Each call goes to the allowed backend with the fewest outstanding calls
+    for its weight. A backend whose call fails with a 429 or 5xx, or which
+    is far slower than its peers, is counted as failing by its circuit
+    breaker, and the call fails over to the next backend. A prompt too large
+    for a backend's token budget (413) fails over too, so that a model with
+    a larger context window can take it, without counting against the
+    backend. Other client errors are returned as they are.
+
+    Material IDs are prefixed with the index of the backend that read the
+    material, so later chunks are fetched from the same backend.
+    """
+
+    def __init__(self) -> None:
+        BaseMaterialReader.__init__(self)
+        self.backends: list[_Backend] = []
+        self.failure_threshold = 5
+        self.open_for = 30.0
+        self.latency_outlier_factor = 3.0
+        self.load_metrics = LLMMetrics()
+
+    def add_backend(
+        self,
+        gateway: VertexAI | VertexGemini | AdmissionControlledLLM,
+        weight: float = 1.0,
+    ) -> VertexRouter:
+        """A gateway to route to, or an `AdmissionControlledLLM` in front of one."""
+        self.backends.append(
+            _Backend(
+                gateway, weight, CircuitBreaker(self.failure_threshold, self.open_for)
+            )
+        )
+        return self
+
+    def set_failure_threshold(self, failure_threshold: int) -> VertexRouter:
+        """Consecutive failures after which a backend's circuit opens."""
+        self.failure_threshold = failure_threshold
+        for backend in self.backends:
+            backend.breaker.failure_threshold = failure_threshold
+        return self
+
+    def set_open_for(self, open_for: float) -> VertexRouter:
+        """Seconds an open circuit keeps its backend out of rotation."""
+        self.open_for = open_for
+        for backend in self.backends:
+            backend.breaker.open_for = open_for
+        return self
+
+    def set_latency_outlier_factor(self, factor: float) -> VertexRouter:
+        """How many times slower than the median backend a call may be before it counts as a failure."""
+        self.latency_outlier_factor = factor
+        return self
+
+    def set_metrics(self, metrics: LLMMetrics) -> VertexRouter:
+        """Where the load and health of each backend are reported."""
+        self.load_metrics = metrics
+        return self
+
+    @property
+    def model(self) -> str:
+        return ",".join(sorted({backend.gateway.model for backend in self.backends}))
+
+    async def async_init(self) -> None:
+        for backend in self.backends:
+            self._add_metrics(backend)
+        for backend in self.backends:
+            print(f"Starting Vertex backend {backend.name}", flush=True)
+            await backend.gateway.async_init()
+
+    async def async_shutdown(self) -> None:
+        for backend in self.backends:
+            await backend.gateway.async_shutdown()
+
+    def metrics(self) -> list[BackendMetrics]:
+        return [
+            BackendMetrics(
+                name=backend.name,
+                weight=backend.weight,
+                outstanding=backend.outstanding,
+                circuit=backend.breaker.state,
+                successes=backend.successes,
+                failures=backend.failures,
+                average_latency=backend.average_latency,
+            )
+            for backend in self.backends
+        ]
+
+    def _add_metrics(self, backend: _Backend) -> None:
+        for name, help, read in [
+            (
+                "llm_router_successes_total",
+                "Calls a backend completed.",
+                lambda: backend.successes,
+            ),
+            (
+                "llm_router_failures_total",
+                "Calls a backend failed, as counted by its circuit breaker.",
+                lambda: backend.failures,
+            ),
+        ]:
+            self.load_metrics.add_counter(name, help, read, backend=backend.name)
+        self.load_metrics.add_gauge(
+            "llm_router_outstanding_calls",
+            "Calls routed to a backend and not yet done.",
+            lambda: backend.outstanding,
+            backend=backend.name,
+        ).add_gauge(
+            "llm_router_average_latency_seconds",
+            "Moving average of a backend's call latency.",
+            lambda: backend.average_latency,
+            backend=backend.name,
+        )
+        for state in [
+            CircuitBreaker.CLOSED,
+            CircuitBreaker.OPEN,
+            CircuitBreaker.HALF_OPEN,
+        ]:
+            self.load_metrics.add_gauge(
+                "llm_router_circuit_state",
+                "1 for the state a backend's circuit breaker is in, 0 for the others.",
+                lambda state=state: float(backend.breaker.state == state),
+                backend=backend.name,
+                state=state,
+            )
+
+    async def generate_reply(self, context: str) -> Response[str]:
+        response, _ = await self._route(
+            lambda gateway: gateway.generate_reply(context), overflow_fails_over=True
+        )
+        return response
+
+    async def generate_streamed_reply(
+        self, request: LLMRequest
+    ) -> Response[AsyncGenerator[str, None]]:
+        response, _ = await self._route(
+            lambda gateway: gateway.generate_streamed_reply(request),
+            is_stream=True,
+            overflow_fails_over=True,
+        )
+        return response
+
+    async def read_and_chunk(
+        self,
+        material: str | bytes | bytearray | RawIOBase | BufferedIOBase | TextIOBase,
+    ) -> Response[AsyncIterator[str | bytes]]:
+        response, _ = await self._route(
+            lambda gateway: gateway.read_and_chunk(material)
+        )
+        return response
+
+    async def read_material(
+        self,
+        material: str | bytes | bytearray | RawIOBase | BufferedIOBase | TextIOBase,
+    ) -> Response[str]:
+        response, backend = await self._route(
+            lambda gateway: gateway.read_material(material)
+        )
+        if not response.is_success or response.payload is None or backend is None:
+            return response
+
+        return Response.ok(f"{self.backends.index(backend)}:{response.payload}")
+
+    async def read_next_chunk(
+        self, material_id: str
+    ) -> Response[str | bytes | bytearray]:
+        index, _, backend_material_id = material_id.partition(":")
+        if not index.isdigit() or int(index) >= len(self.backends):
+            return Response.fail(f"Unable to find chunked material {material_id}", 404)
+
+        return await self.backends[int(index)].gateway.read_next_chunk(
+            backend_material_id
+        )
+
+    async def _route(
+        self,
+        call: Callable[
+            [VertexAI | VertexGemini | AdmissionControlledLLM],
+            Awaitable[Response[PayloadT]],
+        ],
+        is_stream: bool = False,
+        overflow_fails_over: bool = False,
+    ) -> tuple[Response[PayloadT], _Backend | None]:
+        """The first useful response, and the backend that gave it."""
+        if not self.backends:
+            return Response.fail("No Vertex backends are configured", 503), None
+
+        tried: set[int] = set()
+        response: Response[PayloadT] | None = None
+
+        while (backend := self._pick(tried)) is not None:
+            tried.add(id(backend))
+            backend.breaker.on_call()
+            backend.outstanding += 1
+            started_at = monotonic()
+
+            try:
+                response = await call(backend.gateway)
+            except Exception as e:
+                response = Response.error(e)
+
+            if response.is_success:
+                if is_stream and response.payload is not None:
+                    # A stream stays outstanding until it ends. Its duration
+                    # says more about the reply's length than the backend's
+                    # speed, so it is not used as a latency sample.
+                    stream = TrackedStream(
+                        response.payload,  # type: ignore[arg-type]
+                        on_close=lambda _, backend=backend: self._on_done(
+                            backend, None, True
+                        ),
+                    )
+                    return Response.ok(stream), backend  # type: ignore[return-value]
+
+                await self._on_done(backend, monotonic() - started_at, True)
+                return response, backend
+
+            if overflow_fails_over and response.code == 413:
+                # Turned away before reaching the model, so it is not a failure
+                backend.outstanding -= 1
+                backend.breaker.record_skipped()
+                print(
+                    f"Vertex backend {backend.name} cannot fit the prompt: {response.message}, failing over",
+                    flush=True,
+                )
+                continue
+
+            await self._on_done(backend, None, False)
+            if not self._is_failover_worthy(response):
+                return response, backend
+
+            print(
+                f"Vertex backend {backend.name} failed with {response.code}: {response.message}, failing over",
+                flush=True,
+            )
+
+        if response is None:
+            response = Response.fail(
+                "All Vertex backends are unavailable, their circuits are open", 503
+            )
+        return response, None
+
+    def _pick(self, tried: set[int]) -> _Backend | None:
+        candidates = [
+            backend
+            for backend in self.backends
+            if id(backend) not in tried and backend.breaker.allows()
+        ]
+        if not candidates:
+            return None
+        return min(
+            candidates, key=lambda backend: (backend.outstanding + 1) / backend.weight
+        )
+
+    async def _on_done(
+        self, backend: _Backend, latency: float | None, is_success: bool
+    ) -> None:
+        backend.outstanding -= 1
+
+        if is_success and latency is not None and self._is_latency_outlier(
+            backend, latency
+        ):
+            print(
+                f"Vertex backend {backend.name} took {latency:.2f}s, far slower than its peers",
+                flush=True,
+            )
+            is_success = False
+
+        if is_success:
+            backend.successes += 1
+            backend.breaker.record_success()
+            if latency is not None:
+                backend.average_latency = (
+                    latency
+                    if backend.average_latency == 0
+                    else 0.9 * backend.average_latency + 0.1 * latency
+                )
+        else:
+            backend.failures += 1
+            backend.breaker.record_failure()
+
+    def _is_latency_outlier(self, backend: _Backend, latency: float) -> bool:
+        peer_latencies = [
+            peer.average_latency
+            for peer in self.backends
+            if peer is not backend and peer.average_latency > 0
+        ]
+        if not peer_latencies:
+            return False
+        return latency > median(peer_latencies) * self.latency_outlier_factor
+
+    def _is_failover_worthy(self, response: Response) -> bool:
+        """Quota, server and availability errors are worth trying elsewhere; client errors are not."""
+        return response.code == 429 or response.code >= 500
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from hashlib import sha256
+from math import ceil
+from typing import Awaitable, Callable
+
+from pydantic import BaseModel
+from sbilifeco.boundaries.llm_metrics import LLMMetrics
+
+
+class TokenBudgetMetrics(BaseModel):
+    estimates: int = 0
+    exact_counts: int = 0
+    cached_counts: int = 0
+    rejected: int = 0
+    truncated: int = 0
+
+
+class TokenBudgetExceeded(Exception):
+    def __init__(self, tokens: int, limit: int) -> None:
+        super().__init__(
+            f"The prompt is about {tokens} tokens, over the {limit} this model has room for"
+        )
+        self.tokens = tokens
+        self.limit = limit
+
+
+class TokenBudget:
+    """Sizes a request against the model's context window before it is sent.
+
+    Prompts are estimated locally from their UTF-8 size, which errs on the
+    high side for English and is close for Indic scripts. Only estimates
+    clearly under the limit, by more than `exact_margin` of it, are trusted;
+    for the rest the model's own `count_tokens` is called before a prompt is
+    cut or rejected, and its counts are remembered by content hash. A
+    prompt that leaves less than `min_output_tokens` of the window for the
+    reply is rejected, or with the truncate policy has its middle cut out, so
+    instructions at the start and the question at the end survive. The reply
+    gets what is left of the window, up to the gateway's output limit.
+    """
+
+    REJECT = "reject"
+    TRUNCATE = "truncate"
+
+    def __init__(self) -> None:
+        self.context_window = 200000
+        self.min_output_tokens = 1024
+        self.overflow = self.REJECT
+        self.bytes_per_token = 4.0
+        self.exact_margin = 0.1
+        self.count_tokens: Callable[[str], Awaitable[int]] | None = None
+        self.max_entries = 4096
+        self.counts: OrderedDict[str, int] = OrderedDict()
+        self.counters = TokenBudgetMetrics()
+
+    def set_context_window(self, context_window: int) -> TokenBudget:
+        """Tokens the model takes for prompt and reply together."""
+        self.context_window = context_window
+        return self
+
+    def set_min_output_tokens(self, min_output_tokens: int) -> TokenBudget:
+        self.min_output_tokens = min_output_tokens
+        return self
+
+    def set_overflow(self, overflow: str) -> TokenBudget:
+        """REJECT or TRUNCATE prompts too large for the window."""
+        self.overflow = overflow
+        return self
+
+    def set_bytes_per_token(self, bytes_per_token: float) -> TokenBudget:
+        self.bytes_per_token = bytes_per_token
+        return self
+
+    def set_exact_margin(self, exact_margin: float) -> TokenBudget:
+        """Fraction of the limit below it within which estimates are checked with `count_tokens`. 0 checks only estimates over the limit."""
+        self.exact_margin = exact_margin
+        return self
+
+    def set_count_tokens(
+        self, count_tokens: Callable[[str], Awaitable[int]]
+    ) -> TokenBudget:
+        self.count_tokens = count_tokens
+        return self
+
+    def metrics(self) -> TokenBudgetMetrics:
+        return self.counters.model_copy()
+
+    def add_metrics(self, metrics: LLMMetrics, **labels: str) -> None:
+        """Reports the counters to `metrics` with `labels`."""
+        for name, help, read in [
+            (
+                "llm_token_estimates_total",
+                "Prompts sized by estimating their tokens from their length.",
+                lambda: self.counters.estimates,
+            ),
+            (
+                "llm_token_exact_counts_total",
+                "Prompts sized by counting their tokens with the model.",
+                lambda: self.counters.exact_counts,
+            ),
+            (
+                "llm_token_cached_counts_total",
+                "Prompts sized from an earlier exact count.",
+                lambda: self.counters.cached_counts,
+            ),
+            (
+                "llm_token_budget_rejected_total",
+                "Prompts rejected as too large for the context window.",
+                lambda: self.counters.rejected,
+            ),
+            (
+                "llm_token_budget_truncated_total",
+                "Prompts cut down to fit the context window.",
+                lambda: self.counters.truncated,
+            ),
+        ]:
+            metrics.add_counter(name, help, read, **labels)
+
+    def estimate(self, text: str) -> int:
+        return ceil(len(text.encode("utf-8")) / self.bytes_per_token)
+
+    async def fit(
+        self, prompt: str, max_output_tokens: int, fixed: str = ""
+    ) -> tuple[str, int]:
+        """`prompt`, cut to fit if need be, and the output tokens left for the reply.
+
+        `fixed` is sent before the prompt and counts against the window, but
+        is never cut, like a cached prefix.
+        """
+        limit = self.context_window - self.min_output_tokens
+        fixed_tokens = await self._count(fixed, limit)
+        tokens = fixed_tokens + await self._count(prompt, limit - fixed_tokens)
+
+        # Each cut is sized by the last count, so a few rounds settle it
+        for _ in range(3):
+            if tokens <= limit:
+                return prompt, min(max_output_tokens, self.context_window - tokens)
+            if self.overflow != self.TRUNCATE or fixed_tokens >= limit:
+                break
+
+            keep = int(len(prompt) * (limit - fixed_tokens) / (tokens - fixed_tokens))
+            keep = int(keep * 0.95)
+            prompt = prompt[: keep // 2] + "\n...\n" + prompt[len(prompt) - keep // 2 :]
+            tokens = fixed_tokens + await self._count(prompt, limit - fixed_tokens)
+            self.counters.truncated += 1
+
+        self.counters.rejected += 1
+        raise TokenBudgetExceeded(tokens, limit)
+
+    async def reply_tokens(
+        self, prompt: str, max_output_tokens: int, fixed: str = ""
+    ) -> int:
+        """Output tokens left for the reply to `prompt`, which unlike with `fit` is never cut.
+
+        For prompts only of use whole, such as documents to chunk.
+        """
+        limit = self.context_window - self.min_output_tokens
+        fixed_tokens = await self._count(fixed, limit)
+        tokens = fixed_tokens + await self._count(prompt, limit - fixed_tokens)
+        if tokens > limit:
+            self.counters.rejected += 1
+            raise TokenBudgetExceeded(tokens, limit)
+        return min(max_output_tokens, self.context_window - tokens)
+
+    async def _count(self, text: str, limit: int) -> int:
+        if not text:
+            return 0
+
+        estimate = self.estimate(text)
+        self.counters.estimates += 1
+        # No count can make room when there is none left
+        if (
+            self.count_tokens is None
+            or limit <= 0
+            or estimate < limit * (1 - self.exact_margin)
+        ):
+            return estimate
+
+        key = sha256(text.encode("utf-8")).hexdigest()
+        count = self.counts.get(key)
+        if count is not None:
+            self.counts.move_to_end(key)
+            self.counters.cached_counts += 1
+            return count
+
+        try:
+            count = await self.count_tokens(text)
+        except Exception as e:
+            print(f"Unable to count tokens, going by the estimate: {e}", flush=True)
+            return estimate
+
+        self.counters.exact_counts += 1
+        self.counts[key] = count
+        while len(self.counts) > self.max_entries:
+            self.counts.popitem(last=False)
+        return count
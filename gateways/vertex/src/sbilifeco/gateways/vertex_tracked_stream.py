@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+from time import monotonic
+from typing import AsyncGenerator, Awaitable, Callable
+
+from sbilifeco.boundaries.llm import ReplyStats
+
+
+class TrackedStream(AsyncGenerator[str, None]):
+    """Passes a stream through and reports once when it is finished or closed.
+
+    `on_close` receives the time to the first chunk, counted from
+    `started_at` (by default, now), or None if there was none. Unlike a
+    wrapping async generator, this also reports a stream that is closed
+    before it was ever read. The stream's `stats`, if any, are passed on.
+    """
+
+    def __init__(
+        self,
+        stream: AsyncGenerator[str, None],
+        on_close: Callable[[float | None], Awaitable[None]],
+        started_at: float | None = None,
+    ) -> None:
+        self.stream = stream
+        self.stats: ReplyStats | None = getattr(stream, "stats", None)
+        self.on_close = on_close
+        self.started_at = monotonic() if started_at is None else started_at
+        self.time_to_first_chunk: float | None = None
+        self.is_closed = False
+
+    async def asend(self, value: None) -> str:
+        try:
+            chunk = await self.stream.asend(value)
+        except BaseException:
+            await self.aclose()
+            raise
+
+        if self.time_to_first_chunk is None:
+            self.time_to_first_chunk = monotonic() - self.started_at
+        return chunk
+
+    async def athrow(self, typ, val=None, tb=None) -> str:  # type: ignore[override]
+        return await self.stream.athrow(typ, val, tb)
+
+    async def aclose(self) -> None:
+        if self.is_closed:
+            return
+
+        self.is_closed = True
+        try:
+            await self.stream.aclose()
+        finally:
+            await self.on_close(self.time_to_first_chunk)
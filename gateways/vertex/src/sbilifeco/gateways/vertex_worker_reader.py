@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+from asyncio import (
+    Server,
+    StreamReader,
+    StreamWriter,
+    open_unix_connection,
+    start_unix_server,
+    wait_for,
+)
+from base64 import b64decode, b64encode
+from io import BufferedIOBase, RawIOBase, TextIOBase
+from json import dumps, loads
+from os import getpid, remove
+from os.path import join
+from tempfile import gettempdir
+from typing import AsyncIterator
+
+from sbilifeco.boundaries.material_reader import BaseMaterialReader
+from sbilifeco.models.base import Response
+
+
+class WorkerMaterialReader(BaseMaterialReader):
+    """Lets every worker process serve materials, each one's chunks from the worker that read it.
+
+    The chunks of a material come from a stream in the memory of the worker
+    that read it, so material IDs are prefixed with that worker's ID, its
+    process ID. A worker asked for the next chunk of another worker's
+    material relays the call over that worker's Unix socket in the relay
+    directory. Materials read and chunked in one call need no relaying. The
+    materials of a worker that stopped are gone, as they were before.
+    """
+
+    def __init__(self) -> None:
+        BaseMaterialReader.__init__(self)
+        self.reader: BaseMaterialReader
+        self.worker_id = str(getpid())
+        self.relay_directory = gettempdir()
+        self.relay_timeout = 300.0
+        self.server: Server | None = None
+
+    def set_reader(self, reader: BaseMaterialReader) -> WorkerMaterialReader:
+        self.reader = reader
+        return self
+
+    def set_relay_directory(self, relay_directory: str) -> WorkerMaterialReader:
+        """Where the workers of one service keep their relay sockets."""
+        self.relay_directory = relay_directory
+        return self
+
+    def set_relay_timeout(self, relay_timeout: float) -> WorkerMaterialReader:
+        """Seconds to wait for another worker's next chunk."""
+        self.relay_timeout = relay_timeout
+        return self
+
+    async def async_init(self) -> None:
+        path = self._relay_path(self.worker_id)
+        self._remove(path)  # left behind by a killed worker with the same process ID
+        self.server = await start_unix_server(self._serve_relay, path)
+
+    async def async_shutdown(self) -> None:
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        self._remove(self._relay_path(self.worker_id))
+
+    async def read_and_chunk(
+        self,
+        material: str | bytes | bytearray | RawIOBase | BufferedIOBase | TextIOBase,
+    ) -> Response[AsyncIterator[str | bytes]]:
+        return await self.reader.read_and_chunk(material)
+
+    async def read_material(
+        self,
+        material: str | bytes | bytearray | RawIOBase | BufferedIOBase | TextIOBase,
+    ) -> Response[str]:
+        response = await self.reader.read_material(material)
+        if not response.is_success or response.payload is None:
+            return response
+
+        return Response.ok(f"{self.worker_id}:{response.payload}")
+
+    async def read_next_chunk(
+        self, material_id: str
+    ) -> Response[str | bytes | bytearray]:
+        worker_id, _, reader_material_id = material_id.partition(":")
+        if not worker_id.isdigit():
+            return Response.fail(f"Unable to find chunked material {material_id}", 404)
+
+        if worker_id == self.worker_id:
+            return await self.reader.read_next_chunk(reader_material_id)
+        return await self._relay(worker_id, reader_material_id)
+
+    async def _relay(
+        self, worker_id: str, material_id: str
+    ) -> Response[str | bytes | bytearray]:
+        try:
+            reader, writer = await open_unix_connection(self._relay_path(worker_id))
+        except (FileNotFoundError, ConnectionRefusedError):
+            return Response.fail(
+                f"Unable to find chunked material {worker_id}:{material_id}, its worker has stopped",
+                404,
+            )
+
+        try:
+            writer.write(material_id.encode("utf-8") + b"\n")
+            await writer.drain()
+            return self._decode(await wait_for(reader.read(), self.relay_timeout))
+        except Exception as e:
+            print(
+                f"Unable to relay material {material_id} to worker {worker_id}: {e}",
+                flush=True,
+            )
+            return Response.error(e)
+        finally:
+            writer.close()
+
+    async def _serve_relay(self, reader: StreamReader, writer: StreamWriter) -> None:
+        try:
+            material_id = (await reader.readline()).decode("utf-8").strip()
+            response = await self.reader.read_next_chunk(material_id)
+            writer.write(self._encode(response))
+            await writer.drain()
+        except Exception as e:
+            print(f"Unable to relay a chunk to another worker: {e}", flush=True)
+        finally:
+            writer.close()
+
+    def _relay_path(self, worker_id: str) -> str:
+        return join(self.relay_directory, f"vertex-llm-{worker_id}.sock")
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _encode(response: Response[str | bytes | bytearray]) -> bytes:
+        message: dict[str, str | int | bool] = {
+            "is_success": response.is_success,
+            "code": response.code,
+            "message": response.message,
+        }
+        if isinstance(response.payload, (bytes, bytearray)):
+            message["data"] = b64encode(response.payload).decode("ascii")
+        elif response.payload is not None:
+            message["text"] = response.payload
+        return dumps(message).encode("utf-8")
+
+    @staticmethod
+    def _decode(data: bytes) -> Response[str | bytes | bytearray]:
+        message = loads(data)
+        if not message["is_success"]:
+            return Response.fail(message["message"], message["code"])
+        if "data" in message:
+            return Response.ok(b64decode(message["data"]))
+        return Response.ok(message.get("text"))
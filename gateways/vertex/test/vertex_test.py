@@ -1,4 +1,18 @@
 import sys
+from base64 import b64decode
+from sys import executable
+from asyncio import create_task, gather, sleep
+from functools import partial
+from io import BytesIO
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from os import environ, listdir, pathsep, urandom
+from os.path import exists, getsize, join
+from subprocess import run
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from threading import Thread
+from textwrap import dedent
+from time import monotonic, perf_counter, sleep as blocking_sleep
+from unittest.mock import AsyncMock, MagicMock, patch
 from uuid import uuid4
 
 sys.path.append("./src")
@@ -10,8 +24,34 @@ from envvars import EnvVars, Defaults
 
 # Import the necessary service(s) here
 from sbilifeco.boundaries.llm import LLMRequest
+from sbilifeco.boundaries.llm_metrics import LLMMetrics
 from sbilifeco.gateways.vertex import VertexAI
+from sbilifeco.gateways.vertex_admission import (
+    AdaptiveConcurrencyLimit,
+    AdmissionControlledLLM,
+)
+from sbilifeco.boundaries.chunking_jobs import ChunkingJobStatus
+from sbilifeco.gateways.vertex_chunk_parser import (
+    DelimitedChunkParser,
+    SizedChunkParser,
+)
+from sbilifeco.gateways.vertex_chunk_store import ChunkStore
+from sbilifeco.gateways.vertex_chunking_jobs import (
+    ChunkingJobs,
+    StreamingChunkingBackend,
+)
+from sbilifeco.gateways.vertex_downloader import MaterialDownloader
+from sbilifeco.gateways.vertex_executor import BoundedExecutor, ExecutorSaturated
 from sbilifeco.gateways.vertex_gemini import VertexGemini
+from sbilifeco.gateways.vertex_material_source import MaterialSource
+from sbilifeco.gateways.vertex_prechunker import PreChunker, merge_in_order
+from sbilifeco.gateways.vertex_prompt_cache import PromptCacheRegistry
+from sbilifeco.gateways.vertex_reply_cache import CachedLLM, InMemoryReplyCache
+from sbilifeco.gateways.vertex_retry import RetryPolicy
+from sbilifeco.gateways.vertex_router import VertexRouter
+from sbilifeco.gateways.vertex_token_budget import TokenBudget, TokenBudgetExceeded
+from sbilifeco.gateways.vertex_worker_reader import WorkerMaterialReader
+from sbilifeco.models.base import Response
 
 
 class Test(IsolatedAsyncioTestCase):
@@ -44,6 +84,7 @@ class Test(IsolatedAsyncioTestCase):
 
     async def asyncTearDown(self) -> None:
         # Shutdown the service(s) here
+        patch.stopall()
         await self.gemini_service.async_shutdown()
         await self.claude_service.async_shutdown()
 
@@ -81,6 +122,23 @@ class Test(IsolatedAsyncioTestCase):
         async for chunk in response.payload:
             print(chunk, flush=True)
 
+    async def test_gemini_streaming(self) -> None:
+        # Arrange
+        request = LLMRequest(
+            context="What is the answer to life, the universe and everything?"
+        )
+
+        # Act
+        response = await self.gemini_service.generate_streamed_reply(request)
+
+        # Assert
+        self.assertTrue(response.is_success, response.message)
+        assert response.payload is not None
+
+        async for chunk in response.payload:
+            print(chunk, flush=True)
+        self.assertNotIn(request.request_id, self.gemini_service.streams)
+
     async def test_read_and_chunk(self) -> None:
         # Arrange
         with open(self.BROCHURE_PATH, "rb") as brochure:
@@ -123,3 +181,858 @@ class Test(IsolatedAsyncioTestCase):
         async for chunk in stream:
             self.assertTrue(chunk)
             print(chunk, end="", flush=True)
+
+    async def test_cached_reply(self) -> None:
+        # Arrange
+        question = "What is the answer to life, the universe and everything?"
+        patched_generate_reply = patch.object(
+            self.claude_service, "generate_reply", return_value=Response.ok("42")
+        ).start()
+        cached_llm = (
+            CachedLLM()
+            .set_llm(self.claude_service)
+            .set_backend(InMemoryReplyCache().set_max_bytes(1024))
+        )
+
+        # Act
+        first_response = await cached_llm.generate_reply(question)
+        second_response = await cached_llm.generate_reply(question)
+
+        # Assert
+        self.assertEqual(first_response.payload, "42")
+        self.assertEqual(second_response.payload, "42")
+        patched_generate_reply.assert_called_once_with(question)
+
+        metrics = cached_llm.metrics()
+        self.assertEqual(metrics.hits, 1)
+        self.assertEqual(metrics.misses, 1)
+
+
+class UnitTest(IsolatedAsyncioTestCase):
+    """The gateways' building blocks, which need neither Vertex AI nor its credentials."""
+
+    async def asyncSetUp(self) -> None:
+        load_dotenv()
+
+        self.min_chunk_size = int(
+            getenv(EnvVars.min_chunk_size, Defaults.min_chunk_size)
+        )
+
+    async def asyncTearDown(self) -> None:
+        patch.stopall()
+
+    async def test_parallel_material_reads(self) -> None:
+        # Arrange
+        parallel_reads = 20
+        chunk_delay = 0.5
+
+        async def slow_chunks(*args, **kwargs):
+            for _ in range(3):
+                await sleep(chunk_delay)
+                yield MagicMock(text="x" * self.min_chunk_size)
+
+        fake_client = MagicMock()
+        fake_client.aio.models.generate_content_stream = AsyncMock(
+            side_effect=slow_chunks
+        )
+        fake_client.aio.models.count_tokens = AsyncMock(
+            return_value=MagicMock(total_tokens=100)
+        )
+        fake_client.aio.aclose = AsyncMock()
+        gemini = (
+            VertexGemini().set_model("gemini").set_min_chunk_size(self.min_chunk_size)
+        )
+        patch.object(gemini, "_create_client", return_value=fake_client).start()
+        await gemini.async_init()
+        first_chunks_at: list[float] = []
+
+        async def read_all_chunks() -> None:
+            response = await gemini.read_material(b"%PDF-1.7 brochure")
+            self.assertTrue(response.is_success, response.message)
+            assert response.payload is not None
+
+            chunk_response = await gemini.read_next_chunk(response.payload)
+            self.assertTrue(chunk_response.is_success, chunk_response.message)
+            first_chunks_at.append(perf_counter())
+            while chunk_response.is_success and chunk_response.payload is not None:
+                chunk_response = await gemini.read_next_chunk(response.payload)
+            self.assertTrue(chunk_response.is_success, chunk_response.message)
+
+        try:
+            # Act
+            started_at = perf_counter()
+            await gather(*[read_all_chunks() for _ in range(parallel_reads)])
+            elapsed = max(first_chunks_at) - started_at
+            streams = gemini.streams.metrics()
+        finally:
+            await gemini.async_shutdown()
+
+        # Assert
+        self.assertLess(elapsed, parallel_reads * chunk_delay / 4)
+        self.assertEqual(streams.live, 0)
+        self.assertEqual(streams.completed, parallel_reads)
+
+    async def test_chunk_store(self) -> None:
+        # Arrange
+        chunks = ["first chunk", "second chunk", "third chunk"]
+
+        async def chunks_by_llm():
+            for chunk in chunks:
+                yield chunk
+
+        with TemporaryDirectory() as directory:
+            chunk_store = ChunkStore().set_directory(directory)
+            await chunk_store.async_init()
+            key = chunk_store.key("digest", "model", "1", self.min_chunk_size)
+
+            truncated_key = chunk_store.key("other", "model", "1", self.min_chunk_size)
+            orphan = join(directory, f"{truncated_key}.crashed.partial")
+            open(orphan, "w").close()
+
+            # Act
+            teed_chunks = [
+                chunk
+                async for chunk in chunk_store.tee(key, chunks_by_llm(), ["end_turn"])
+            ]
+            stored_chunks = [chunk async for chunk in chunk_store.read(key)]
+            truncated_chunks = [
+                chunk
+                async for chunk in chunk_store.tee(
+                    truncated_key, chunks_by_llm(), ["end_turn", "max_tokens"]
+                )
+            ]
+
+            # Assert
+            self.assertEqual(teed_chunks, chunks)
+            self.assertEqual(stored_chunks, chunks)
+            self.assertEqual(truncated_chunks, chunks)
+            self.assertFalse(chunk_store.has(truncated_key))
+
+            # Act
+            await chunk_store.set_max_bytes(0).set_partial_max_age(0).evict()
+
+            # Assert
+            self.assertFalse(chunk_store.has(key))
+            self.assertFalse(exists(orphan))
+
+    async def test_material_source_memory(self) -> None:
+        # Each read runs in a process of its own, so its peak RSS is its own.
+        # "read_all" is the way materials used to be read: the whole file,
+        # and for Claude its base64 bytes and base64 string too, all at once.
+        script = dedent(
+            """
+            import sys
+            from base64 import b64encode
+            from hashlib import sha256
+            from os import fork, wait
+            from resource import RUSAGE_SELF, getrusage
+            from sbilifeco.gateways.vertex_material_source import MaterialSource
+
+            # Work in a forked child, as an exec'd process keeps the peak RSS
+            # of the test runner it was started from
+            if fork():
+                wait()
+                sys.exit()
+
+            gateway, how, path = sys.argv[1:]
+            before = getrusage(RUSAGE_SELF).ru_maxrss
+            if how == "read_all":
+                with open(path, "rb") as f:
+                    data = f.read()
+                if gateway == "claude":
+                    data = b64encode(data).decode("ascii")
+            else:
+                source = MaterialSource.open(f"file://{path}")
+                source.digest()
+                data = source.base64() if gateway == "claude" else source.as_bytes()
+                source.close()
+            grown = getrusage(RUSAGE_SELF).ru_maxrss - before
+            if isinstance(data, str):
+                data = data.encode("ascii")
+            print(grown * 1024, sha256(data).hexdigest())
+            """
+        )
+
+        def peak_rss(gateway: str, how: str, path: str) -> tuple[int, str]:
+            ran = run(
+                [executable, "-c", script, gateway, how, path],
+                env={**environ, "PYTHONPATH": pathsep.join(sys.path)},
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            grown, digest = ran.stdout.split()
+            return int(grown), digest
+
+        for size_mb in (10, 100):
+            with NamedTemporaryFile(suffix=".pdf") as pdf:
+                # Arrange
+                size = size_mb * 1024 * 1024
+                pdf.write(b"%PDF-1.7\n" + urandom(size))
+                pdf.flush()
+
+                for gateway in ("claude", "gemini"):
+                    # Act
+                    read_all_peak, expected = peak_rss(gateway, "read_all", pdf.name)
+                    mapped_peak, digest = peak_rss(gateway, "mapped", pdf.name)
+
+                    # Assert
+                    print(
+                        f"{gateway}, {size_mb} MB: read-all peak RSS {read_all_peak / 2**20:.1f} MB, "
+                        f"memory-mapped peak RSS {mapped_peak / 2**20:.1f} MB",
+                        flush=True,
+                    )
+                    self.assertEqual(digest, expected)
+                    if gateway == "claude":
+                        self.assertLess(mapped_peak, read_all_peak * 0.85)
+                    else:
+                        # One copy, without the mapped file resident as well
+                        self.assertLess(mapped_peak, size * 1.25)
+
+    async def test_downloader(self) -> None:
+        status_codes: list[int] = []
+
+        class RecordingHandler(SimpleHTTPRequestHandler):
+            def log_request(self, code="-", size="-") -> None:
+                status_codes.append(int(code))
+
+        with TemporaryDirectory() as served, TemporaryDirectory() as cache:
+            # Arrange
+            with open(join(served, "brochure.pdf"), "wb") as f:
+                f.write(b"%PDF-1.7\n" + urandom(64 * 1024))
+
+            http_server = ThreadingHTTPServer(
+                ("localhost", 0), partial(RecordingHandler, directory=served)
+            )
+            Thread(target=http_server.serve_forever, daemon=True).start()
+            url = f"http://localhost:{http_server.server_address[1]}/brochure.pdf"
+
+            # A cache too small for even the one brochure must still keep it
+            downloader = (
+                MaterialDownloader()
+                .set_cache_directory(cache)
+                .set_fresh_for(0)
+                .set_max_cache_bytes(1024)
+            )
+            await downloader.async_init()
+
+            try:
+                # Act
+                paths = await gather(*[downloader.download(url) for _ in range(5)])
+                path_again = await downloader.download(url)
+
+                # Assert
+                self.assertEqual(len(set(paths)), 1)
+                self.assertEqual(path_again, paths[0])
+                self.assertEqual(getsize(paths[0]), 9 + 64 * 1024)
+                self.assertEqual(status_codes, [200, 304])
+            finally:
+                await downloader.async_shutdown()
+                http_server.shutdown()
+
+    async def test_bounded_executor(self) -> None:
+        # Arrange
+        executor = (
+            BoundedExecutor().set_workers(2).set_max_queue(2).set_queue_timeout(0.1)
+        )
+        waits: list[tuple[str, float]] = []
+        executor.set_on_wait(lambda call, waited: waits.append((call, waited))).start()
+        single = (
+            BoundedExecutor().set_workers(1).set_max_queue(0).set_queue_timeout(0.1)
+        )
+        single.start()
+
+        try:
+            # Act
+            results = await gather(
+                *[executor.run(blocking_sleep, 0.3) for _ in range(5)],
+                return_exceptions=True,
+            )
+            metrics = executor.metrics()
+
+            abandoned = create_task(single.run(blocking_sleep, 0.3))
+            await sleep(0.05)
+            abandoned.cancel()
+            with self.assertRaises(ExecutorSaturated):
+                await single.run(blocking_sleep, 0)
+            await sleep(0.3)
+            await single.run(blocking_sleep, 0)
+
+            # Assert
+            rejected = [r for r in results if isinstance(r, ExecutorSaturated)]
+            self.assertEqual(len(rejected), 1)
+            self.assertEqual(metrics.rejected, 1)
+            self.assertEqual(metrics.completed, 4)
+            self.assertEqual(metrics.queued, 0)
+            self.assertEqual(metrics.busy, 0)
+            self.assertGreater(metrics.max_wait_seconds, 0.2)
+            self.assertEqual([call for call, _ in waits], ["sleep"] * 4)
+        finally:
+            executor.stop()
+            single.stop()
+
+    async def test_admission_control(self) -> None:
+        # Arrange
+        in_flight = 0
+        peak_in_flight = 0
+
+        async def generate_reply(context: str) -> Response[str]:
+            nonlocal in_flight, peak_in_flight
+            in_flight += 1
+            peak_in_flight = max(peak_in_flight, in_flight)
+            await sleep(0.05)
+            in_flight -= 1
+            return Response.ok(context)
+
+        llm = MagicMock()
+        llm.generate_reply = generate_reply
+        admission = (
+            AdmissionControlledLLM()
+            .set_llm(llm)
+            .set_initial_concurrency(4)
+            .set_max_concurrency(4)
+            .set_max_wait(0.12)
+        )
+
+        # Act
+        responses = await gather(
+            *[admission.generate_reply(str(i)) for i in range(20)]
+        )
+
+        # Assert
+        codes = [response.code for response in responses]
+        self.assertEqual(peak_in_flight, 4)
+        self.assertGreater(codes.count(503), 0)
+        self.assertEqual(codes.count(503), admission.metrics().rejected)
+        self.assertEqual(admission.metrics().in_flight, 0)
+
+        # Act, with a whole round of calls rate limited at once
+        limit = AdaptiveConcurrencyLimit()
+        for _ in range(8):
+            await limit.acquire(monotonic() + 1)
+        for _ in range(8):
+            await limit.release(None, True)
+
+        # Assert
+        self.assertEqual(limit.limit, 8.0)
+
+        # Act, routing over two models, each admitted on its own
+        in_flight = peak_in_flight = 0
+        backends = [
+            AdmissionControlledLLM()
+            .set_llm(MagicMock(region="us-central1", model=model))
+            .set_initial_concurrency(1)
+            .set_max_concurrency(1)
+            .set_max_wait(1)
+            for model in ["claude-sonnet-4", "gemini-2.5-pro"]
+        ]
+        router = VertexRouter()
+        for backend in backends:
+            backend.llm.generate_reply = generate_reply
+            router.add_backend(backend)
+        routed = await gather(*[router.generate_reply(str(i)) for i in range(4)])
+
+        # Assert
+        self.assertTrue(all(response.is_success for response in routed))
+        self.assertEqual(peak_in_flight, 2)
+        self.assertEqual([backend.metrics().admitted for backend in backends], [2, 2])
+
+        # Act, chunking a material, which holds its slot until its chunks end
+        async def material_chunks():
+            yield "chunk"
+
+        reader = MagicMock(region="us-central1", model="gemini-2.5-pro")
+        reader.read_and_chunk = AsyncMock(
+            side_effect=lambda _: Response.ok(material_chunks())
+        )
+        admitted_reader = (
+            AdmissionControlledLLM()
+            .set_llm(reader)
+            .set_initial_concurrency(1)
+            .set_max_concurrency(1)
+            .set_max_wait(0.05)
+        )
+        first_read = await admitted_reader.read_and_chunk("brochure")
+        read_meanwhile = await admitted_reader.read_and_chunk("brochure")
+        assert first_read.payload is not None
+        chunks_read = [chunk async for chunk in first_read.payload]
+        read_after = await admitted_reader.read_and_chunk("brochure")
+
+        # Assert
+        self.assertEqual(chunks_read, ["chunk"])
+        self.assertEqual(read_meanwhile.code, 503)
+        self.assertTrue(read_after.is_success, read_after.message)
+
+    async def test_retries_and_hedging(self) -> None:
+        # Arrange
+        policy: RetryPolicy[int] = (
+            RetryPolicy()
+            .set_base_delay(0.01)
+            .set_hedging(True)
+            .set_min_hedge_delay(0.01)
+        )
+        attempts = 0
+
+        async def attempt() -> int:
+            nonlocal attempts
+            attempts += 1
+            if attempts % 40 == 0:
+                await sleep(5)  # a stuck call, which the hedge should cut off
+            elif attempts % 13 == 0:
+                raise ConnectionError("Connection reset")
+            else:
+                await sleep(0.01)
+            return attempts
+
+        # Act
+        started_at = perf_counter()
+        for _ in range(60):
+            await policy.call(attempt, lambda e: isinstance(e, ConnectionError))
+        elapsed = perf_counter() - started_at
+
+        # Assert
+        metrics = policy.metrics()
+        self.assertGreater(metrics.retries, 0)
+        self.assertGreater(metrics.hedges_won, 0)
+        self.assertLess(elapsed, 5)
+
+        # Act, exporting the counters
+        registry = LLMMetrics()
+        policy.add_metrics(registry, model="gemini-2.5-pro")
+        rendered = registry.render()
+
+        # Assert
+        self.assertIn("# TYPE llm_vertex_retries_total counter", rendered)
+        self.assertIn(
+            f'llm_vertex_retries_total{{model="gemini-2.5-pro"}} {float(metrics.retries)}',
+            rendered,
+        )
+
+    async def test_worker_material_reads(self) -> None:
+        # Arrange
+        chunks = ["First chunk", b"%PDF-1.7 second chunk", None]
+        gemini = MagicMock()
+        gemini.read_material = AsyncMock(return_value=Response.ok("brochure"))
+        gemini.read_next_chunk = AsyncMock(
+            side_effect=[Response.ok(chunk) for chunk in chunks]
+        )
+
+        with TemporaryDirectory() as directory:
+            workers = [
+                WorkerMaterialReader().set_reader(gemini).set_relay_directory(directory)
+                for _ in range(2)
+            ]
+            workers[0].worker_id, workers[1].worker_id = "100", "200"
+            for worker in workers:
+                await worker.async_init()
+
+            try:
+                # Act
+                material_id = await workers[0].read_material("brochure.pdf")
+                assert material_id.payload is not None
+                relayed = [
+                    await workers[1].read_next_chunk(material_id.payload)
+                    for _ in chunks
+                ]
+                await workers[0].async_shutdown()
+                after_stop = await workers[1].read_next_chunk(material_id.payload)
+
+                # Assert
+                self.assertEqual(material_id.payload, "100:brochure")
+                self.assertEqual([response.payload for response in relayed], chunks)
+                gemini.read_next_chunk.assert_awaited_with("brochure")
+                self.assertEqual(after_stop.code, 404)
+            finally:
+                for worker in workers:
+                    await worker.async_shutdown()
+
+    async def test_router_failover(self) -> None:
+        # Arrange
+        exhausted = MagicMock(region="us-central1", model="claude-sonnet-4")
+        exhausted.generate_reply = AsyncMock(
+            return_value=Response.fail("Quota exceeded", 429)
+        )
+        healthy = MagicMock(region="europe-west1", model="claude-sonnet-4")
+        healthy.generate_reply = AsyncMock(return_value=Response.ok("42"))
+        for backend in [exhausted, healthy]:
+            backend.async_init = AsyncMock()
+
+        metrics = LLMMetrics()
+        router = (
+            VertexRouter()
+            .set_failure_threshold(2)
+            .set_metrics(metrics)
+            .add_backend(exhausted)
+            .add_backend(healthy)
+        )
+        await router.async_init()
+
+        # Act
+        responses = [await router.generate_reply("Question") for _ in range(10)]
+        rendered = metrics.render()
+
+        # Assert
+        self.assertTrue(all(response.payload == "42" for response in responses))
+        self.assertEqual(exhausted.generate_reply.await_count, 2)
+        self.assertEqual(router.metrics()[0].circuit, "open")
+        self.assertIn(
+            'llm_router_failures_total{backend="us-central1/claude-sonnet-4"} 2.0',
+            rendered,
+        )
+        self.assertIn(
+            'llm_router_circuit_state{backend="us-central1/claude-sonnet-4",state="open"} 1.0',
+            rendered,
+        )
+        self.assertIn(
+            'llm_router_successes_total{backend="europe-west1/claude-sonnet-4"} 10.0',
+            rendered,
+        )
+
+    async def test_chunking_jobs(self) -> None:
+        # Arrange
+        class Backend:
+            def __init__(self) -> None:
+                self.calls: list[list[int]] = []
+                self.states: list[dict[str, str]] = []
+                self.cancelled: list[dict[str, str]] = []
+
+            async def chunk_many(self, sources: list[tuple[int, str]], checkpoint):
+                self.calls.append([index for index, _ in sources])
+                self.states.append(dict(checkpoint.state))
+                await checkpoint.save(run=str(len(self.calls)))
+                for index, source in sources:
+                    await sleep(0.1)
+                    if source == "unreadable":
+                        yield index, ValueError("Unsupported source material")
+                    else:
+                        yield index, [f"{source} chunk {n}" for n in range(3)]
+
+            async def cancel(self, checkpoint) -> None:
+                self.cancelled.append(dict(checkpoint.state))
+
+        backend = Backend()
+
+        with TemporaryDirectory() as directory:
+            jobs = ChunkingJobs().set_directory(directory).set_backend(backend)
+            await jobs.async_init()
+
+            # Act
+            submitted = await jobs.submit_job(["first", "unreadable", "third"])
+            assert submitted.payload is not None
+            watched = await jobs.watch_job(submitted.payload.job_id)
+            assert watched.payload is not None
+            updates = [job async for job in watched.payload]
+            chunks = await jobs.read_job_chunks(submitted.payload.job_id, 2)
+
+            # Assert
+            self.assertEqual(updates[-1].status, ChunkingJobStatus.FAILED)
+            self.assertEqual(
+                [document.status for document in updates[-1].documents],
+                [
+                    ChunkingJobStatus.SUCCEEDED,
+                    ChunkingJobStatus.FAILED,
+                    ChunkingJobStatus.SUCCEEDED,
+                ],
+            )
+            self.assertEqual(chunks.payload, [f"third chunk {n}" for n in range(3)])
+
+            # Act, stopping a job halfway and starting again from disk
+            submitted = await jobs.submit_job([f"document {n}" for n in range(4)])
+            assert submitted.payload is not None
+            await sleep(0.25)
+            await jobs.async_shutdown()
+
+            restarted = ChunkingJobs().set_directory(directory).set_backend(backend)
+            await restarted.async_init()
+            watched = await restarted.watch_job(submitted.payload.job_id)
+            assert watched.payload is not None
+            updates = [job async for job in watched.payload]
+
+            # Assert
+            self.assertEqual(updates[-1].status, ChunkingJobStatus.SUCCEEDED)
+            self.assertEqual(backend.calls[-1], [2, 3])
+            self.assertEqual(backend.states[-1], {"run": "2"})
+
+            # Act, cancelling a job the backend has started
+            submitted = await restarted.submit_job(["cancelled"])
+            assert submitted.payload is not None
+            await sleep(0.05)
+            cancelled = await restarted.cancel_job(submitted.payload.job_id)
+            await restarted.async_shutdown()
+
+            # Assert
+            assert cancelled.payload is not None
+            self.assertEqual(cancelled.payload.status, ChunkingJobStatus.CANCELLED)
+            self.assertEqual(backend.cancelled, [{"run": "4"}])
+
+            # Act, leaving finished jobs to age while running
+            expiring = (
+                ChunkingJobs()
+                .set_directory(directory)
+                .set_backend(backend)
+                .set_sweep_interval(0.1)
+            )
+            await expiring.async_init()
+            loaded = len(expiring.jobs)
+            expiring.set_max_age(0.01)
+            await sleep(0.3)
+            await expiring.async_shutdown()
+
+            # Assert
+            self.assertEqual(loaded, 3)
+            self.assertEqual(expiring.jobs, {})
+            self.assertEqual(listdir(directory), [])
+
+    async def test_broken_chunking_stream(self) -> None:
+        # Arrange
+        async def text_stream():
+            yield "First chunk\n#=====#\n"
+            raise ConnectionError("Stream reset by Vertex AI")
+
+        reply = MagicMock()
+        reply.__aenter__ = AsyncMock(return_value=MagicMock(text_stream=text_stream()))
+        reply.__aexit__ = AsyncMock(return_value=False)
+        vertex_client = MagicMock()
+        vertex_client.messages.stream.return_value = reply
+
+        claude = VertexAI()
+        claude.clients = MagicMock()
+        claude.clients.acquire.return_value = vertex_client
+        claude.clients.release = AsyncMock()
+        backend = StreamingChunkingBackend().set_reader(claude)
+
+        with TemporaryDirectory() as directory:
+            jobs = ChunkingJobs().set_directory(directory).set_backend(backend)
+            await jobs.async_init()
+
+            # Act
+            submitted = await jobs.submit_job(["Policy terms."])
+            assert submitted.payload is not None
+            watched = await jobs.watch_job(submitted.payload.job_id)
+            assert watched.payload is not None
+            updates = [job async for job in watched.payload]
+
+            # Assert
+            self.assertEqual(updates[-1].status, ChunkingJobStatus.FAILED)
+            self.assertIn("Stream reset", updates[-1].documents[0].error or "")
+            claude.clients.release.assert_awaited_once_with(vertex_client)
+
+    async def test_prompt_cache(self) -> None:
+        # Arrange
+        brochure = "Policy terms. " * 1000
+        created: list[str] = []
+
+        async def create(prefix: str, ttl: float) -> str:
+            await sleep(0.05)
+            if prefix.startswith("Refused"):
+                raise ValueError("Cached content is too small")
+            created.append(prefix)
+            return f"cachedContents/{len(created)}"
+
+        registry = PromptCacheRegistry(create).set_ttl(0.3).set_refresh_margin(0.1)
+
+        # Act
+        handles = await gather(
+            *[registry.handle("gemini-2.5-flash", brochure) for _ in range(5)]
+        )
+        refused = await registry.handle("gemini-2.5-flash", "Refused " + brochure)
+        short = await registry.handle("gemini-2.5-flash", "Too short to cache")
+        await sleep(0.25)
+        renewed = await registry.handle("gemini-2.5-flash", brochure)
+
+        # Assert
+        self.assertEqual(set(handles), {"cachedContents/1"})
+        self.assertIsNone(refused)
+        self.assertIsNone(short)
+        self.assertEqual(renewed, "cachedContents/2")
+        metrics = registry.metrics()
+        self.assertEqual(metrics.creations, 2)
+        self.assertEqual(metrics.failures, 1)
+
+    async def test_prechunker(self) -> None:
+        # Arrange
+        prechunker = PreChunker().set_window_chars(200)
+        long_paragraph = " ".join(f"Clause {n} applies." for n in range(30))
+        text = "\n\n".join(
+            ["Benefits at a glance.", long_paragraph, "Exclusions apply."]
+        )
+
+        # Act
+        windows = prechunker.windows(text)
+
+        # Assert
+        self.assertGreater(len(windows), 1)
+        self.assertTrue(all(len(window) <= 200 for window in windows))
+        self.assertTrue(all(window.endswith(".") for window in windows))
+        self.assertEqual(" ".join(" ".join(windows).split()), " ".join(text.split()))
+
+    async def test_chunk_parsers(self) -> None:
+        # Arrange
+        async def deltas():
+            for delta in [
+                "First chunk.\n#==",
+                "===#\nSecond",
+                " chunk.\n#=====#",
+                "\nLast",
+            ]:
+                yield delta
+
+        sized = SizedChunkParser(20)
+        text = "One sentence here. Another one here. " * 3
+
+        # Act
+        chunks = [chunk async for chunk in DelimitedChunkParser().parse(deltas())]
+        sized_chunks = [sized.feed(text[n : n + 7]) for n in range(0, len(text), 7)]
+        sized_chunks.append(sized.close())
+
+        # Assert
+        self.assertEqual(chunks, ["First chunk.", "Second chunk.", "Last"])
+        self.assertEqual(" ".join(filter(None, sized_chunks)).strip(), text.strip())
+        self.assertTrue(
+            all(chunk.strip().endswith(".") for chunk in filter(None, sized_chunks))
+        )
+        self.assertTrue(
+            all(len(chunk) >= 20 for chunk in filter(None, sized_chunks[:-1]))
+        )
+
+    async def test_page_range_fan_out(self) -> None:
+        # Arrange
+        from pypdf import PdfReader, PdfWriter
+
+        writer = PdfWriter()
+        for _ in range(45):
+            writer.add_blank_page(200, 200)
+        with NamedTemporaryFile(suffix=".pdf") as pdf:
+            writer.write(pdf.name)
+            data = open(pdf.name, "rb").read()
+
+        def producer(number: int):
+            async def chunks():
+                for n in range(3):
+                    await sleep(0.05)
+                    yield f"range {number} chunk {n}"
+
+            return chunks
+
+        # Act
+        page_ranges = PreChunker().set_pages_per_range(10).page_ranges(data)
+        started_at = perf_counter()
+        merged = [
+            text
+            async for _, text in merge_in_order(
+                [producer(number) for number in range(len(page_ranges))], 5
+            )
+        ]
+        elapsed = perf_counter() - started_at
+
+        # Assert
+        self.assertEqual(
+            [len(PdfReader(BytesIO(pdf)).pages) for pdf in page_ranges],
+            [10, 10, 10, 10, 5],
+        )
+        self.assertEqual(
+            merged,
+            [f"range {number} chunk {n}" for number in range(5) for n in range(3)],
+        )
+        self.assertLess(elapsed, 0.5)
+
+        # Act, chunking the PDF with Claude
+        sent: list[dict] = []
+
+        def stream(**kwargs):
+            sent.append(kwargs["messages"][1]["content"][0]["source"])
+
+            async def text_stream():
+                yield "chunk"
+
+            reply = MagicMock()
+            reply.__aenter__ = AsyncMock(
+                return_value=MagicMock(
+                    text_stream=text_stream(),
+                    get_final_message=AsyncMock(
+                        return_value=MagicMock(stop_reason="end_turn")
+                    ),
+                )
+            )
+            reply.__aexit__ = AsyncMock(return_value=False)
+            return reply
+
+        claude = VertexAI().set_prechunker(
+            PreChunker().set_window_chars(0).set_pages_per_range(10)
+        )
+        claude.clients = MagicMock()
+        claude.clients.acquire.return_value.messages.stream = stream
+        claude.clients.release = AsyncMock()
+        response = await claude.read_and_chunk(data)
+        assert response.payload is not None
+        chunks = [chunk async for chunk in response.payload]
+
+        # Assert
+        self.assertEqual(
+            [
+                len(PdfReader(BytesIO(b64decode(source["data"]))).pages)
+                for source in sent
+            ],
+            [10, 10, 10, 10, 5],
+        )
+        self.assertEqual(chunks.count("chunk"), 5)
+
+    async def test_token_budget(self) -> None:
+        # Arrange
+        question = "What is the sum assured? "
+        brochure = "Policy terms. " * 3000
+        counted: list[str] = []
+
+        async def count_tokens(text: str) -> int:
+            counted.append(text)
+            return len(text) // 5
+
+        budget = (
+            TokenBudget()
+            .set_context_window(10000)
+            .set_min_output_tokens(500)
+            .set_count_tokens(count_tokens)
+        )
+        truncating = TokenBudget().set_context_window(10000).set_overflow("truncate")
+
+        small = MagicMock(region="us-central1", model="claude-sonnet-4")
+        small.generate_reply = AsyncMock(
+            return_value=Response.fail("The prompt is too large", 413)
+        )
+        large = MagicMock(region="us-central1", model="gemini-2.5-pro")
+        large.generate_reply = AsyncMock(return_value=Response.ok("42"))
+        router = VertexRouter().set_failure_threshold(1)
+        router.add_backend(small).add_backend(large)
+
+        # Act
+        _, max_tokens = await budget.fit(question, 8192)
+        prompt, near_max_tokens = await budget.fit(brochure[:38000], 8192)
+        await budget.fit(brochure[:38000], 8192)
+        _, overestimated_max_tokens = await budget.fit(question, 8192, fixed=brochure)
+        with self.assertRaises(TokenBudgetExceeded):
+            await budget.fit(question, 8192, fixed=brochure * 2)
+        truncated, _ = await truncating.fit(question + brochure + question, 8192)
+        with self.assertRaises(TokenBudgetExceeded):
+            await truncating.reply_tokens(brochure, 8192)
+        chunking_tokens = await truncating.reply_tokens(brochure[:4000], 8192)
+        responses = [await router.generate_reply(brochure) for _ in range(3)]
+
+        # Assert
+        self.assertEqual(max_tokens, 8192)
+        self.assertEqual(counted, [brochure[:38000], brochure, brochure * 2])
+        self.assertEqual(near_max_tokens, 10000 - 38000 // 5)
+        self.assertEqual(
+            overestimated_max_tokens,
+            10000 - len(brochure) // 5 - budget.estimate(question),
+        )
+        self.assertLessEqual(truncating.estimate(truncated), 10000 - 1024)
+        self.assertTrue(truncated.startswith(question))
+        self.assertTrue(truncated.endswith(question))
+        self.assertEqual(chunking_tokens, 8192)
+        self.assertTrue(all(response.payload == "42" for response in responses))
+        self.assertEqual(small.generate_reply.await_count, 3)
+        self.assertEqual(router.metrics()[0].circuit, "closed")
+        metrics = budget.metrics()
+        self.assertEqual(metrics.exact_counts, 3)
+        self.assertEqual(metrics.cached_counts, 1)
+        self.assertEqual(metrics.rejected, 1)